@@ -0,0 +1,410 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+# Built-in libraries
+import functools
+import json
+import logging
+import re
+import time
+
+# import rest handler
+import z_rest_handler
+
+# import kvstore repository
+from z_kvstore_repository import APP_NAME, KVRepository, collection_schema
+
+# the log file is written by the logging pipeline of the handler
+logger = logging.getLogger(__name__)
+
+
+def tabulator_param(params, *names):
+    """
+    Get the list of a Tabulator request parameter, sent as a JSON list or in the
+    name[0][key]=value form of the remote pagination requests.
+
+    >>> tabulator_param({"sort[0][field]": "a", "sort[0][dir]": "desc"}, "sort")
+    [{'field': 'a', 'dir': 'desc'}]
+    """
+
+    for name in names:
+        value = params.get(name)
+        if value is None:
+            continue
+        items = json.loads(value) if isinstance(value, str) else value
+        if not isinstance(items, list) or not all(isinstance(i, dict) for i in items):
+            raise ValueError(f"{name} is incorrect, a list of objects is expected")
+        return items
+
+    items = {}
+    for name in names:
+        pattern = re.compile(r"^%s\[(\d+)\]\[(\w+)\]$" % re.escape(name))
+        for key, value in params.items():
+            match = pattern.match(key)
+            if match:
+                items.setdefault(int(match.group(1)), {})[match.group(2)] = value
+
+    return [items[position] for position in sorted(items)]
+
+
+class KVTableHandler(z_rest_handler.RESTHandler):
+    """
+    Server side of the inline editors of KV store tables, like kv_store_table.xml.
+    """
+
+    # log file in $SPLUNK_HOME/var/log/splunk
+    log_file = "splunk_rest_kv_table.log"
+
+    # the time field of the records that is compared and set by each save
+    version_field = "updated"
+
+    # decimals of the version field, versions are compared as they are stored
+    version_precision = 3
+
+    # rows per page of the remote pagination
+    default_page_size = 50
+    max_page_size = 1000
+
+    # seconds the row count of a collection and filter is kept, saves invalidate it
+    count_ttl = 60
+
+    def __init__(self, command_line, command_arg):
+        super(KVTableHandler, self).__init__(command_line, command_arg, logger)
+
+        # row counts of the collections, grouped by collection
+        self.row_counts = z_rest_handler.SingleFlight(self.count_ttl)
+
+        # the (collection, _key) of the rows being saved by the threads of the process
+        self.save_locks = z_rest_handler.KeyLocks()
+
+    def table_repository(self, request_info, collection_name, versioned=True):
+        """
+        Get the repository of a collection declared in collections.conf, on behalf of
+        the user of the request. The collections that are saved must have the version
+        field.
+        """
+
+        schema = collection_schema(collection_name)
+        if versioned and schema.field_types.get(self.version_field) != "time":
+            raise ValueError(
+                f'collection="{collection_name}" has no time field="{self.version_field}" for the optimistic concurrency'
+            )
+
+        collection = self.get_kvstore_collection(
+            request_info, collection_name, app=APP_NAME
+        )
+        batch_size = self.get_kvstore_batch_size(request_info, app=APP_NAME)
+
+        # the chunks of a collection run concurrently, bounded per collection
+        return KVRepository(
+            collection,
+            schema,
+            batch_size,
+            map_function=functools.partial(
+                self.map_concurrent, tenant_id=collection_name
+            ),
+        )
+
+    def get_rows(self, request_info, collection=None, page=1, size=None, **kwargs):
+
+        # the collection is required, if not submitted describe the usage
+        if collection is None or kwargs.get("describe") in ("true", "True"):
+            response = {
+                "describe": "This endpoint serves one page of a KV store table for the Tabulator remote pagination, it requires a GET call with the following query parameters:",
+                "resource_desc": "Get one page of the rows of a KV store table, with the total number of pages",
+                "resource_spl_example": '| rest splunk_server=local "/services/kv_table/rows?collection=my_collection&page=1&size=50&sort[0][field]=mynumber&sort[0][dir]=desc"',
+                "options": [
+                    {
+                        "collection": "The KV store collection, declared in collections.conf with the time field updated",
+                        "page": "OPTIONAL: the page number, starting at 1",
+                        "size": f"OPTIONAL: the number of rows per page, defaults to {self.default_page_size}, up to {self.max_page_size}",
+                        "sort": "OPTIONAL: the Tabulator sorters as sort[n][field] and sort[n][dir] (asc | desc), or as a JSON list in sorters",
+                        "filter": "OPTIONAL: the Tabulator filters as filter[n][field], filter[n][type] and filter[n][value], or as a JSON list in filters. The types are =, !=, <, <=, >, >= and in (JSON only), like is not supported by the KV store",
+                        "fields": "OPTIONAL: comma separated list of fields to be returned",
+                    }
+                ],
+            }
+            return {"payload": response, "status": 200}
+
+        try:
+            page = int(page)
+            size = int(size or self.default_page_size)
+            if page < 1 or not 0 < size <= self.max_page_size:
+                raise ValueError(
+                    f"page and size are incorrect, valid sizes are 1 to {self.max_page_size}"
+                )
+
+            sorters = [
+                (sorter.get("field"), sorter.get("dir", "asc"))
+                for sorter in tabulator_param(kwargs, "sorters", "sort")
+            ]
+            filters = [
+                (item.get("field"), item.get("type", "="), item.get("value"))
+                for item in tabulator_param(kwargs, "filters", "filter")
+            ]
+            fields = [
+                field.strip()
+                for field in kwargs.get("fields", "").split(",")
+                if field.strip()
+            ]
+
+            repository = self.table_repository(
+                request_info, collection, versioned=False
+            )
+            query = repository.schema.query(filters)
+            sort = repository.schema.sort(sorters) or "_key"
+
+        except (KeyError, TypeError, ValueError) as e:
+            error_msg = self.log_error('collection="%s", %s', collection, e.args[0])
+            return {
+                "payload": {"action": "failure", "result": error_msg},
+                "status": 500,
+            }
+
+        try:
+            with self.timed("kv_query"):
+                # the stored documents, with the fields that are not declared
+                documents = repository.find_documents(
+                    query, (page - 1) * size, size, sort, fields
+                )
+                # counts are kept per user, they are read with the session of the user
+                count = self.row_counts.do(
+                    (collection, request_info.user, json.dumps(query, sort_keys=True)),
+                    functools.partial(repository.count, query),
+                    group=collection,
+                )
+
+        except Exception as e:
+            error_msg = self.log_error(
+                'collection="%s", failed to retrieve KVstore collection records, exception="%s"',
+                collection,
+                e,
+            )
+            return {
+                "payload": {"action": "failure", "result": error_msg},
+                "status": 500,
+            }
+
+        return self.render_json(
+            {
+                "last_page": max(1, -(-count // size)),
+                "last_row": count,
+                "data": documents,
+            }
+        )
+
+    def post_save_delta(self, request_info, **kwargs):
+
+        describe = False
+
+        # Retrieve from data
+        resp_dict = request_info.json_body
+
+        if resp_dict is not None:
+            describe = resp_dict.get("describe") in ("true", "True", True)
+        else:
+            describe = True
+
+        if describe:
+            response = {
+                "describe": "This endpoint saves the rows changed in a KV store table, it requires a POST call with the following data:",
+                "resource_desc": "Save the changed rows of a KV store table, rows that were modified since they were loaded are not saved and returned as conflicts",
+                "resource_spl_example": "| rest splunk_server=local /services/kv_table/save_delta method=post body=\"{'collection': 'my_collection', 'rows': [{'_key': '65a0f0c1e4b0', 'updated': 1704067200, 'mynumber': 2}]}\"",
+                "options": [
+                    {
+                        "collection": "The KV store collection, declared in collections.conf with the time field updated",
+                        "rows": "The changed rows, each with its _key, the updated value of the row as it was loaded (if the row has one) and the changed fields only, a field set to null is removed. Rows without _key are inserted",
+                    }
+                ],
+            }
+            return {"payload": response, "status": 200}
+
+        collection_name = resp_dict.get("collection")
+        rows = resp_dict.get("rows")
+        if not collection_name or not isinstance(rows, list):
+            error_msg = self.log_error(
+                'collection="%s", the collection and the list of rows are required',
+                collection_name,
+            )
+            return {
+                "payload": {"action": "failure", "result": error_msg},
+                "status": 500,
+            }
+
+        try:
+            repository = self.table_repository(request_info, collection_name)
+        except (KeyError, ValueError) as e:
+            error_msg = self.log_error("%s", e.args[0])
+            return {
+                "payload": {"action": "failure", "result": error_msg},
+                "status": 500,
+            }
+
+        # the rows are read, compared and saved while no other thread saves them
+        keys = [
+            (collection_name, row["_key"])
+            for row in rows
+            if isinstance(row, dict) and isinstance(row.get("_key"), str)
+        ]
+        with self.save_locks.hold(keys):
+            try:
+                results, documents = self.merge_delta(repository, rows)
+            except Exception as e:
+                error_msg = self.log_error(
+                    'collection="%s", failed to retrieve the KVstore records of the changed rows, exception="%s"',
+                    collection_name,
+                    e,
+                )
+                return {
+                    "payload": {"action": "failure", "result": error_msg},
+                    "status": 500,
+                }
+
+            # the merged rows are saved through batch_save, one call up to the KV store limit
+            with self.timed("kv_write"):
+                saved_keys = repository.upsert_documents(
+                    [document for position, document in documents]
+                )
+
+        for (position, document), saved_key in zip(documents, saved_keys):
+            if isinstance(saved_key, Exception):
+                results[position] = {
+                    "_key": document.get("_key"),
+                    "result": "failure",
+                    "exception": f'collection="{collection_name}", the row could not be saved, exception="{str(saved_key)}"',
+                }
+            else:
+                results[position] = {
+                    "_key": saved_key,
+                    "result": "success",
+                    self.version_field: document[self.version_field],
+                }
+
+        # the row counts of the collection are counted again by the next page
+        if documents:
+            self.row_counts.invalidate(collection_name)
+
+        counts = {"success": 0, "conflict": 0, "failure": 0}
+        for result in results:
+            counts[result["result"]] += 1
+
+        req_summary = {
+            "process_count": len(results),
+            "success_count": counts["success"],
+            "conflicts_count": counts["conflict"],
+            "failures_count": counts["failure"],
+            "records": results,
+        }
+
+        if counts["failure"]:
+            http_status = 500
+        elif counts["conflict"]:
+            http_status = 409
+        else:
+            http_status = 200
+
+        return self.render_json(req_summary, http_status)
+
+    def version(self, value):
+        """
+        Get a version as it is stored, rounded to version_precision decimals.
+
+        >>> KVTableHandler.version(KVTableHandler, 1704067200.1234567)
+        1704067200.123
+        """
+
+        if value is None:
+            return None
+        return round(float(value), self.version_precision)
+
+    def merge_delta(self, repository, rows):
+        """
+        Merge the changed rows into the stored documents of the collection, the fields
+        that are not declared in the schema are kept. A row without a version updates a
+        stored document without a version, e.g. a row written by another application.
+
+        Returns the results of the rows that are not saved (invalid rows and conflicts)
+        and the (position, document) of the rows to save, the other results are None.
+        """
+
+        schema = repository.schema
+        version_field = self.version_field
+        version_attribute = schema.record_class._attributes[version_field]
+        now = self.version(time.time())
+        results = [None] * len(rows)
+
+        def failure(position, row, exception):
+            results[position] = {
+                "_key": row.get("_key") if isinstance(row, dict) else None,
+                "result": "failure",
+                "exception": f'collection="{schema.name}", the row is not valid, exception="{str(exception)}"',
+            }
+
+        # validate the changes locally, before any call to splunkd
+        changes = []
+        for position, row in enumerate(rows):
+            try:
+                record = schema.coerce(row)
+            except ValueError as e:
+                failure(position, row, e)
+                continue
+            changes.append((position, row, record))
+
+        # read the stored documents of the changed rows only
+        keys = [record._key for _, _, record in changes if record._key is not None]
+        with self.timed("kv_query"):
+            current_documents = dict(zip(keys, repository.get_documents(keys)))
+
+        documents = []
+        for position, row, record in changes:
+            if record._key is None:
+                document = record.to_dict()
+            else:
+                current = current_documents.get(record._key)
+                if current is None:
+                    results[position] = {
+                        "_key": record._key,
+                        "result": "conflict",
+                        "reason": "the row was deleted",
+                    }
+                    continue
+
+                try:
+                    current_version = current.get(version_field)
+                    if current_version is not None:
+                        current_version = schema.coerce_value(
+                            version_field, current_version
+                        )
+                except ValueError as e:
+                    failure(position, row, e)
+                    continue
+
+                if self.version(current_version) != self.version(
+                    getattr(record, version_attribute)
+                ):
+                    results[position] = {
+                        "_key": record._key,
+                        "result": "conflict",
+                        "reason": "the row was modified",
+                        "current": current,
+                    }
+                    continue
+
+                # apply the changed fields, fields set to null are removed
+                document = dict(current)
+                changed = record.to_dict()
+                for field in row:
+                    if (
+                        field in ("_key", version_field)
+                        or field not in schema.field_types
+                    ):
+                        continue
+                    if row[field] is None:
+                        document.pop(field, None)
+                    else:
+                        document[field] = changed[field]
+
+            document[version_field] = now
+            documents.append((position, document))
+
+        return results, documents
@@ -12,41 +12,24 @@ __email__ = "support@trackme-solutions.com"
 __status__ = "PRODUCTION"
 
 # Built-in libraries
-import json
+import functools
 import logging
 import os
 import sys
 import time
-from logging.handlers import RotatingFileHandler
+from collections import OrderedDict
 
 # splunk home
 splunkhome = os.environ["SPLUNK_HOME"]
 
-# set logging
+# the log file is written by the logging pipeline of the handler
 logger = logging.getLogger(__name__)
-filehandler = RotatingFileHandler(
-    "%s/var/log/splunk/trackme_rest_api.log" % splunkhome,
-    mode="a",
-    maxBytes=10000000,
-    backupCount=1,
-)
-formatter = logging.Formatter(
-    "%(asctime)s %(levelname)s %(filename)s %(funcName)s %(lineno)d %(message)s"
-)
-logging.Formatter.converter = time.gmtime
-filehandler.setFormatter(formatter)
-log = logging.getLogger()
-for hdlr in log.handlers[:]:
-    if isinstance(hdlr, logging.FileHandler):
-        log.removeHandler(hdlr)
-log.addHandler(filehandler)
-log.setLevel(logging.INFO)
 
 # append libs
 sys.path.append(os.path.join(splunkhome, "etc", "apps", "trackme", "lib"))
 
 # import rest handler
-import trackme_rest_handler
+import z_rest_handler
 
 # import trackme libs
 from trackme_libs import (
@@ -54,19 +37,311 @@ from trackme_libs import (
     trackme_audit_event,
 )
 
-from trackme_libs_ack import (
-    get_all_ack_records_from_kvcollection,
-    convert_epoch_to_datetime,
+from trackme_libs_ack import convert_epoch_to_datetime
+
+# the epochs of the ack records repeat across reads, convert each of them once
+convert_epoch_to_datetime_cached = functools.lru_cache(maxsize=100000)(
+    convert_epoch_to_datetime
+)
+
+# import ack libs
+from z_ack_libs import (
+    ACK_KEYS_MIGRATED_KEY,
+    PUSHDOWN_MAX_OBJECTS,
+    AckExpiryAuthError,
+    AckExpiryError,
+    AckExpirySweeper,
+    AckKeyMigrationError,
+    AckRecordCache,
+    ack_keys_migrated,
+    ack_record_key,
+    decorate_ack_records,
+    is_auth_failure,
+    mark_ack_keys_migrated,
+    normalize_ack_record,
+    parse_derived_fields,
+    query_ack_records,
+    query_records_by_object,
+    rekey_ack_records,
+    to_epoch,
 )
 
-# import Splunk libs
-import splunklib.client as client
+# import kvstore helpers
+from z_kvstore_repository import batch_save_records, query_all_records, query_page
+
+
+class TrackMeHandlerAck_v2(z_rest_handler.RESTHandler):
+    # log file in $SPLUNK_HOME/var/log/splunk
+    log_file = "trackme_rest_api.log"
+
+    # expire the acks of the tenants in a background thread of the process
+    ack_expiry_enabled = True
 
+    # keys of the last audit records written, a batch that is retried skips them
+    audit_written_size = 10000
 
-class TrackMeHandlerAck_v2(trackme_rest_handler.RESTHandler):
     def __init__(self, command_line, command_arg):
         super(TrackMeHandlerAck_v2, self).__init__(command_line, command_arg, logger)
 
+        # ack records of the tenants, kept across requests of the persistent process
+        self.ack_cache = AckRecordCache()
+
+        # expiration of the acks in the background, with the system token and the
+        # splunkd URI of the last request of each tenant
+        self.ack_expiry = AckExpirySweeper(
+            self.load_active_acks, self.expire_acks, logger=logger
+        )
+        self.ack_expiry_contexts = {}
+
+        # written by the background thread of the audit sink only
+        self.audit_written = OrderedDict()
+
+        # the tenants whose collection is marked as migrated to the derived _key
+        self.ack_keys_migrated = set()
+        self.ack_keys_locks = z_rest_handler.KeyLocks()
+
+    def done(self):
+        """
+        Stop the ack expiry sweeper when the persistent process is done.
+        """
+
+        self.ack_expiry.stop()
+        super(TrackMeHandlerAck_v2, self).done()
+
+    def resolve_loglevel(self, request_info):
+        return trackme_getloglevel(
+            request_info.system_authtoken, request_info.server_rest_port
+        )
+
+    def write_audit_records(self, records):
+        for record in records:
+            if record.key in self.audit_written:
+                continue
+            trackme_audit_event(*record)
+            self.audit_written[record.key] = None
+            if len(self.audit_written) > self.audit_written_size:
+                self.audit_written.popitem(last=False)
+
+    def read_ack_records(
+        self,
+        tenant_id,
+        object_category,
+        collection,
+        object_value_list=None,
+    ):
+        """
+        Get the ack records of the category from the cache. While the cache is not
+        loaded, the records of a short list of objects are queried from the collection.
+        """
+
+        if (
+            object_value_list
+            and len(object_value_list) <= PUSHDOWN_MAX_OBJECTS
+            and not self.ack_cache.is_loaded(tenant_id, object_category)
+        ):
+            return query_ack_records(
+                collection,
+                object_category,
+                object_value_list,
+                map_function=functools.partial(
+                    self.map_concurrent, tenant_id=tenant_id
+                ),
+            )
+
+        return self.ack_cache.get(tenant_id, object_category, collection)
+
+    def track_ack_expiry(self, request_info, tenant_id):
+        """
+        Sweep the expired acks of the tenant of the request in the background, with the
+        system token of the request, the last request of the tenant refreshes it.
+        """
+
+        if not self.ack_expiry_enabled or not request_info.system_authtoken:
+            return
+
+        self.ack_expiry_contexts[tenant_id] = (
+            request_info.system_authtoken,
+            request_info.server_rest_uri,
+        )
+        self.ack_expiry.track(tenant_id)
+
+    def migrate_ack_keys(self, request_info, tenant_id, collection):
+        """
+        Migrate the ack records of a tenant to their derived _key before the handler
+        upserts records by their derived _key, the records of an object with another
+        _key would be duplicated otherwise. The migration runs once per collection, the
+        collections are marked once migrated.
+        """
+
+        if tenant_id in self.ack_keys_migrated:
+            return
+
+        with self.ack_keys_locks.hold([tenant_id]):
+            if tenant_id in self.ack_keys_migrated:
+                return
+
+            with self.timed("kv_query"):
+                migrated = ack_keys_migrated(collection)
+
+            if not migrated:
+                batch_size = self.get_kvstore_batch_size(request_info, app="trackme")
+                with self.timed("kv_write"):
+                    summary = rekey_ack_records(
+                        collection,
+                        batch_size,
+                        map_function=functools.partial(
+                            self.map_concurrent, tenant_id=tenant_id
+                        ),
+                    )
+
+                # the cached and coalesced records of the tenant refer to the previous keys
+                if summary["rekeyed"] or summary["deleted"]:
+                    self.ack_cache.invalidate(tenant_id)
+                    self.single_flight.invalidate()
+
+                if summary["failures"]:
+                    raise AckKeyMigrationError(
+                        f'{len(summary["failures"])} records could not be migrated, failures="{summary["failures"]}"'
+                    )
+
+                with self.timed("kv_write"):
+                    mark_ack_keys_migrated(collection)
+
+            self.ack_keys_migrated.add(tenant_id)
+
+    def ack_expiry_connection(self, tenant_id):
+        """
+        Get the connection of the ack expiry sweeper for a tenant, on behalf of the
+        system user.
+        """
+
+        context = self.ack_expiry_contexts.get(tenant_id)
+        if context is None:
+            raise AckExpiryAuthError(f'tenant_id="{tenant_id}", no system token')
+
+        system_authtoken, server_rest_uri = context
+        return self.service_pool.get(
+            system_authtoken, server_rest_uri, "nobody", "trackme"
+        )
+
+    def load_active_acks(self, tenant_id):
+        """
+        Get the active acks of a tenant, with the fields used to schedule their
+        expiration.
+        """
+
+        collection = self.ack_expiry_connection(tenant_id).kvstore_collection(
+            f"kv_trackme_common_alerts_ack_tenant_{tenant_id}"
+        )
+
+        with self.timed("kv_query"):
+            return query_all_records(
+                collection,
+                {"ack_state": "active"},
+                fields=("object", "object_category", "ack_state", "ack_expiration"),
+            )
+
+    def expire_acks(self, tenant_id, entries):
+        """
+        Set the due acks of a tenant to inactive, the records are read again as they
+        may have been updated since they were scheduled.
+        """
+
+        connection = self.ack_expiry_connection(tenant_id)
+        collection = connection.kvstore_collection(
+            f"kv_trackme_common_alerts_ack_tenant_{tenant_id}"
+        )
+        batch_size = connection.max_documents_per_batch_save()
+        system_authtoken, server_rest_uri = self.ack_expiry_contexts[tenant_id]
+        map_concurrent = functools.partial(self.map_concurrent, tenant_id=tenant_id)
+
+        objects_by_category = OrderedDict()
+        for object_category, object_value, _expiration in entries:
+            objects_by_category.setdefault(object_category, []).append(object_value)
+
+        now = time.time()
+        failures = []
+
+        for object_category, object_values in objects_by_category.items():
+            with self.timed("kv_query"):
+                ack_records = query_ack_records(
+                    collection,
+                    object_category,
+                    object_values,
+                    map_function=map_concurrent,
+                )
+
+            documents = []
+            for object_value in object_values:
+                ack_record = ack_records.get_by_object(object_value)
+                if ack_record is None or ack_record.get("ack_state") != "active":
+                    continue
+
+                # the ack was extended since it was scheduled
+                if to_epoch(ack_record.get("ack_expiration")) > now:
+                    self.ack_expiry.schedule(tenant_id, ack_record)
+                    continue
+
+                document = {
+                    field: value
+                    for field, value in ack_record.items()
+                    if field == "_key" or not field.startswith("_")
+                }
+                document.update(
+                    {
+                        "ack_state": "inactive",
+                        "ack_expiration": 0,
+                        "ack_type": "N/A",
+                        "ack_mtime": now,
+                    }
+                )
+                documents.append(document)
+
+            if not documents:
+                continue
+
+            with self.timed("kv_write"):
+                saved_keys = batch_save_records(
+                    collection, documents, batch_size, map_concurrent
+                )
+
+            # coalesced reads of the category must not serve the previous records
+            self.single_flight.invalidate((tenant_id, object_category))
+
+            for document, saved_key in zip(documents, saved_keys):
+                if isinstance(saved_key, Exception):
+                    failures.append(saved_key)
+                    continue
+
+                # write-through to the ack records cache
+                self.ack_cache.upsert(tenant_id, object_category, document)
+
+                # audit, written in the background
+                self.audit(
+                    system_authtoken,
+                    server_rest_uri,
+                    tenant_id,
+                    "splunk-system-user",
+                    "success",
+                    "expire ack",
+                    str(document["object"]),
+                    str(object_category),
+                    document,
+                    "The Ack expired",
+                    "N/A",
+                )
+
+        # the sweeper retries the entries later
+        if failures:
+            # a rejected session key pauses the tenant, other failures are retried
+            if any(is_auth_failure(failure) for failure in failures):
+                error_class = AckExpiryAuthError
+            else:
+                error_class = AckExpiryError
+            raise error_class(
+                f'tenant_id="{tenant_id}", {len(failures)} acks could not be expired, exception="{str(failures[0])}"'
+            )
+
     def get_resource_group_desc_ack(self, request_info, **kwargs):
         response = {
             "resource_group_name": "ack",
@@ -81,10 +356,7 @@ class TrackMeHandlerAck_v2(trackme_rest_handler.RESTHandler):
         tenant_id = None
 
         # Retrieve from data
-        try:
-            resp_dict = json.loads(str(request_info.raw_args["payload"]))
-        except Exception as e:
-            resp_dict = None
+        resp_dict = request_info.json_body
 
         if resp_dict is not None:
             try:
@@ -97,8 +369,9 @@ class TrackMeHandlerAck_v2(trackme_rest_handler.RESTHandler):
                 # tenant_id is required
                 tenant_id = resp_dict.get("tenant_id", None)
                 if tenant_id is None:
-                    error_msg = f'tenant_id="{tenant_id}", tenant_id is required'
-                    logging.error(error_msg)
+                    error_msg = self.log_error(
+                        'tenant_id="%s", tenant_id is required', tenant_id
+                    )
                     return {
                         "payload": {"action": "failure", "result": error_msg},
                         "status": 500,
@@ -108,8 +381,11 @@ class TrackMeHandlerAck_v2(trackme_rest_handler.RESTHandler):
                 action = resp_dict.get("action", "show")
                 if action not in ("show", "enable", "disable"):
                     # log error and return
-                    error_msg = f'tenant_id="{tenant_id}", action="{action}", action is incorrect, valid options are show | enable | disable'
-                    logging.error(error_msg)
+                    error_msg = self.log_error(
+                        'tenant_id="%s", action="%s", action is incorrect, valid options are show | enable | disable',
+                        tenant_id,
+                        action,
+                    )
                     return {
                         "payload": {"action": "failure", "result": error_msg},
                         "status": 500,
@@ -126,8 +402,11 @@ class TrackMeHandlerAck_v2(trackme_rest_handler.RESTHandler):
                     if action == "show":
                         object_list = "*"
                     else:
-                        error_msg = f'tenant_id="{tenant_id}", action="{action}", object_list is required'
-                        logging.error(error_msg)
+                        error_msg = self.log_error(
+                            'tenant_id="%s", action="%s", object_list is required',
+                            tenant_id,
+                            action,
+                        )
                         return {
                             "payload": {"action": "failure", "result": error_msg},
                             "status": 500,
@@ -140,14 +419,30 @@ class TrackMeHandlerAck_v2(trackme_rest_handler.RESTHandler):
                 # object_category
                 object_category_value = resp_dict["object_category"]
 
+                # pagination is optional, used if object_list is * and limit or cursor is set
+                try:
+                    pagination = z_rest_handler.Pagination.from_params(
+                        resp_dict, default_sort="_key"
+                    )
+                except ValueError as e:
+                    error_msg = self.log_error('tenant_id="%s", %s', tenant_id, e)
+                    return {
+                        "payload": {"action": "failure", "result": error_msg},
+                        "status": 500,
+                    }
+
                 # ack_period
                 ack_period = resp_dict.get("ack_period", 86400)
                 try:
                     ack_period = int(ack_period)
                 except Exception as e:
                     # log error format and return error
-                    error_msg = f'tenant_id="{tenant_id}", ack_period="{ack_period}", ack_period period is incorrect, an integer is expected, exception="{str(e)}"'
-                    logging.error(error_msg)
+                    error_msg = self.log_error(
+                        'tenant_id="%s", ack_period="%s", ack_period period is incorrect, an integer is expected, exception="%s"',
+                        tenant_id,
+                        ack_period,
+                        e,
+                    )
                     return {
                         "payload": {"action": "failure", "result": error_msg},
                         "status": 500,
@@ -157,8 +452,11 @@ class TrackMeHandlerAck_v2(trackme_rest_handler.RESTHandler):
                 ack_type = resp_dict.get("ack_type", "unsticky")
                 if not ack_type in ("sticky", "unsticky"):
                     # log error format and return error
-                    error_msg = f'tenant_id="{tenant_id}", ack_type="{ack_type}", ack_type is incorrect, valid options are sticky | unsticky'
-                    logging.error(error_msg)
+                    error_msg = self.log_error(
+                        'tenant_id="%s", ack_type="%s", ack_type is incorrect, valid options are sticky | unsticky',
+                        tenant_id,
+                        ack_type,
+                    )
                     return {
                         "payload": {"action": "failure", "result": error_msg},
                         "status": 500,
@@ -175,8 +473,11 @@ class TrackMeHandlerAck_v2(trackme_rest_handler.RESTHandler):
 
                 if not ack_source in ("auto_ack", "user_ack"):
                     # log error format and return error
-                    error_msg = f'tenant_id="{tenant_id}", ack_source="{ack_source}", ack_source is incorrect, valid options are auto_ack | user_ack'
-                    logging.error(error_msg)
+                    error_msg = self.log_error(
+                        'tenant_id="%s", ack_source="%s", ack_source is incorrect, valid options are auto_ack | user_ack',
+                        tenant_id,
+                        ack_source,
+                    )
                     return {
                         "payload": {"action": "failure", "result": error_msg},
                         "status": 500,
@@ -204,6 +505,10 @@ class TrackMeHandlerAck_v2(trackme_rest_handler.RESTHandler):
                         "ack_source": "OPTIONAL: the source of the ack, if unset will be defined to: user_ack. Valid options are: auto_ack, user_ack",
                         "anomaly_reason": "OPTIONAL: the reason for the anomaly, if unset will be defined to: N/A",
                         "update_comment": "OPTIONAL: a comment for the update, comments are added to the audit record, if unset will be defined to: API update",
+                        "limit": "OPTIONAL: if action=show and object_list=*, the maximum number of records per page, the response contains next_cursor to retrieve the next page",
+                        "cursor": "OPTIONAL: if action=show and object_list=*, the next_cursor of the previous page",
+                        "sort": "OPTIONAL: if action=show and object_list=*, the KVstore sort of the pages, defaults to _key",
+                        "fields": "OPTIONAL: if action=show and object_list=*, comma separated list of fields to be returned",
                     }
                 ],
             }
@@ -227,26 +532,11 @@ class TrackMeHandlerAck_v2(trackme_rest_handler.RESTHandler):
         # records summary
         records_summary = []
 
-        # Get splunkd port
-        splunkd_port = request_info.server_rest_port
-
-        # Get service
-        service = client.connect(
-            owner="nobody",
-            app="trackme",
-            port=splunkd_port,
-            token=request_info.session_key,
-            timeout=300,
-        )
-
-        # set loglevel
-        loglevel = trackme_getloglevel(
-            request_info.system_authtoken, request_info.server_rest_port
-        )
-        log.setLevel(logging.getLevelName(loglevel))
-
         collection_name = f"kv_trackme_common_alerts_ack_tenant_{tenant_id}"
-        collection = service.kvstore[collection_name]
+        collection = self.get_kvstore_collection(
+            request_info, collection_name, app="trackme"
+        )
+        self.track_ack_expiry(request_info, tenant_id)
 
         # Component mapping
         component_mapping = {
@@ -258,49 +548,98 @@ class TrackMeHandlerAck_v2(trackme_rest_handler.RESTHandler):
             "splk-wlk": "wlk",
         }
 
-        # get the whole collection
-        try:
-            (
-                collection_records_list,
-                collection_records_keys,
-                collection_records_objects,
-                collection_records_objects_dict,
-                collection_records_keys_dict,
-            ) = get_all_ack_records_from_kvcollection(
-                collection_name, collection, object_category_value
+        # if action is show and object_list is * with pagination, return one page of records
+        if action == "show" and object_list == "*" and pagination is not None:
+            try:
+                with self.timed("kv_query"):
+                    records, next_cursor = query_page(
+                        collection,
+                        {"object_category": object_category_value},
+                        pagination,
+                    )
+
+            except Exception as e:
+                error_msg = self.log_error(
+                    'tenant_id="%s", failed to retrieve KVstore collection records of collection="%s", exception="%s"',
+                    tenant_id,
+                    collection_name,
+                    e,
+                )
+                return {
+                    "payload": {"action": "failure", "result": error_msg},
+                    "status": 500,
+                }
+
+            return self.render_json(
+                {
+                    "process_count": len(records),
+                    "records": records,
+                    "next_cursor": next_cursor,
+                }
             )
 
-        except Exception as e:
-            error_msg = f'tenant_id="{tenant_id}", failed to retrieve KVstore collection records using function get_all_records_from_kvcollection, exception="{str(e)}"'
-            logging.error(error_msg)
-            return {
-                "payload": {"action": "failure", "result": error_msg},
-                "status": 500,
-            }
+        # enable and disable upsert the records by their derived _key
+        if action in ("enable", "disable"):
+            try:
+                self.migrate_ack_keys(request_info, tenant_id, collection)
+
+            except Exception as e:
+                error_msg = self.log_error(
+                    'tenant_id="%s", failed to migrate the keys of KVstore collection="%s", exception="%s"',
+                    tenant_id,
+                    collection_name,
+                    e,
+                )
+                return {
+                    "payload": {"action": "failure", "result": error_msg},
+                    "status": 500,
+                }
+
+        # get the ack records of the category for show, synchronized with the
+        # collection
+        if action == "show":
+            try:
+                with self.timed("kv_query"):
+                    ack_records = self.read_ack_records(
+                        tenant_id,
+                        object_category_value,
+                        collection,
+                        object_value_list if object_list != "*" else None,
+                    )
+
+            except Exception as e:
+                error_msg = self.log_error(
+                    'tenant_id="%s", failed to retrieve KVstore collection records of collection="%s", exception="%s"',
+                    tenant_id,
+                    collection_name,
+                    e,
+                )
+                return {
+                    "payload": {"action": "failure", "result": error_msg},
+                    "status": 500,
+                }
 
         # if action is show and object_list is *, return all records
         if action == "show" and object_list == "*":
-            return {
-                "payload": {
-                    "process_count": len(collection_records_list),
-                    "records": collection_records_list,
-                },
-                "status": 200,
-            }
+            records = ack_records.records()
+            return self.render_json(
+                {
+                    "process_count": len(records),
+                    "records": records,
+                }
+            )
 
         else:
             # action show
             if action == "show":
                 for object_value in object_value_list:
-                    if object_value in collection_records_objects:
+                    if object_value in ack_records:
                         # increment counter
                         processed_count += 1
                         succcess_count += 1
                         failures_count += 0
 
-                        records_summary.append(
-                            collection_records_objects_dict[object_value]
-                        )
+                        records_summary.append(ack_records.get_by_object(object_value))
 
                     else:
                         # increment counter
@@ -326,6 +665,38 @@ class TrackMeHandlerAck_v2(trackme_rest_handler.RESTHandler):
                     ack_expiration = 0
                     ack_type = "N/A"
 
+                # the chunks of KV store calls run concurrently, bounded per tenant
+                map_concurrent = functools.partial(
+                    self.map_concurrent, tenant_id=tenant_id
+                )
+
+                # if action is enable, and anomaly_reason is not set, retrieve the actual anomaly_reason of all entities from the data KV
+                data_kvrecords = {}
+                if action == "enable" and anomaly_reason == "N/A":
+                    collection_data_name = f"kv_trackme_{component_mapping.get(object_category_value, None)}_tenant_{tenant_id}"
+                    try:
+                        collection_data = self.get_kvstore_collection(
+                            request_info, collection_data_name, app="trackme"
+                        )
+                        with self.timed("kv_query"):
+                            data_kvrecords = query_records_by_object(
+                                collection_data,
+                                object_value_list,
+                                fields=("object", "anomaly_reason"),
+                                map_function=map_concurrent,
+                            )
+
+                    except Exception as e:
+                        error_msg = self.log_error(
+                            'tenant_id="%s", while attempting to retrieve the anomaly_reason in the data KVstore %s an exception was encountered, exception="%s"',
+                            tenant_id,
+                            collection_data_name,
+                            e,
+                        )
+
+                ack_records_list = []
+                documents = []
+
                 for object_value in object_value_list:
 
                     ack_record = {
@@ -340,34 +711,45 @@ class TrackMeHandlerAck_v2(trackme_rest_handler.RESTHandler):
                         "ack_comment": ack_comment,
                     }
 
-                    # only for enable, on a per object and if anomaly_reason is not set
-                    if action == "enable":
-                        # if action is enable, and anomaly_reason is not set, attempt to connect to the data KV and retrieve the actual anomaly_reason
-                        if anomaly_reason == "N/A":
-
-                            try:
-                                collection_data_name = f"kv_trackme_{component_mapping.get(object_category_value, None)}_tenant_{tenant_id}"
-                                collection_data = service.kvstore[collection_data_name]
-                                data_kvrecord = collection_data.data.query(
-                                    query=json.dumps({"object": object_value})
-                                )[0]
-                                ack_record["anomaly_reason"] = data_kvrecord.get(
-                                    "anomaly_reason", "N/A"
-                                )
-
-                            except Exception as e:
-                                error_msg = f'tenant_id="{tenant_id}", while attempting to retrieve the anomaly_reason in the data KVstore {collection_data_name} an exception was encountered, exception="{str(e)}"'
-                                logging.error(error_msg)
-
-                    try:
-                        if object_value in collection_records_objects:
-                            # Update the record
-                            collection.data.update(
-                                collection_records_objects_dict[object_value]["_key"],
-                                json.dumps(ack_record),
+                    # only for enable, if anomaly_reason is not set use the actual anomaly_reason of the entity
+                    if action == "enable" and anomaly_reason == "N/A":
+                        data_kvrecord = data_kvrecords.get(object_value)
+                        if data_kvrecord is not None:
+                            ack_record["anomaly_reason"] = data_kvrecord.get(
+                                "anomaly_reason", "N/A"
                             )
-                        else:
-                            collection.data.insert(json.dumps(ack_record))
+
+                    ack_records_list.append(ack_record)
+
+                    # the record of the object is upserted by its derived _key
+                    documents.append(
+                        dict(
+                            ack_record,
+                            _key=ack_record_key(object_category_value, object_value),
+                        )
+                    )
+
+                # save the records in chunks through the batch_save endpoint
+                batch_size = self.get_kvstore_batch_size(request_info, app="trackme")
+                with self.timed("kv_write"):
+                    saved_keys = batch_save_records(
+                        collection, documents, batch_size, map_concurrent
+                    )
+
+                # coalesced reads of the category must not serve the previous records
+                self.single_flight.invalidate((tenant_id, object_category_value))
+
+                for object_value, ack_record, saved_key in zip(
+                    object_value_list, ack_records_list, saved_keys
+                ):
+                    if not isinstance(saved_key, Exception):
+                        # write-through to the ack records cache
+                        self.ack_cache.upsert(
+                            tenant_id,
+                            object_category_value,
+                            dict(ack_record, _key=saved_key),
+                        )
+                        self.ack_expiry.schedule(tenant_id, ack_record)
 
                         # increment counter
                         processed_count += 1
@@ -388,8 +770,8 @@ class TrackMeHandlerAck_v2(trackme_rest_handler.RESTHandler):
                         elif action == "disable":
                             audit_msg = "The Ack was disabled successfully"
 
-                        # audit
-                        trackme_audit_event(
+                        # audit, written in the background
+                        self.audit(
                             request_info.system_authtoken,
                             request_info.server_rest_uri,
                             tenant_id,
@@ -403,7 +785,9 @@ class TrackMeHandlerAck_v2(trackme_rest_handler.RESTHandler):
                             str(update_comment),
                         )
 
-                    except Exception as e:
+                    else:
+                        e = saved_key
+
                         # increment counter
                         processed_count += 1
                         succcess_count += 0
@@ -427,8 +811,8 @@ class TrackMeHandlerAck_v2(trackme_rest_handler.RESTHandler):
                                 f"The Ack could not be disabled, exception={str(e)}"
                             )
 
-                        # audit
-                        trackme_audit_event(
+                        # audit, written in the background
+                        self.audit(
                             request_info.system_authtoken,
                             request_info.server_rest_uri,
                             tenant_id,
@@ -455,7 +839,7 @@ class TrackMeHandlerAck_v2(trackme_rest_handler.RESTHandler):
             else:
                 http_status = 500
 
-            return {"payload": req_summary, "status": http_status}
+            return self.render_json(req_summary, http_status)
 
     def post_get_ack_for_object(self, request_info, **kwargs):
 
@@ -463,10 +847,7 @@ class TrackMeHandlerAck_v2(trackme_rest_handler.RESTHandler):
         tenant_id = None
 
         # Retrieve from data
-        try:
-            resp_dict = json.loads(str(request_info.raw_args["payload"]))
-        except Exception as e:
-            resp_dict = None
+        resp_dict = request_info.json_body
 
         if resp_dict is not None:
             try:
@@ -479,8 +860,9 @@ class TrackMeHandlerAck_v2(trackme_rest_handler.RESTHandler):
                 # tenant_id is required
                 tenant_id = resp_dict.get("tenant_id", None)
                 if tenant_id is None:
-                    error_msg = f'tenant_id="{tenant_id}", tenant_id is required'
-                    logging.error(error_msg)
+                    error_msg = self.log_error(
+                        'tenant_id="%s", tenant_id is required', tenant_id
+                    )
                     return {
                         "payload": {"action": "failure", "result": error_msg},
                         "status": 500,
@@ -500,6 +882,22 @@ class TrackMeHandlerAck_v2(trackme_rest_handler.RESTHandler):
                 # object_category
                 object_category_value = resp_dict["object_category"]
 
+                # pagination is optional, used if object_list is * and limit or cursor is set
+                # derived_fields is optional, all derived fields are added if not set
+                try:
+                    pagination = z_rest_handler.Pagination.from_params(
+                        resp_dict, default_sort="_key"
+                    )
+                    derived_fields = parse_derived_fields(
+                        resp_dict.get("derived_fields")
+                    )
+                except ValueError as e:
+                    error_msg = self.log_error('tenant_id="%s", %s', tenant_id, e)
+                    return {
+                        "payload": {"action": "failure", "result": error_msg},
+                        "status": 500,
+                    }
+
         else:
             # body is required in this endpoint, if not submitted describe the usage
             describe = True
@@ -514,134 +912,457 @@ class TrackMeHandlerAck_v2(trackme_rest_handler.RESTHandler):
                         "tenant_id": "The tenant identifier",
                         "object_category": "the object category (splk-dsm, splk-dhm, splk-mhm, splk-cim, splk-flx, splk-wlk)",
                         "object_list": "List of entities, in a comma separated format. Use * to retrieve all objects, defaults to * if not specified",
+                        "limit": "OPTIONAL: if object_list=*, the maximum number of records per page, the response contains the records and next_cursor to retrieve the next page",
+                        "cursor": "OPTIONAL: if object_list=*, the next_cursor of the previous page",
+                        "sort": "OPTIONAL: if object_list=*, the KVstore sort of the pages, defaults to _key",
+                        "fields": "OPTIONAL: if object_list=*, comma separated list of fields to be returned",
+                        "derived_fields": "OPTIONAL: comma separated list of the fields to be added to the records, valid options are ack_mtime_datetime, ack_expiration_datetime and ack_is_enabled, defaults to all of them",
                     }
                 ],
             }
             return {"payload": response, "status": 200}
 
-        # Get splunkd port
-        splunkd_port = request_info.server_rest_port
+        # identical concurrent reads of a user share one read, its response is reused
+        # shortly, reads of other users run with their own session and its ACLs
+        flight_key = (
+            request_info.user,
+            tenant_id,
+            object_category_value,
+            object_list,
+            pagination.key() if pagination is not None else None,
+            derived_fields,
+        )
 
-        # Get service
-        service = client.connect(
-            owner="nobody",
-            app="trackme",
-            port=splunkd_port,
-            token=request_info.session_key,
-            timeout=300,
+        return self.single_flight.do(
+            flight_key,
+            functools.partial(
+                self.read_ack_for_object,
+                request_info,
+                tenant_id,
+                object_category_value,
+                object_list,
+                object_value_list,
+                pagination,
+                derived_fields,
+            ),
+            group=(tenant_id, object_category_value),
+            cacheable=lambda response: response.get("status") == 200,
         )
 
-        # set loglevel
-        loglevel = trackme_getloglevel(
-            request_info.system_authtoken, request_info.server_rest_port
+    def read_ack_for_object(
+        self,
+        request_info,
+        tenant_id,
+        object_category_value,
+        object_list,
+        object_value_list,
+        pagination,
+        derived_fields=None,
+    ):
+        collection_name = f"kv_trackme_common_alerts_ack_tenant_{tenant_id}"
+        collection = self.get_kvstore_collection(
+            request_info, collection_name, app="trackme"
+        )
+        self.track_ack_expiry(request_info, tenant_id)
+
+        # with pagination, retrieve one page of records of the category
+        if object_list == "*" and pagination is not None:
+            try:
+                with self.timed("kv_query"):
+                    records, next_cursor = query_page(
+                        collection,
+                        {"object_category": object_category_value},
+                        pagination,
+                    )
+
+            except Exception as e:
+                error_msg = self.log_error(
+                    'tenant_id="%s", failed to retrieve KVstore collection records of collection="%s", exception="%s"',
+                    tenant_id,
+                    collection_name,
+                    e,
+                )
+                return {
+                    "payload": {"action": "failure", "result": error_msg},
+                    "status": 500,
+                }
+
+        else:
+            # get the ack records of the category, synchronized with the collection
+            try:
+                with self.timed("kv_query"):
+                    ack_records = self.read_ack_records(
+                        tenant_id,
+                        object_category_value,
+                        collection,
+                        object_value_list if object_list != "*" else None,
+                    )
+
+            except Exception as e:
+                error_msg = self.log_error(
+                    'tenant_id="%s", failed to retrieve KVstore collection records of collection="%s", exception="%s"',
+                    tenant_id,
+                    collection_name,
+                    e,
+                )
+                return {
+                    "payload": {"action": "failure", "result": error_msg},
+                    "status": 500,
+                }
+
+            if object_list == "*":
+                records = ack_records.records()
+            else:
+                records = [
+                    ack_records.get_by_object(object_value)
+                    for object_value in object_value_list
+                    if object_value in ack_records
+                ]
+
+        # decorate copies of the records, the records are shared with the cache
+        filtered_records = decorate_ack_records(
+            records, convert_epoch_to_datetime_cached, derived_fields
         )
-        log.setLevel(logging.getLevelName(loglevel))
+
+        if pagination is not None and object_list == "*":
+            return self.render_json(
+                {
+                    "records": filtered_records,
+                    "next_cursor": next_cursor,
+                }
+            )
+
+        return self.render_json(filtered_records)
+
+    def post_ack_import(self, request_info, tenant_id=None, **kwargs):
+
+        # the records are the newline-delimited JSON payload, if not submitted describe the usage
+        payload = request_info.payload
+        if not payload or kwargs.get("describe") in ("true", "True"):
+            response = {
+                "describe": "This endpoint imports Ack records, it requires a POST call with the tenant_id as a query parameter and one JSON record per line as the payload:",
+                "resource_desc": "Import Ack records, records are identified by their object_category and object so the import can be repeated or resumed",
+                "resource_spl_example": "| trackme url=\"/services/trackme/v2/ack/ack_import?tenant_id=mytenant\" mode=\"post\" body=\"{'object_category': 'splk-dsm', 'object': 'netscreen:netscreen:firewall', 'ack_period': 86400}\"",
+                "options": [
+                    {
+                        "tenant_id": "The tenant identifier, as a query parameter",
+                        "object": "The entity, required in each record",
+                        "object_category": "the object category (splk-dsm, splk-dhm, splk-mhm, splk-cim, splk-flx, splk-wlk), required in each record",
+                        "ack_state": "OPTIONAL: active | inactive, defaults to active",
+                        "ack_expiration": "OPTIONAL: the expiration of an active Ack in epoch seconds",
+                        "ack_period": "OPTIONAL: if ack_expiration is not set, the period of an active Ack in seconds, defaults to 86400",
+                        "ack_type": "OPTIONAL: sticky | unsticky for active Acks, defaults to unsticky",
+                        "ack_source": "OPTIONAL: auto_ack | user_ack, defaults to user_ack",
+                        "ack_comment": "OPTIONAL: the comment of the Ack, defaults to API import",
+                        "anomaly_reason": "OPTIONAL: the reason for the anomaly, defaults to N/A",
+                        "ack_mtime": "OPTIONAL: the modification time in epoch seconds, defaults to now",
+                    }
+                ],
+            }
+            return {"payload": response, "status": 200}
+
+        # tenant_id is required
+        if tenant_id is None:
+            error_msg = self.log_error(
+                'tenant_id="%s", tenant_id is required', tenant_id
+            )
+            return {
+                "payload": {"action": "failure", "result": error_msg},
+                "status": 500,
+            }
 
         collection_name = f"kv_trackme_common_alerts_ack_tenant_{tenant_id}"
-        collection = service.kvstore[collection_name]
+        collection = self.get_kvstore_collection(
+            request_info, collection_name, app="trackme"
+        )
+        self.track_ack_expiry(request_info, tenant_id)
+        batch_size = self.get_kvstore_batch_size(request_info, app="trackme")
 
-        # get the whole collection
+        # the records are upserted by their derived _key
         try:
-            (
-                collection_records_list,
-                collection_records_keys,
-                collection_records_objects,
-                collection_records_objects_dict,
-                collection_records_keys_dict,
-            ) = get_all_ack_records_from_kvcollection(
-                collection_name, collection, object_category_value
-            )
+            self.migrate_ack_keys(request_info, tenant_id, collection)
 
         except Exception as e:
-            error_msg = f'tenant_id="{tenant_id}", failed to retrieve KVstore collection records using function get_all_records_from_kvcollection, exception="{str(e)}"'
-            logging.error(error_msg)
+            error_msg = self.log_error(
+                'tenant_id="%s", failed to migrate the keys of KVstore collection="%s", exception="%s"',
+                tenant_id,
+                collection_name,
+                e,
+            )
             return {
                 "payload": {"action": "failure", "result": error_msg},
                 "status": 500,
             }
 
-        # if action is show and object_list is *, return all records
-        filtered_records = []
+        # the records are imported in chunks of one batch_save call
+        now = time.time()
+        results = []
+        for chunk in z_rest_handler.iter_chunks(
+            z_rest_handler.iter_ndjson(payload, self.codec), batch_size
+        ):
+            results.extend(
+                self.import_ack_chunk(
+                    request_info, tenant_id, collection, batch_size, chunk, now
+                )
+            )
+
+        if results and all(result["result"] == "success" for result in results):
+            http_status = 200
+        else:
+            http_status = 500
+
+        return self.render_ndjson(results, http_status)
+
+    def import_ack_chunk(
+        self, request_info, tenant_id, collection, batch_size, chunk, now
+    ):
+        """
+        Import a chunk of (line number, record), returns the result of each line.
+        """
+
+        results = {}
+        ack_records_by_key = OrderedDict()
+        lines_by_key = {}
+
+        def failure(line_number, record, exception):
+            results[line_number] = {
+                "line": line_number,
+                "object": record.get("object") if isinstance(record, dict) else None,
+                "object_category": (
+                    record.get("object_category") if isinstance(record, dict) else None
+                ),
+                "result": "failure",
+                "exception": f'tenant_id="{tenant_id}", line={line_number} could not be imported, exception="{str(exception)}"',
+            }
 
-        if object_list == "*":
-            for record in collection_records_list:
-                # convert ack_mtime to ack_mtime_datetime
-                ack_mtime_datetime = convert_epoch_to_datetime(record.get("ack_mtime"))
-                record["ack_mtime_datetime"] = ack_mtime_datetime
+        for line_number, record in chunk:
+            if isinstance(record, Exception):
+                failure(line_number, None, record)
+                continue
+            try:
+                ack_record = normalize_ack_record(record, now)
+            except ValueError as e:
+                failure(line_number, record, e)
+                continue
+
+            # the last record of an object in the chunk wins
+            key = (ack_record["object_category"], ack_record["object"])
+            ack_records_by_key[key] = ack_record
+            lines_by_key.setdefault(key, []).append(line_number)
+
+        # the records are upserted by the _key derived from their object category and
+        # object, which makes the import idempotent
+        documents = [
+            dict(ack_record, _key=ack_record_key(*key))
+            for key, ack_record in ack_records_by_key.items()
+        ]
+        object_categories = {key[0] for key in ack_records_by_key}
+
+        with self.timed("kv_write"):
+            saved_keys = batch_save_records(
+                collection,
+                documents,
+                batch_size,
+                functools.partial(self.map_concurrent, tenant_id=tenant_id),
+            )
+
+        for object_category in object_categories:
+            self.single_flight.invalidate((tenant_id, object_category))
+
+        for document, saved_key in zip(documents, saved_keys):
+            key = (document["object_category"], document["object"])
+            ack_record = ack_records_by_key[key]
 
-                # convert ack_expiration to ack_expiration_datetime
-                ack_expiration_datetime = convert_epoch_to_datetime(
-                    record.get("ack_expiration")
+            if isinstance(saved_key, Exception):
+                for line_number in lines_by_key[key]:
+                    failure(line_number, ack_record, saved_key)
+                status = "failure"
+                audit_msg = f"The Ack could not be imported, exception={str(saved_key)}"
+            else:
+                # write-through to the ack records cache
+                self.ack_cache.upsert(
+                    tenant_id, key[0], dict(ack_record, _key=saved_key)
                 )
-                record["ack_expiration_datetime"] = ack_expiration_datetime
+                self.ack_expiry.schedule(tenant_id, ack_record)
+                for line_number in lines_by_key[key]:
+                    results[line_number] = {
+                        "line": line_number,
+                        "object": key[1],
+                        "object_category": key[0],
+                        "result": "success",
+                        "_key": saved_key,
+                    }
+                status = "success"
+                audit_msg = "The Ack was imported successfully"
+
+            # audit, written in the background
+            self.audit(
+                request_info.system_authtoken,
+                request_info.server_rest_uri,
+                tenant_id,
+                request_info.user,
+                status,
+                "import ack",
+                str(key[1]),
+                str(key[0]),
+                ack_record,
+                audit_msg,
+                "API import",
+            )
 
-                # create a new field called ack_is_enabled which is a boolean 0/1 depending on if the ack_state is active or inactive
-                if record.get("ack_state") == "active":
-                    record["ack_is_enabled"] = 1
-                else:
-                    record["ack_is_enabled"] = 0
+        return [results[line_number] for line_number in sorted(results)]
 
-                # field anomaly_reason is optional, if not set, will be defined to N/A, if set it is a comma seperated string to be turned into a list
-                anomaly_reason = record.get("anomaly_reason", None)
-                if not anomaly_reason:
-                    record["anomaly_reason"] = "N/A"
-                else:
-                    if not isinstance(anomaly_reason, list):
-                        record["anomaly_reason"] = anomaly_reason.split(",")
+    def get_ack_export(
+        self, request_info, tenant_id=None, object_category=None, **kwargs
+    ):
 
-                # field ack_source is optional, if not set, will be defined to user_ack
-                ack_source = record.get("ack_source", "user_ack")
-                record["ack_source"] = ack_source
+        # tenant_id is required, if not submitted describe the usage
+        if tenant_id is None or kwargs.get("describe") in ("true", "True"):
+            response = {
+                "describe": "This endpoint exports Ack records as one JSON record per line, it requires a GET call with the following query parameters:",
+                "resource_desc": "Export Ack records, the records can be imported with ack_import",
+                "resource_spl_example": '| trackme url="/services/trackme/v2/ack/ack_export?tenant_id=mytenant&object_category=splk-dsm" mode="get"',
+                "options": [
+                    {
+                        "tenant_id": "The tenant identifier",
+                        "object_category": "OPTIONAL: the object category (splk-dsm, splk-dhm, splk-mhm, splk-cim, splk-flx, splk-wlk), all categories are exported if not set",
+                        "limit": "OPTIONAL: the maximum number of records per page, the X-Next-Cursor response header contains the cursor of the next page",
+                        "cursor": "OPTIONAL: the X-Next-Cursor of the previous page",
+                        "sort": "OPTIONAL: the KVstore sort of the pages, defaults to _key",
+                        "fields": "OPTIONAL: comma separated list of fields to be returned",
+                    }
+                ],
+            }
+            return {"payload": response, "status": 200}
+
+        # pagination is optional, all records are exported if limit and cursor are not set
+        try:
+            pagination = z_rest_handler.Pagination.from_params(
+                kwargs, default_sort="_key"
+            )
+        except ValueError as e:
+            error_msg = self.log_error('tenant_id="%s", %s', tenant_id, e)
+            return {
+                "payload": {"action": "failure", "result": error_msg},
+                "status": 500,
+            }
 
-                filtered_records.append(record)
+        collection_name = f"kv_trackme_common_alerts_ack_tenant_{tenant_id}"
+        collection = self.get_kvstore_collection(
+            request_info, collection_name, app="trackme"
+        )
+        self.track_ack_expiry(request_info, tenant_id)
+
+        if object_category is not None:
+            query = {"object_category": object_category}
+        else:
+            query = {"_key": {"$ne": ACK_KEYS_MIGRATED_KEY}}
+
+        # the fields projection is applied by the KV store, with or without pagination
+        fields = [
+            field.strip()
+            for field in str(kwargs.get("fields", "")).split(",")
+            if field.strip()
+        ]
+
+        try:
+            with self.timed("kv_query"):
+                if pagination is not None:
+                    records, next_cursor = query_page(collection, query, pagination)
+                else:
+                    records = query_all_records(collection, query, fields=fields)
+                    next_cursor = None
 
+        except Exception as e:
+            error_msg = self.log_error(
+                'tenant_id="%s", failed to retrieve KVstore collection records of collection="%s", exception="%s"',
+                tenant_id,
+                collection_name,
+                e,
+            )
             return {
-                "payload": filtered_records,
-                "status": 200,
+                "payload": {"action": "failure", "result": error_msg},
+                "status": 500,
             }
 
+        if next_cursor is not None:
+            headers = {"X-Next-Cursor": next_cursor}
         else:
-            filtered_records = []
-            for object_value in object_value_list:
-                if object_value in collection_records_objects:
-                    record = collection_records_objects_dict[object_value]
-
-                    # convert ack_mtime to ack_mtime_datetime
-                    ack_mtime_datetime = convert_epoch_to_datetime(
-                        record.get("ack_mtime")
-                    )
-                    record["ack_mtime_datetime"] = ack_mtime_datetime
+            headers = None
 
-                    # convert ack_expiration to ack_expiration_datetime
-                    if record.get("ack_expiration") != 0:
-                        ack_expiration_datetime = convert_epoch_to_datetime(
-                            record.get("ack_expiration")
-                        )
-                    else:
-                        ack_expiration_datetime = "N/A"
-                    record["ack_expiration_datetime"] = ack_expiration_datetime
+        return self.render_ndjson(records, 200, headers)
 
-                    # create a new field called ack_is_enabled which is a boolean 0/1 depending on if the ack_state is active or inactive
-                    if record.get("ack_state") == "active":
-                        record["ack_is_enabled"] = 1
-                    else:
-                        record["ack_is_enabled"] = 0
+    def post_ack_migrate_keys(self, request_info, tenant_id=None, **kwargs):
 
-                    # field anomaly_reason is optional, if not set, will be defined to N/A, if set it is a comma seperated string to be turned into a list
-                    anomaly_reason = record.get("anomaly_reason", None)
-                    if not anomaly_reason:
-                        record["anomaly_reason"] = "N/A"
-                    else:
-                        if not isinstance(anomaly_reason, list):
-                            record["anomaly_reason"] = anomaly_reason.split(",")
+        # tenant_id is required, if not submitted describe the usage
+        if tenant_id is None or kwargs.get("describe") in ("true", "True"):
+            response = {
+                "describe": "This endpoint migrates the Ack records of a tenant to the keys derived from their object_category and object, it requires a POST call with the following query parameters:",
+                "resource_desc": "Migrate the keys of the Ack records, the most recent record of each entity is kept, the migration can be run again",
+                "resource_spl_example": '| trackme url="/services/trackme/v2/ack/ack_migrate_keys?tenant_id=mytenant" mode="post"',
+                "options": [
+                    {
+                        "tenant_id": "The tenant identifier",
+                    }
+                ],
+            }
+            return {"payload": response, "status": 200}
 
-                    # field ack_source is optional, if not set, will be defined to user_ack
-                    ack_source = record.get("ack_source", "user_ack")
-                    record["ack_source"] = ack_source
+        collection_name = f"kv_trackme_common_alerts_ack_tenant_{tenant_id}"
+        collection = self.get_kvstore_collection(
+            request_info, collection_name, app="trackme"
+        )
+        batch_size = self.get_kvstore_batch_size(request_info, app="trackme")
 
-                    filtered_records.append(record)
+        try:
+            with self.timed("kv_write"):
+                summary = rekey_ack_records(
+                    collection,
+                    batch_size,
+                    map_function=functools.partial(
+                        self.map_concurrent, tenant_id=tenant_id
+                    ),
+                )
+                if not summary["failures"]:
+                    mark_ack_keys_migrated(collection)
 
+        except Exception as e:
+            error_msg = self.log_error(
+                'tenant_id="%s", failed to migrate the keys of KVstore collection="%s", exception="%s"',
+                tenant_id,
+                collection_name,
+                e,
+            )
             return {
-                "payload": filtered_records,
-                "status": 200,
+                "payload": {"action": "failure", "result": error_msg},
+                "status": 500,
             }
+
+        # the cached and coalesced records of the tenant refer to the previous keys
+        self.ack_cache.invalidate(tenant_id)
+        self.single_flight.invalidate()
+
+        if summary["failures"]:
+            status = "failure"
+            http_status = 500
+        else:
+            status = "success"
+            http_status = 200
+            self.ack_keys_migrated.add(tenant_id)
+
+        # audit, written in the background
+        self.audit(
+            request_info.system_authtoken,
+            request_info.server_rest_uri,
+            tenant_id,
+            request_info.user,
+            status,
+            "migrate ack keys",
+            "all",
+            "all",
+            summary,
+            "The keys of the Ack records were migrated",
+            "N/A",
+        )
+
+        return self.render_json(summary, http_status)
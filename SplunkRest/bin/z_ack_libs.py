@@ -0,0 +1,1055 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import hashlib
+import heapq
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from z_kvstore_repository import (
+    KV_PAGE_SIZE,
+    batch_save_records,
+    chunk_list,
+    query_all_records,
+)
+
+# number of objects per $or query, the query is passed in the URL of the request
+OBJECT_QUERY_CHUNK_SIZE = 100
+
+# fields added to the ack records returned by the API
+ACK_DERIVED_FIELDS = ("ack_mtime_datetime", "ack_expiration_datetime", "ack_is_enabled")
+
+# lists of objects up to this size are queried by object instead of loading the
+# category, this takes one query like the incremental refresh of a loaded category
+PUSHDOWN_MAX_OBJECTS = OBJECT_QUERY_CHUNK_SIZE
+
+# the _key of the record that marks a collection whose records have their derived
+# _key, it has no object_category so the queries of the ack records skip it
+ACK_KEYS_MIGRATED_KEY = "ack_keys_migrated"
+
+
+def to_epoch(value, default=0.0):
+    """
+    Convert an epoch value of a KV record to a float.
+
+    >>> to_epoch("1700000000.5")
+    1700000000.5
+    >>> to_epoch(None)
+    0.0
+    """
+
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def ack_record_key(object_category, object_value):
+    """
+    Get the _key of the ack record of an object, derived from the object category and
+    the object so that writes can upsert the record without reading it first.
+
+    >>> ack_record_key("splk-dsm", "netscreen:netscreen:firewall")
+    '53a01be548ac4cecf8cad7f7cc420367d2a63acf'
+    """
+
+    key_source = json.dumps([object_category, object_value], ensure_ascii=False)
+    return hashlib.sha1(key_source.encode("utf-8")).hexdigest()
+
+
+class AckKeyMigrationError(Exception):
+    """
+    The records of an ack collection could not all be migrated to their derived _key.
+    """
+
+
+def ack_keys_migrated(collection):
+    """
+    Tell whether the records of an ack collection were migrated to their derived _key.
+    """
+
+    return bool(
+        collection.data.query(
+            query=json.dumps({"_key": ACK_KEYS_MIGRATED_KEY}), fields="_key"
+        )
+    )
+
+
+def mark_ack_keys_migrated(collection):
+    """
+    Mark the records of an ack collection as migrated to their derived _key.
+    """
+
+    collection.data.batch_save(
+        {"_key": ACK_KEYS_MIGRATED_KEY, "ack_keys_migrated": time.time()}
+    )
+
+
+def parse_derived_fields(value):
+    """
+    Parse the comma separated derived fields of a request, None if not set.
+    Raises ValueError for unknown fields.
+
+    >>> parse_derived_fields("ack_is_enabled, ack_mtime_datetime")
+    ('ack_mtime_datetime', 'ack_is_enabled')
+    >>> parse_derived_fields("")
+    ()
+    """
+
+    if value is None:
+        return None
+
+    fields = [field.strip() for field in str(value).split(",") if field.strip()]
+    unknown = [field for field in fields if field not in ACK_DERIVED_FIELDS]
+    if unknown:
+        raise ValueError(
+            "derived_fields=%s is incorrect, valid options are %s"
+            % (",".join(unknown), " | ".join(ACK_DERIVED_FIELDS))
+        )
+
+    return tuple(field for field in ACK_DERIVED_FIELDS if field in fields)
+
+
+def normalize_ack_record(record, now, ack_comment="API import"):
+    """
+    Make the ack record of an imported record, raises ValueError if it is invalid.
+
+    object and object_category are required. ack_state defaults to active, the
+    ack_expiration of an active ack defaults to now plus ack_period (one day by
+    default), an inactive ack has no expiration and no type. ack_mtime defaults to now
+    so an exported record keeps its mtime when it is imported again.
+
+    >>> normalize_ack_record({"object": "a", "object_category": "splk-dsm"}, 100.0)
+    ... # doctest: +NORMALIZE_WHITESPACE
+    {'object': 'a', 'object_category': 'splk-dsm', 'anomaly_reason': 'N/A',
+     'ack_source': 'user_ack', 'ack_expiration': 86500.0, 'ack_state': 'active',
+     'ack_mtime': 100.0, 'ack_type': 'unsticky', 'ack_comment': 'API import'}
+    """
+
+    object_value = record.get("object")
+    object_category = record.get("object_category")
+    if not object_value or not isinstance(object_value, str):
+        raise ValueError("object is required")
+    if not object_category or not isinstance(object_category, str):
+        raise ValueError("object_category is required")
+
+    ack_state = record.get("ack_state", "active")
+    if ack_state not in ("active", "inactive"):
+        raise ValueError(
+            f'ack_state="{ack_state}" is incorrect, valid options are active | inactive'
+        )
+
+    ack_source = record.get("ack_source", "user_ack")
+    if ack_source not in ("auto_ack", "user_ack"):
+        raise ValueError(
+            f'ack_source="{ack_source}" is incorrect, valid options are auto_ack | user_ack'
+        )
+
+    if ack_state == "active":
+        ack_type = record.get("ack_type", "unsticky")
+        if ack_type not in ("sticky", "unsticky"):
+            raise ValueError(
+                f'ack_type="{ack_type}" is incorrect, valid options are sticky | unsticky'
+            )
+        if record.get("ack_expiration") is not None:
+            ack_expiration = to_epoch(record["ack_expiration"], None)
+        else:
+            ack_expiration = now + to_epoch(record.get("ack_period", 86400), None)
+        if ack_expiration is None:
+            raise ValueError("ack_expiration and ack_period must be epoch seconds")
+    else:
+        ack_type = "N/A"
+        ack_expiration = 0
+
+    ack_mtime = to_epoch(record.get("ack_mtime", now), None)
+    if ack_mtime is None:
+        raise ValueError("ack_mtime must be epoch seconds")
+
+    anomaly_reason = record.get("anomaly_reason") or "N/A"
+    if isinstance(anomaly_reason, list):
+        anomaly_reason = ",".join(str(reason) for reason in anomaly_reason)
+
+    return {
+        "object": object_value,
+        "object_category": object_category,
+        "anomaly_reason": anomaly_reason,
+        "ack_source": ack_source,
+        "ack_expiration": ack_expiration,
+        "ack_state": ack_state,
+        "ack_mtime": ack_mtime,
+        "ack_type": ack_type,
+        "ack_comment": record.get("ack_comment") or ack_comment,
+    }
+
+
+def decorate_ack_records(records, convert_epoch, derived_fields=None):
+    """
+    Decorate copies of ack records for the API responses, the records are not modified.
+
+    anomaly_reason is turned into a list ("N/A" if not set), ack_source defaults to
+    user_ack. The derived fields (all of ACK_DERIVED_FIELDS if None) are added:
+    ack_mtime_datetime and ack_expiration_datetime are converted by convert_epoch,
+    once per distinct epoch, an ack_expiration of 0 is "N/A". ack_is_enabled is 1 if
+    ack_state is active, 0 otherwise.
+    """
+
+    if derived_fields is None:
+        derived_fields = ACK_DERIVED_FIELDS
+    add_mtime = "ack_mtime_datetime" in derived_fields
+    add_expiration = "ack_expiration_datetime" in derived_fields
+    add_enabled = "ack_is_enabled" in derived_fields
+
+    converted = {}
+
+    def convert(value):
+        try:
+            return converted[value]
+        except KeyError:
+            result = converted[value] = convert_epoch(value)
+            return result
+        except TypeError:
+            # unhashable value
+            return convert_epoch(value)
+
+    decorated = []
+
+    for record in records:
+        record = dict(record)
+
+        if add_mtime:
+            record["ack_mtime_datetime"] = convert(record.get("ack_mtime"))
+
+        if add_expiration:
+            ack_expiration = record.get("ack_expiration")
+            if to_epoch(ack_expiration, None) == 0:
+                record["ack_expiration_datetime"] = "N/A"
+            else:
+                record["ack_expiration_datetime"] = convert(ack_expiration)
+
+        if add_enabled:
+            record["ack_is_enabled"] = 1 if record.get("ack_state") == "active" else 0
+
+        anomaly_reason = record.get("anomaly_reason")
+        if not anomaly_reason:
+            record["anomaly_reason"] = "N/A"
+        elif not isinstance(anomaly_reason, list):
+            record["anomaly_reason"] = anomaly_reason.split(",")
+
+        if "ack_source" not in record:
+            record["ack_source"] = "user_ack"
+
+        decorated.append(record)
+
+    return decorated
+
+
+def object_queries(objects, object_category=None, chunk_size=OBJECT_QUERY_CHUNK_SIZE):
+    """
+    Make the KV store queries of a list of objects, one $or query per chunk of objects,
+    restricted to the object category if set.
+
+    >>> object_queries(["a", "b", "c"], chunk_size=2)
+    [{'$or': [{'object': 'a'}, {'object': 'b'}]}, {'$or': [{'object': 'c'}]}]
+    >>> object_queries(["a"], "splk-dsm")
+    [{'$and': [{'object_category': 'splk-dsm'}, {'$or': [{'object': 'a'}]}]}]
+    """
+
+    objects = list(dict.fromkeys(objects))
+    queries = []
+
+    for start in range(0, len(objects), chunk_size):
+        chunk = objects[start : start + chunk_size]
+        query = {"$or": [{"object": object_value} for object_value in chunk]}
+        if object_category is not None:
+            query = {"$and": [{"object_category": object_category}, query]}
+        queries.append(query)
+
+    return queries
+
+
+def query_records_by_object(
+    collection,
+    objects,
+    fields=None,
+    chunk_size=OBJECT_QUERY_CHUNK_SIZE,
+    map_function=map,
+):
+    """
+    Retrieve the records of a list of objects with one $or query per chunk of objects.
+
+    The chunks are queried with map_function(function, chunks), e.g. the map_concurrent
+    of the handler to run the queries concurrently.
+
+    Returns a dict of the records by object, the first record is kept if an object has
+    several records.
+    """
+
+    def query_chunk(query):
+        return query_all_records(collection, query, fields=fields)
+
+    records_by_object = {}
+    for records in map_function(query_chunk, object_queries(objects, None, chunk_size)):
+        for record in records:
+            records_by_object.setdefault(record.get("object"), record)
+
+    return records_by_object
+
+
+def query_ack_records(
+    collection,
+    object_category,
+    objects,
+    fields=None,
+    chunk_size=OBJECT_QUERY_CHUNK_SIZE,
+    map_function=map,
+):
+    """
+    Retrieve the ack records of a list of objects of the category, the filters are
+    applied by the KV store so only the records of the objects are transferred.
+
+    Returns an AckCollectionIndex of the records, fields must include _key, object and
+    ack_mtime if set.
+    """
+
+    def query_chunk(query):
+        return query_all_records(collection, query, fields=fields)
+
+    index = AckCollectionIndex()
+    queries = object_queries(objects, object_category, chunk_size)
+    for records in map_function(query_chunk, queries):
+        for record in records:
+            index.upsert(record)
+
+    return index
+
+
+def rekey_ack_records(
+    collection, batch_size, chunk_size=OBJECT_QUERY_CHUNK_SIZE, map_function=map
+):
+    """
+    Migrate the ack records of a collection to the keys of ack_record_key.
+
+    The _key of all records is read first, then the objects to migrate are processed
+    in batches: their records are read again, the most recent record of each object
+    (by ack_mtime) is saved under the derived _key and the other records of the object
+    are deleted once it is saved. Objects that only have their derived _key are left as
+    they are, so the migration can be run again.
+
+    Returns the counters of the migration and the failures.
+    """
+
+    summary = {"records": 0, "objects": 0, "rekeyed": 0, "deleted": 0, "failures": []}
+
+    keys_by_object = OrderedDict()
+    for record in query_all_records(
+        collection, fields=("_key", "object_category", "object")
+    ):
+        if record["_key"] == ACK_KEYS_MIGRATED_KEY:
+            continue
+        object_key = (record.get("object_category"), record.get("object"))
+        keys_by_object.setdefault(object_key, []).append(record["_key"])
+        summary["records"] += 1
+    summary["objects"] = len(keys_by_object)
+
+    # the objects whose records do not have the derived _key, or have duplicates
+    objects = []
+    for object_key, keys in keys_by_object.items():
+        key = ack_record_key(*object_key)
+        if keys != [key]:
+            objects.append((key, keys))
+
+    def query_chunk(keys):
+        return query_all_records(collection, {"$or": [{"_key": k} for k in keys]})
+
+    def delete_chunk(keys):
+        try:
+            collection.data.delete(json.dumps({"$or": [{"_key": k} for k in keys]}))
+        except Exception as e:
+            return e
+        return len(keys)
+
+    for start in range(0, len(objects), batch_size):
+        batch = objects[start : start + batch_size]
+
+        # read the current records of the batch, they may have changed since
+        records_by_key = {}
+        keys = [k for _, object_keys in batch for k in object_keys]
+        for records in map_function(query_chunk, chunk_list(keys, chunk_size)):
+            for record in records:
+                records_by_key[record["_key"]] = record
+
+        documents = []
+        obsolete_keys = {}
+        keys_to_delete = []
+        for key, object_keys in batch:
+            records = [records_by_key[k] for k in object_keys if k in records_by_key]
+            if not records:
+                continue
+
+            latest = max(records, key=lambda record: to_epoch(record.get("ack_mtime")))
+            previous_keys = [r["_key"] for r in records if r["_key"] != key]
+            if latest["_key"] == key:
+                keys_to_delete.extend(previous_keys)
+                continue
+
+            documents.append(
+                {
+                    field: value
+                    for field, value in latest.items()
+                    if not field.startswith("_")
+                }
+            )
+            documents[-1]["_key"] = key
+            obsolete_keys[key] = previous_keys
+
+        # the previous records of an object are only deleted once its record is saved
+        saved_keys = batch_save_records(collection, documents, batch_size, map_function)
+        for document, saved_key in zip(documents, saved_keys):
+            if isinstance(saved_key, Exception):
+                summary["failures"].append(
+                    f'object="{document.get("object")}", exception="{str(saved_key)}"'
+                )
+                continue
+            summary["rekeyed"] += 1
+            keys_to_delete.extend(obsolete_keys[document["_key"]])
+
+        for result in map_function(
+            delete_chunk, chunk_list(keys_to_delete, chunk_size)
+        ):
+            if isinstance(result, Exception):
+                summary["failures"].append(f'exception="{str(result)}"')
+            else:
+                summary["deleted"] += result
+
+    return summary
+
+
+class AckCollectionIndex(object):
+    """
+    The ack records of one tenant and object category, indexed by object and by _key.
+
+    Records are shared with the cache and must not be modified by the caller.
+    """
+
+    __slots__ = (
+        "records_by_key",
+        "keys_by_object",
+        "last_mtime",
+        "last_refresh",
+        "last_full_sync",
+        "lock",
+    )
+
+    def __init__(self):
+        self.records_by_key = {}
+        self.keys_by_object = {}
+        self.last_mtime = 0.0
+        self.last_refresh = None
+        self.last_full_sync = None
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.records_by_key)
+
+    def __contains__(self, object_value):
+        return object_value in self.keys_by_object
+
+    def upsert(self, record):
+        """
+        Add or replace a record, an object keeps pointing to its most recent record.
+        """
+
+        key = record["_key"]
+        object_value = record.get("object")
+        mtime = to_epoch(record.get("ack_mtime"))
+
+        previous = self.records_by_key.get(key)
+        if previous is not None and previous.get("object") != object_value:
+            if self.keys_by_object.get(previous.get("object")) == key:
+                del self.keys_by_object[previous.get("object")]
+
+        self.records_by_key[key] = record
+
+        current_key = self.keys_by_object.get(object_value)
+        if current_key is None or current_key == key:
+            self.keys_by_object[object_value] = key
+        elif mtime >= to_epoch(self.records_by_key[current_key].get("ack_mtime")):
+            self.keys_by_object[object_value] = key
+
+        if mtime > self.last_mtime:
+            self.last_mtime = mtime
+
+    def get_by_object(self, object_value):
+        """
+        Get the record of an object, or None.
+        """
+
+        key = self.keys_by_object.get(object_value)
+        if key is None:
+            return None
+        return self.records_by_key[key]
+
+    def get_by_key(self, key):
+        """
+        Get a record by its _key, or None.
+        """
+
+        return self.records_by_key.get(key)
+
+    def records(self):
+        """
+        List the most recent record of each object.
+        """
+
+        return [self.records_by_key[key] for key in self.keys_by_object.values()]
+
+
+class AckRecordCache(object):
+    """
+    In-memory cache of the ack collections of the persistent process, one index per
+    tenant and object category.
+
+    The first read of a tenant and category loads the records of the category, the
+    following reads only query the records whose ack_mtime is newer than the last sync
+    (minus mtime_overlap seconds for records written concurrently). Records deleted by
+    others are only noticed by the full sync that runs every full_sync_interval seconds.
+    Writes of the handler are applied to the cache with upsert.
+
+    The cache holds at most max_records records, least recently used indexes are
+    evicted when the budget is exceeded.
+    """
+
+    def __init__(
+        self,
+        max_records=500000,
+        refresh_interval=0,
+        full_sync_interval=900,
+        mtime_overlap=5,
+        page_size=KV_PAGE_SIZE,
+    ):
+        self.max_records = max_records
+        self.refresh_interval = refresh_interval
+        self.full_sync_interval = full_sync_interval
+        self.mtime_overlap = mtime_overlap
+        self.page_size = page_size
+        self.indexes = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, tenant_id, object_category, collection):
+        """
+        Get the synchronized index of a tenant and object category.
+        """
+
+        cache_key = (tenant_id, object_category)
+
+        with self.lock:
+            index = self.indexes.get(cache_key)
+            if index is None:
+                index = AckCollectionIndex()
+                self.indexes[cache_key] = index
+            self.indexes.move_to_end(cache_key)
+
+        with index.lock:
+            now = time.monotonic()
+            if (
+                index.last_full_sync is None
+                or now - index.last_full_sync >= self.full_sync_interval
+            ):
+                self.load(index, collection, object_category, now)
+            elif now - index.last_refresh >= self.refresh_interval:
+                self.refresh(index, collection, object_category, now)
+
+        self.evict(cache_key)
+
+        return index
+
+    def load(self, index, collection, object_category, now):
+        """
+        Load all records of the object category into the index.
+        """
+
+        records = query_all_records(
+            collection, {"object_category": object_category}, self.page_size
+        )
+
+        index.records_by_key = {}
+        index.keys_by_object = {}
+        index.last_mtime = 0.0
+        for record in records:
+            index.upsert(record)
+
+        index.last_refresh = now
+        index.last_full_sync = now
+
+    def refresh(self, index, collection, object_category, now):
+        """
+        Apply the records modified since the last sync to the index.
+        """
+
+        query = {
+            "$and": [
+                {"object_category": object_category},
+                {"ack_mtime": {"$gt": index.last_mtime - self.mtime_overlap}},
+            ]
+        }
+
+        for record in query_all_records(collection, query, self.page_size):
+            index.upsert(record)
+
+        index.last_refresh = now
+
+    def is_loaded(self, tenant_id, object_category):
+        """
+        Tell whether the records of the tenant and object category are cached.
+        """
+
+        with self.lock:
+            index = self.indexes.get((tenant_id, object_category))
+
+        return index is not None and index.last_full_sync is not None
+
+    def upsert(self, tenant_id, object_category, record):
+        """
+        Write-through of a record that was inserted or updated by the handler.
+        """
+
+        with self.lock:
+            index = self.indexes.get((tenant_id, object_category))
+
+        if index is not None:
+            with index.lock:
+                index.upsert(record)
+
+    def invalidate(self, tenant_id=None, object_category=None):
+        """
+        Drop the cached indexes of a tenant (and category), or all of them.
+        """
+
+        with self.lock:
+            for cache_key in list(self.indexes):
+                if tenant_id is not None and cache_key[0] != tenant_id:
+                    continue
+                if object_category is not None and cache_key[1] != object_category:
+                    continue
+                del self.indexes[cache_key]
+
+    def evict(self, current_key):
+        """
+        Evict least recently used indexes until the cache fits its budget.
+        """
+
+        with self.lock:
+            total = sum(len(index) for index in self.indexes.values())
+            for cache_key in list(self.indexes):
+                if total <= self.max_records:
+                    break
+                if cache_key == current_key:
+                    continue
+                total -= len(self.indexes.pop(cache_key))
+
+
+class AckExpiryIndex(object):
+    """
+    The upcoming expirations of the active acks, one min-heap per tenant.
+
+    Heap entries are not removed when an ack is disabled or enabled again, the entries
+    that no longer match the scheduled expiration of their ack are skipped when they
+    reach the top of the heap, and the heap is rebuilt once most entries are stale.
+    """
+
+    def __init__(self):
+        self.heaps = {}
+        self.expirations = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.expirations)
+
+    def schedule(self, tenant_id, record):
+        """
+        Schedule the expiration of an ack record, or unschedule it if the ack is not
+        active. Returns the scheduled expiration, or None.
+        """
+
+        entry_key = (tenant_id, record.get("object_category"), record.get("object"))
+        expiration = to_epoch(record.get("ack_expiration"))
+
+        with self.lock:
+            if record.get("ack_state") != "active" or expiration <= 0:
+                self.expirations.pop(entry_key, None)
+                return None
+
+            if self.expirations.get(entry_key) != expiration:
+                self.expirations[entry_key] = expiration
+                heap = self.heaps.setdefault(tenant_id, [])
+                heapq.heappush(heap, (expiration, entry_key[1], entry_key[2]))
+                if len(heap) > 2 * len(self.expirations) + 64:
+                    self.compact(tenant_id)
+
+        return expiration
+
+    def compact(self, tenant_id):
+        """
+        Rebuild the heap of a tenant without its stale entries.
+        """
+
+        heap = [
+            (expiration, object_category, object_value)
+            for (
+                entry_tenant_id,
+                object_category,
+                object_value,
+            ), expiration in self.expirations.items()
+            if entry_tenant_id == tenant_id
+        ]
+        heapq.heapify(heap)
+        self.heaps[tenant_id] = heap
+
+    def pop_due(self, tenant_id, now):
+        """
+        Remove and return the (object_category, object, ack_expiration) entries of the
+        tenant that are due.
+        """
+
+        due = []
+
+        with self.lock:
+            heap = self.heaps.get(tenant_id, [])
+            while heap and heap[0][0] <= now:
+                expiration, object_category, object_value = heapq.heappop(heap)
+                entry_key = (tenant_id, object_category, object_value)
+                if self.expirations.get(entry_key) == expiration:
+                    del self.expirations[entry_key]
+                    due.append((object_category, object_value, expiration))
+
+        return due
+
+    def next_due(self):
+        """
+        Get the earliest scheduled expiration of all tenants, or None.
+        """
+
+        next_expiration = None
+
+        with self.lock:
+            for tenant_id, heap in self.heaps.items():
+                # drop the stale entries at the top of the heap
+                while heap:
+                    expiration, object_category, object_value = heap[0]
+                    entry_key = (tenant_id, object_category, object_value)
+                    if self.expirations.get(entry_key) == expiration:
+                        break
+                    heapq.heappop(heap)
+
+                if heap and (next_expiration is None or heap[0][0] < next_expiration):
+                    next_expiration = heap[0][0]
+
+        return next_expiration
+
+    def clear(self, tenant_id):
+        """
+        Unschedule the expirations of a tenant.
+        """
+
+        with self.lock:
+            self.heaps.pop(tenant_id, None)
+            for entry_key in [k for k in self.expirations if k[0] == tenant_id]:
+                del self.expirations[entry_key]
+
+    def tenants(self):
+        """
+        List the tenants with scheduled expirations.
+        """
+
+        with self.lock:
+            return [tenant_id for tenant_id, heap in self.heaps.items() if heap]
+
+
+def is_auth_failure(exception):
+    """
+    Tell whether an exception is an authentication failure of splunkd, e.g. an
+    HTTPError of splunklib for an expired session key.
+
+    >>> is_auth_failure(AckExpiryAuthError("no session key"))
+    True
+    >>> is_auth_failure(ValueError("KV store unavailable"))
+    False
+    """
+
+    return (
+        isinstance(exception, AckExpiryAuthError)
+        or getattr(exception, "status", None) == 401
+    )
+
+
+class AckExpiryAuthError(Exception):
+    """
+    The sweeper has no valid session key for a tenant.
+    """
+
+
+class AckExpiryError(Exception):
+    """
+    The due acks of a tenant could not all be expired, the sweeper retries them.
+    """
+
+
+class AckExpirySweeper(object):
+    """
+    Flip the acks to inactive when they expire, driven by an AckExpiryIndex.
+
+    The active acks of a tenant are read by load(tenant_id) when the tenant is tracked,
+    and again every rescan_interval seconds to pick up the acks written by others, the
+    writes of the handler are scheduled as they happen. When acks are due, they are
+    passed to expire(tenant_id, entries) as (object_category, object, ack_expiration)
+    entries, which is expected to read the current records and update the expired ones
+    in batches. Entries of a failed load or expire are retried after retry_interval
+    seconds, doubled with each consecutive failure of the tenant up to rescan_interval.
+    A tenant whose load or expire fails to authenticate is no longer swept until it is
+    tracked again, by a request with a new session key.
+
+    sweep() runs one pass, e.g. from a scripted input, start() runs the passes in a
+    background thread of the persistent process.
+    """
+
+    def __init__(
+        self,
+        load,
+        expire,
+        rescan_interval=900,
+        retry_interval=60,
+        max_wait=60,
+        logger=None,
+    ):
+        self.load = load
+        self.expire = expire
+        self.rescan_interval = rescan_interval
+        self.retry_interval = retry_interval
+        self.max_wait = max_wait
+        self.logger = logger
+        self.index = AckExpiryIndex()
+        self.rescans = {}
+        self.failures = {}
+        self.counters = {"loaded": 0, "expired": 0, "failed": 0, "paused": 0}
+        self.lock = threading.Lock()
+        self.condition = threading.Condition()
+        self.wakeup = None
+        self.stopping = False
+        self.thread = None
+
+    def track(self, tenant_id):
+        """
+        Start sweeping the acks of a tenant, its active acks are loaded by the next pass.
+        A paused tenant is swept again.
+        """
+
+        with self.condition:
+            if tenant_id in self.rescans:
+                return
+            self.rescans[tenant_id] = 0
+            self.condition.notify()
+
+        self.start()
+
+    def schedule(self, tenant_id, record):
+        """
+        Schedule the expiration of an ack record written by the handler.
+        """
+
+        expiration = self.index.schedule(tenant_id, record)
+
+        if expiration is not None:
+            with self.condition:
+                if self.wakeup is not None and expiration < self.wakeup:
+                    self.condition.notify()
+
+    def sweep(self, now=None):
+        """
+        Load the tenants that are due for a rescan and expire the due acks, returns
+        the number of due entries.
+        """
+
+        if now is None:
+            now = time.time()
+
+        with self.condition:
+            rescans = [
+                tenant_id for tenant_id, rescan in self.rescans.items() if rescan <= now
+            ]
+
+        for tenant_id in rescans:
+            try:
+                records = self.load(tenant_id)
+            except Exception as e:
+                if is_auth_failure(e):
+                    self.pause(tenant_id, e)
+                    continue
+                with self.condition:
+                    self.rescans[tenant_id] = now + self.backoff(tenant_id)
+                if self.logger is not None:
+                    self.logger.exception(
+                        'tenant_id="%s", failed to load the active acks', tenant_id
+                    )
+                continue
+
+            count = 0
+            for record in records:
+                self.index.schedule(tenant_id, record)
+                count += 1
+            with self.condition:
+                self.rescans[tenant_id] = now + self.rescan_interval
+                self.failures.pop(tenant_id, None)
+            self.count("loaded", count)
+
+        due_count = 0
+        for tenant_id in self.index.tenants():
+            entries = self.index.pop_due(tenant_id, now)
+            if not entries:
+                continue
+            due_count += len(entries)
+
+            try:
+                self.expire(tenant_id, entries)
+            except Exception as e:
+                self.count("failed", len(entries))
+                if is_auth_failure(e):
+                    self.pause(tenant_id, e)
+                    continue
+                if self.logger is not None:
+                    self.logger.exception(
+                        'tenant_id="%s", failed to expire %s acks',
+                        tenant_id,
+                        len(entries),
+                    )
+                retry = now + self.backoff(tenant_id)
+                for object_category, object_value, _expiration in entries:
+                    self.index.schedule(
+                        tenant_id,
+                        {
+                            "object_category": object_category,
+                            "object": object_value,
+                            "ack_state": "active",
+                            "ack_expiration": retry,
+                        },
+                    )
+            else:
+                with self.condition:
+                    self.failures.pop(tenant_id, None)
+                self.count("expired", len(entries))
+
+        return due_count
+
+    def backoff(self, tenant_id):
+        """
+        Count a failure of a tenant, returns the seconds to wait before its retry.
+        """
+
+        with self.condition:
+            failures = self.failures.get(tenant_id, 0)
+            self.failures[tenant_id] = failures + 1
+
+        return min(self.retry_interval * 2**failures, self.rescan_interval)
+
+    def pause(self, tenant_id, exception):
+        """
+        Stop sweeping a tenant after an authentication failure, its scheduled
+        expirations are dropped and loaded again when the tenant is tracked again.
+        """
+
+        with self.condition:
+            self.rescans.pop(tenant_id, None)
+            self.failures.pop(tenant_id, None)
+        self.index.clear(tenant_id)
+        self.count("paused", 1)
+
+        if self.logger is not None:
+            self.logger.warning(
+                'tenant_id="%s", the ack expiry is paused until the next request of the tenant, exception="%s"',
+                tenant_id,
+                exception,
+            )
+
+    def count(self, counter, value):
+        """
+        Increment a counter.
+        """
+
+        with self.lock:
+            self.counters[counter] += value
+
+    def next_wakeup(self):
+        """
+        Get the time of the next pass, the next expiration or rescan.
+        """
+
+        with self.condition:
+            wakeups = list(self.rescans.values())
+        next_due = self.index.next_due()
+        if next_due is not None:
+            wakeups.append(next_due)
+        return min(wakeups) if wakeups else None
+
+    def start(self):
+        """
+        Start the background thread, if not running yet.
+        """
+
+        if self.thread is not None:
+            return
+
+        with self.condition:
+            if self.thread is None and not self.stopping:
+                self.thread = threading.Thread(
+                    target=self.run, name="ack-expiry-sweeper", daemon=True
+                )
+                self.thread.start()
+
+    def run(self):
+        """
+        Run the passes until the sweeper is stopped, waiting for the next wakeup or at
+        most max_wait seconds in between.
+        """
+
+        while True:
+            with self.condition:
+                if self.stopping:
+                    return
+
+            self.sweep()
+
+            with self.condition:
+                if self.stopping:
+                    return
+                wakeup = self.next_wakeup()
+                timeout = self.max_wait
+                if wakeup is not None:
+                    timeout = min(max(wakeup - time.time(), 0), self.max_wait)
+                self.wakeup = time.time() + timeout
+                self.condition.wait(timeout)
+                self.wakeup = None
+
+    def stop(self, timeout=5.0):
+        """
+        Stop the background thread.
+        """
+
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def stats(self):
+        """
+        Get the counters of the sweeper and the number of scheduled expirations.
+        """
+
+        with self.lock:
+            counters = dict(self.counters)
+        with self.condition:
+            tenants = len(self.rescans)
+
+        return dict(counters, scheduled=len(self.index), tenants=tenants)
@@ -0,0 +1,741 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import configparser
+import datetime
+import json
+import keyword
+import math
+import os
+import re
+from collections import OrderedDict
+
+# default and local collections.conf of the app
+APP_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+APP_NAME = os.path.basename(APP_PATH)
+
+# the maximum number of documents per batch_save call, see limits.conf [kvstore]
+DEFAULT_BATCH_SIZE = 1000
+
+# number of records retrieved per KV store query
+KV_PAGE_SIZE = 10000
+
+# number of _key per $or query, the query is passed in the URL of the request
+KEY_QUERY_CHUNK_SIZE = 100
+
+BOOL_VALUES = {
+    "1": True,
+    "true": True,
+    "t": True,
+    "yes": True,
+    "y": True,
+    "0": False,
+    "false": False,
+    "f": False,
+    "no": False,
+    "n": False,
+}
+
+
+def coerce_string(value):
+    """
+    Coerce a value of a string field.
+
+    >>> coerce_string(12)
+    '12'
+    """
+
+    if isinstance(value, (dict, list, tuple)):
+        raise ValueError(f"expected a string, got {type(value).__name__}")
+    return str(value)
+
+
+def coerce_number(value):
+    """
+    Coerce a value of a number field, numeric strings are converted.
+
+    >>> coerce_number("1.5"), coerce_number(3)
+    (1.5, 3)
+    """
+
+    if isinstance(value, bool):
+        raise ValueError("expected a number, got bool")
+    if isinstance(value, str):
+        try:
+            value = int(value)
+        except ValueError:
+            try:
+                value = float(value)
+            except ValueError:
+                raise ValueError(f'expected a number, got "{value}"')
+    if not isinstance(value, (int, float)):
+        raise ValueError(f"expected a number, got {type(value).__name__}")
+    if isinstance(value, float) and not math.isfinite(value):
+        raise ValueError(f"expected a finite number, got {value}")
+    return value
+
+
+def coerce_bool(value):
+    """
+    Coerce a value of a bool field, 0/1 and true/false strings are converted.
+
+    >>> coerce_bool("True"), coerce_bool(0)
+    (True, False)
+    """
+
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)) and value in (0, 1):
+        return bool(value)
+    if isinstance(value, str) and value.strip().lower() in BOOL_VALUES:
+        return BOOL_VALUES[value.strip().lower()]
+    raise ValueError(f'expected a bool, got "{value}"')
+
+
+def coerce_time(value):
+    """
+    Coerce a value of a time field to epoch seconds, datetimes and ISO 8601 strings
+    are converted, naive datetimes are UTC.
+
+    >>> coerce_time("2024-01-01T00:00:00Z")
+    1704067200.0
+    >>> coerce_time(datetime.datetime(2024, 1, 1))
+    1704067200.0
+    """
+
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=datetime.timezone.utc)
+        return value.timestamp()
+
+    try:
+        return float(coerce_number(value))
+    except ValueError:
+        if not isinstance(value, str):
+            raise ValueError(f"expected an epoch or ISO 8601 time, got {value!r}")
+
+    text = value.strip()
+    if text.endswith("Z"):
+        text = text[:-1] + "+00:00"
+    try:
+        return coerce_time(datetime.datetime.fromisoformat(text))
+    except ValueError:
+        raise ValueError(f'expected an epoch or ISO 8601 time, got "{value}"')
+
+
+def coerce_array(value):
+    """
+    Coerce a value of an array field.
+
+    >>> coerce_array(("a", "b"))
+    ['a', 'b']
+    """
+
+    if not isinstance(value, (list, tuple)):
+        raise ValueError(f"expected an array, got {type(value).__name__}")
+    return list(value)
+
+
+# the field types of collections.conf, cidr fields are stored as strings
+FIELD_COERCERS = {
+    "string": coerce_string,
+    "cidr": coerce_string,
+    "number": coerce_number,
+    "bool": coerce_bool,
+    "time": coerce_time,
+    "array": coerce_array,
+}
+
+
+class KVRecord(object):
+    """
+    Base class of the record classes of a collection, see CollectionSchema.
+
+    Records hold the _key and the coerced values of the fields of the collection, a
+    field that is not set is None and is not written to the KV store.
+    """
+
+    __slots__ = ("_key",)
+
+    _collection = None
+    _field_types = OrderedDict()
+    _attributes = OrderedDict()
+
+    def __init__(self, _key=None, **values):
+        self._key = _key
+        for attribute in self._attributes.values():
+            setattr(self, attribute, None)
+        for attribute, value in values.items():
+            if attribute not in self.__slots__:
+                raise ValueError(
+                    f'collection="{self._collection}", unknown field="{attribute}"'
+                )
+            setattr(self, attribute, value)
+
+    @classmethod
+    def from_dict(cls, data, strict=True):
+        """
+        Make a record from a dictionary, coercing the values to the field types.
+
+        Unknown fields raise a ValueError if strict, or are ignored. Internal fields of
+        the KV store like _user are always ignored.
+        """
+
+        record = cls(data.get("_key"))
+
+        for field, value in data.items():
+            if field.startswith("_"):
+                continue
+            field_type = cls._field_types.get(field)
+            if field_type is None:
+                if strict:
+                    raise ValueError(
+                        f'collection="{cls._collection}", unknown field="{field}"'
+                    )
+                continue
+            if value is None:
+                continue
+            try:
+                value = FIELD_COERCERS[field_type](value)
+            except ValueError as e:
+                raise ValueError(
+                    f'collection="{cls._collection}", field="{field}", {str(e)}'
+                )
+            setattr(record, cls._attributes[field], value)
+
+        return record
+
+    def to_dict(self):
+        """
+        Get the document of the record, without the fields that are not set.
+        """
+
+        document = OrderedDict()
+        if self._key is not None:
+            document["_key"] = self._key
+        for field, attribute in self._attributes.items():
+            value = getattr(self, attribute)
+            if value is not None:
+                document[field] = value
+        return document
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.to_dict() == other.to_dict()
+
+    def __repr__(self):
+        return "%s(%s)" % (
+            type(self).__name__,
+            ", ".join("%s=%r" % item for item in self.to_dict().items()),
+        )
+
+
+# the comparison operators of the KV store queries, None is an equality
+QUERY_OPERATORS = {
+    "=": None,
+    "!=": "$ne",
+    "<": "$lt",
+    "<=": "$lte",
+    ">": "$gt",
+    ">=": "$gte",
+}
+
+
+def attribute_name(field):
+    """
+    Get the attribute of a field in the record classes, fields that are not valid
+    identifiers are mapped to one.
+
+    >>> attribute_name("geo.lat"), attribute_name("class"), attribute_name("to_dict")
+    ('geo_lat', 'class_', 'to_dict_')
+    """
+
+    name = re.sub(r"\W", "_", field)
+    if not name or name[0].isdigit():
+        name = "_" + name
+    if keyword.iskeyword(name) or hasattr(KVRecord, name):
+        name += "_"
+    return name
+
+
+class CollectionSchema(object):
+    """
+    The fields of a collection declared in collections.conf, with the record class
+    generated for them.
+    """
+
+    def __init__(self, name, field_types, enforce_types=False):
+        self.name = name
+        self.field_types = OrderedDict(field_types)
+        self.enforce_types = enforce_types
+
+        for field, field_type in self.field_types.items():
+            if field_type not in FIELD_COERCERS:
+                raise ValueError(
+                    f'collection="{name}", field="{field}" has the unsupported type="{field_type}"'
+                )
+
+        attributes = OrderedDict(
+            (field, attribute_name(field)) for field in self.field_types
+        )
+        if len(set(attributes.values())) != len(attributes):
+            raise ValueError(f'collection="{name}", fields map to the same attribute')
+
+        self.record_class = type(
+            "".join(part.capitalize() for part in re.split(r"\W|_", name)) + "Record",
+            (KVRecord,),
+            {
+                "__slots__": tuple(attributes.values()),
+                "_collection": name,
+                "_field_types": self.field_types,
+                "_attributes": attributes,
+            },
+        )
+
+    def coerce(self, row, strict=True):
+        """
+        Coerce a row, a dictionary or a record of the collection, to a record.
+        """
+
+        if isinstance(row, self.record_class):
+            return row
+        if not isinstance(row, dict):
+            raise ValueError(
+                f'collection="{self.name}", expected a dictionary, got {type(row).__name__}'
+            )
+        return self.record_class.from_dict(row, strict)
+
+    def check_field(self, field):
+        """
+        Check that a field of a query, sort or projection belongs to the collection.
+        """
+
+        if field != "_key" and field not in self.field_types:
+            raise ValueError(f'collection="{self.name}", unknown field="{field}"')
+        return field
+
+    def coerce_value(self, field, value):
+        """
+        Coerce a value compared to a field in a query.
+        """
+
+        if field == "_key":
+            return str(value)
+        try:
+            return FIELD_COERCERS[self.field_types[field]](value)
+        except ValueError as e:
+            raise ValueError(f'collection="{self.name}", field="{field}", {str(e)}')
+
+    def query(self, filters):
+        """
+        Make the KV store query of (field, operator, value) filters, which must all
+        match. The operators are those of QUERY_OPERATORS and "in", whose value is a
+        list. Returns None without filters.
+
+        >>> collection_schema("my_collection").query([("mynumber", ">", "1")])
+        {'mynumber': {'$gt': 1}}
+        """
+
+        conditions = []
+        for field, operator, value in filters:
+            self.check_field(field)
+            if operator == "in":
+                if not isinstance(value, (list, tuple)) or not value:
+                    raise ValueError(f'field="{field}", "in" expects a list of values')
+                conditions.append(
+                    {"$or": [{field: self.coerce_value(field, v)} for v in value]}
+                )
+            elif operator in QUERY_OPERATORS:
+                value = self.coerce_value(field, value)
+                if QUERY_OPERATORS[operator] is not None:
+                    value = {QUERY_OPERATORS[operator]: value}
+                conditions.append({field: value})
+            else:
+                raise ValueError(
+                    f'field="{field}", the filter type="{operator}" is not supported'
+                )
+
+        if not conditions:
+            return None
+        if len(conditions) == 1:
+            return conditions[0]
+        return {"$and": conditions}
+
+    def sort(self, sorters):
+        """
+        Make the KV store sort of (field, direction) sorters, direction is asc or desc.
+
+        >>> collection_schema("my_collection").sort([("mynumber", "desc")])
+        'mynumber:-1'
+        """
+
+        sort_keys = []
+        for field, direction in sorters:
+            self.check_field(field)
+            if direction not in ("asc", "desc"):
+                raise ValueError(
+                    f'field="{field}", the sort dir="{direction}" is not supported'
+                )
+            sort_keys.append("%s:%s" % (field, "1" if direction == "asc" else "-1"))
+        return ",".join(sort_keys) or None
+
+
+def parse_collections_conf(paths):
+    """
+    Parse the collections.conf files, later files override the fields of the earlier
+    ones like local overrides default. Returns the schema of each collection.
+    """
+
+    parser = configparser.ConfigParser(
+        interpolation=None, strict=False, comment_prefixes=("#", ";")
+    )
+    parser.optionxform = str
+    parser.read(paths, encoding="utf-8")
+
+    schemas = OrderedDict()
+    for name in parser.sections():
+        stanza = parser[name]
+        field_types = OrderedDict(
+            (option[len("field.") :], value.strip().lower())
+            for option, value in stanza.items()
+            if option.startswith("field.")
+        )
+        enforce_types = stanza.get("enforceTypes", "false").strip().lower() in (
+            "1",
+            "true",
+        )
+        schemas[name] = CollectionSchema(name, field_types, enforce_types)
+
+    return schemas
+
+
+# schemas of the app, parsed once per process
+_schemas = {}
+
+
+def collection_schema(name, app_path=APP_PATH):
+    """
+    Get the schema of a collection of the app, collections.conf is parsed on the first
+    call.
+
+    >>> collection_schema("my_collection").field_types["mynumber"]
+    'number'
+    """
+
+    schemas = _schemas.get(app_path)
+    if schemas is None:
+        schemas = _schemas[app_path] = parse_collections_conf(
+            [
+                os.path.join(app_path, "default", "collections.conf"),
+                os.path.join(app_path, "local", "collections.conf"),
+            ]
+        )
+
+    try:
+        return schemas[name]
+    except KeyError:
+        raise KeyError(f'collection="{name}" is not declared in collections.conf')
+
+
+def query_all_records(collection, query=None, page_size=KV_PAGE_SIZE, fields=None):
+    """
+    Retrieve all records of a KV store collection that match the query, page by page.
+    """
+
+    records = []
+    skip = 0
+
+    while True:
+        kwargs = {"skip": skip, "limit": page_size}
+        if query:
+            kwargs["query"] = json.dumps(query)
+        if fields:
+            kwargs["fields"] = ",".join(fields)
+        page = collection.data.query(**kwargs)
+        records.extend(page)
+        if len(page) < page_size:
+            return records
+        skip += page_size
+
+
+def query_page(collection, query, pagination):
+    """
+    Retrieve one page of records, the KV store applies skip, limit, sort and fields.
+
+    Returns the records of the page and the cursor of the next page, or None.
+    """
+
+    # one more record than requested tells whether there is a next page
+    kwargs = {"skip": pagination.skip, "limit": pagination.limit + 1}
+    if query:
+        kwargs["query"] = json.dumps(query)
+    if pagination.sort:
+        kwargs["sort"] = pagination.sort
+    if pagination.fields:
+        kwargs["fields"] = ",".join(pagination.fields)
+
+    records = collection.data.query(**kwargs)
+    has_next_page = len(records) > pagination.limit
+    records = records[: pagination.limit]
+
+    if has_next_page:
+        return records, pagination.next_cursor(len(records))
+    return records, None
+
+
+def chunk_list(values, chunk_size):
+    """
+    Split a list in chunks of chunk_size values.
+
+    >>> chunk_list([1, 2, 3, 4, 5], 2)
+    [[1, 2], [3, 4], [5]]
+    """
+
+    return [
+        values[start : start + chunk_size]
+        for start in range(0, len(values), chunk_size)
+    ]
+
+
+def stored_document(record):
+    """
+    Get the document of a record read from the KV store, without the internal fields
+    of the KV store like _user.
+
+    >>> stored_document({"_key": "1", "_user": "nobody", "note": "a"})
+    {'_key': '1', 'note': 'a'}
+    """
+
+    return {
+        field: value
+        for field, value in record.items()
+        if field == "_key" or not field.startswith("_")
+    }
+
+
+def batch_save_records(collection, documents, batch_size, map_function=map):
+    """
+    Save documents in chunks through the batch_save endpoint of the collection.
+
+    The chunks are saved with map_function(function, chunks), e.g. the map_concurrent
+    of the handler to save them concurrently.
+
+    Returns a list aligned with the documents, holding the _key of each saved document
+    or the exception of the chunk that could not be saved. The KV store keeps the
+    documents of a failed chunk that were saved before the failure, the documents
+    with a _key are read again and only those that are not stored as they were sent
+    get the exception.
+    """
+
+    def save_chunk(chunk):
+        try:
+            return collection.data.batch_save(*chunk)
+        except Exception as e:
+            return verify_chunk(chunk, e)
+
+    def verify_chunk(chunk, exception):
+        keys = [document["_key"] for document in chunk if "_key" in document]
+        stored = {}
+        try:
+            for keys_chunk in chunk_list(keys, KEY_QUERY_CHUNK_SIZE):
+                for record in query_all_records(
+                    collection, {"$or": [{"_key": key} for key in keys_chunk]}
+                ):
+                    stored[record["_key"]] = stored_document(record)
+        except Exception:
+            return [exception] * len(chunk)
+
+        return [
+            (
+                document["_key"]
+                if "_key" in document
+                and stored.get(document["_key"]) == stored_document(document)
+                else exception
+            )
+            for document in chunk
+        ]
+
+    chunks = [
+        documents[start : start + batch_size]
+        for start in range(0, len(documents), batch_size)
+    ]
+
+    results = []
+    for keys in map_function(save_chunk, chunks):
+        results.extend(keys)
+
+    return results
+
+
+class KVRepository(object):
+    """
+    Typed access to a KV store collection, rows are coerced and validated against the
+    schema of the collection before any call to splunkd.
+
+    Rows are saved in chunks of batch_size through the batch_save endpoint and read or
+    deleted by _key in chunks of chunk_size keys per query. The chunks are run with
+    map_function(function, chunks), e.g. the map_concurrent of the handler.
+    """
+
+    def __init__(
+        self,
+        collection,
+        schema,
+        batch_size=DEFAULT_BATCH_SIZE,
+        chunk_size=KEY_QUERY_CHUNK_SIZE,
+        map_function=map,
+    ):
+        self.collection = collection
+        self.schema = schema
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+        self.map_function = map_function
+
+    def validate(self, rows):
+        """
+        Coerce rows to records, returns a list aligned with the rows holding the record
+        or the ValueError of each row.
+        """
+
+        records = []
+        for row in rows:
+            try:
+                records.append(self.schema.coerce(row))
+            except ValueError as e:
+                records.append(e)
+        return records
+
+    def upsert_many(self, rows):
+        """
+        Insert or update rows, rows with a _key replace the record of the _key.
+
+        Returns a list aligned with the rows, holding the _key of each saved row or
+        the exception of the row: a ValueError if it is not valid, in which case it is
+        not sent, or the exception of its chunk. The _key of saved records is set.
+        """
+
+        results = self.validate(rows)
+        records = [record for record in results if not isinstance(record, Exception)]
+
+        saved_keys = iter(
+            batch_save_records(
+                self.collection,
+                [record.to_dict() for record in records],
+                self.batch_size,
+                self.map_function,
+            )
+        )
+
+        for position, record in enumerate(results):
+            if isinstance(record, Exception):
+                continue
+            saved_key = next(saved_keys)
+            if not isinstance(saved_key, Exception):
+                record._key = saved_key
+            results[position] = saved_key
+
+        return results
+
+    def upsert_documents(self, documents):
+        """
+        Insert or update documents as they are, with the fields that are not declared
+        in the schema, e.g. stored documents merged with the changes of validated rows.
+
+        Returns a list aligned with the documents, holding the _key of each saved
+        document or the exception of its chunk.
+        """
+
+        return batch_save_records(
+            self.collection, documents, self.batch_size, self.map_function
+        )
+
+    def get_many(self, keys):
+        """
+        Get the records of a list of _key, returns a list aligned with the keys holding
+        the record or None.
+        """
+
+        return [
+            None if document is None else self.schema.coerce(document, False)
+            for document in self.get_documents(keys)
+        ]
+
+    def get_documents(self, keys):
+        """
+        Get the stored documents of a list of _key, with the fields that are not
+        declared in the schema. Returns a list aligned with the keys holding the
+        document or None.
+        """
+
+        def query_chunk(chunk):
+            return query_all_records(
+                self.collection, {"$or": [{"_key": key} for key in chunk]}
+            )
+
+        documents_by_key = {}
+        unique_keys = list(dict.fromkeys(keys))
+        for records in self.map_function(
+            query_chunk, chunk_list(unique_keys, self.chunk_size)
+        ):
+            for record in records:
+                documents_by_key[record["_key"]] = stored_document(record)
+
+        return [documents_by_key.get(key) for key in keys]
+
+    def find(self, query=None, skip=0, limit=0, sort=None, fields=None):
+        """
+        Get the records of a query, one page of limit records if set.
+        """
+
+        if fields:
+            fields = [self.schema.check_field(field) for field in fields]
+
+        return [
+            self.schema.coerce(document, False)
+            for document in self.find_documents(query, skip, limit, sort, fields)
+        ]
+
+    def find_documents(self, query=None, skip=0, limit=0, sort=None, fields=None):
+        """
+        Get the stored documents of a query, with the fields that are not declared in
+        the schema, one page of limit documents if set.
+        """
+
+        kwargs = {"skip": skip, "limit": limit}
+        if query:
+            kwargs["query"] = json.dumps(query)
+        if sort:
+            kwargs["sort"] = sort
+        if fields:
+            kwargs["fields"] = ",".join(fields)
+
+        return [
+            stored_document(record) for record in self.collection.data.query(**kwargs)
+        ]
+
+    def count(self, query=None):
+        """
+        Count the records of a query, only their _key is retrieved.
+        """
+
+        return len(query_all_records(self.collection, query, fields=("_key",)))
+
+    def delete_many(self, keys):
+        """
+        Delete the records of a list of _key, returns the number of deleted records.
+
+        The KV store does not return the number of records deleted by a query, the
+        records of each chunk that exist are counted before they are deleted.
+        """
+
+        def delete_chunk(chunk):
+            query = {"$or": [{"_key": key} for key in chunk]}
+            existing = query_all_records(self.collection, query, fields=("_key",))
+            if not existing:
+                return 0
+            self.collection.data.delete(json.dumps(query))
+            return len(existing)
+
+        unique_keys = list(dict.fromkeys(keys))
+        return sum(
+            self.map_function(delete_chunk, chunk_list(unique_keys, self.chunk_size))
+        )
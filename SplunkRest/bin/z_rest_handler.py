@@ -1,52 +1,1781 @@
 #!/usr/bin/env python
 # coding=utf-8
 
+import libs  # noqa: F401
+
+import asyncio
+import atexit
+import base64
+import http.client
+import io
+import itertools
+import queue
 import re
 import json
-from urllib.parse import urlparse
+import logging
+import logging.handlers
+import os
+import ssl
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from urllib.parse import quote, urlencode, urlparse
 import urllib3
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 from splunk.persistconn.application import PersistentServerConnectionApplication
 
+import splunklib.client as client
+from splunklib import binding
 
-class RequestInfo(object):
+# optional fast JSON libraries, vendored in lib
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+# HTTP verbs that are resolved to functions of a REST handler (get_*, post_*, ...)
+HTTP_METHODS = ("get", "post", "put", "delete", "patch", "head")
+
+# maximum number of resolved paths kept per route table
+MAX_RESOLVED_ROUTES = 1024
+
+# default of max_documents_per_batch_save in the [kvstore] stanza of limits.conf
+DEFAULT_MAX_DOCUMENTS_PER_BATCH_SAVE = 1000
+
+
+def normalize_path(path):
     """
-    This represents the request.
+    Normalize a path the same way it is mapped to a function name.
+
+    >>> normalize_path("Ack/Manage")
+    'ack_manage'
+    """
+
+    return re.sub(r"[^a-zA-Z0-9_]", "_", path).lower()
+
+
+def route(method, path):
+    """
+    Register a function for an additional route. Path parameters are written as {name}
+    and are passed to the function as keyword arguments.
+
+    For example, a function decorated with @route("post", "ack/{tenant_id}/objects")
+    is executed for a POST request to /ack/mytenant/objects with tenant_id="mytenant".
+    """
+
+    def decorator(function):
+        routes = list(getattr(function, "rest_routes", []))
+        routes.append((method.lower(), path.strip("/")))
+        function.rest_routes = routes
+        return function
+
+    return decorator
+
+
+class RouteNode(object):
+    """
+    A node of the route trie, one node per path segment.
+    """
+
+    __slots__ = ("children", "param_name", "param_child", "function_name")
+
+    def __init__(self):
+        self.children = {}
+        self.param_name = None
+        self.param_child = None
+        self.function_name = None
+
+
+class RouteTable(object):
+    """
+    The routes of a REST handler class, built once when the class is created.
+
+    Functions named after the HTTP verb and the path (get_lookup_contents) are kept in
+    a dict keyed by (method, normalized path), routes with path parameters registered
+    with @route are kept in a trie per method. Resolved paths are memoized, so the
+    normalization of a path only runs the first time it is requested.
+    """
+
+    def __init__(self):
+        self.static = {}
+        self.templates = {}
+        self.routes = []
+        self.resolved = {}
+
+    @classmethod
+    def build(cls, handler_class):
+        """
+        Scan the functions of the handler class and build its route table.
+        """
+
+        table = cls()
+
+        # only functions defined by sub-classes are routes by name, helpers of the base
+        # class like get_function_signature must not be reachable
+        own_names = set()
+        for klass in handler_class.__mro__:
+            if klass is not RESTHandler and issubclass(klass, RESTHandler):
+                own_names.update(vars(klass))
+
+        for name in dir(handler_class):
+            function = getattr(handler_class, name, None)
+            if not callable(function):
+                continue
+
+            for method, path in getattr(function, "rest_routes", []):
+                table.add(method, path, name)
+
+            if name in own_names:
+                method, _, path = name.partition("_")
+                if method in HTTP_METHODS:
+                    table.add(method, path, name)
+
+        return table
+
+    def add(self, method, path, function_name):
+        """
+        Add a route to the table.
+        """
+
+        self.routes.append(
+            {"method": method, "path": "/" + path, "function": function_name}
+        )
+
+        if "{" not in path:
+            self.static[(method, normalize_path(path))] = function_name
+            return
+
+        node = self.templates.setdefault(method, RouteNode())
+        for segment in path.split("/"):
+            if segment.startswith("{") and segment.endswith("}"):
+                if node.param_child is None:
+                    node.param_name = segment[1:-1]
+                    node.param_child = RouteNode()
+                node = node.param_child
+            else:
+                node = node.children.setdefault(segment, RouteNode())
+        node.function_name = function_name
+
+    def resolve(self, method, path):
+        """
+        Get the function name and the path parameters for a request, or None.
+        """
+
+        key = (method, path)
+        resolved = self.resolved.get(key)
+        if resolved is not None:
+            return resolved
+
+        function_name = self.static.get((method, normalize_path(path)))
+        if function_name is not None:
+            resolved = (function_name, {})
+        else:
+            resolved = self.match_template(method, path)
+
+        if resolved is not None and len(self.resolved) < MAX_RESOLVED_ROUTES:
+            self.resolved[key] = resolved
+
+        return resolved
+
+    def match_template(self, method, path):
+        """
+        Walk the trie of the method along the segments of the path.
+        """
+
+        node = self.templates.get(method)
+        params = {}
+
+        for segment in path.strip("/").split("/"):
+            if node is None:
+                return None
+            child = node.children.get(segment)
+            if child is None and node.param_child is not None and segment:
+                params[node.param_name] = segment
+                child = node.param_child
+            node = child
+
+        if node is None or node.function_name is None:
+            return None
+
+        return (node.function_name, params)
+
+
+class KeepAliveConnections(object):
+    """
+    HTTP connections to splunkd that are kept alive and reused across requests.
+
+    Responses are read completely before a connection is given back, idle connections
+    are closed after keepalive_idle seconds since splunkd drops them on its side.
+    """
+
+    def __init__(self, timeout=300, verify=False, max_idle=8, keepalive_idle=10):
+        self.timeout = timeout
+        self.verify = verify
+        self.max_idle = max_idle
+        self.keepalive_idle = keepalive_idle
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def connect(self, scheme, host, port):
+        """
+        Open a new connection.
+        """
+
+        if scheme == "http":
+            return http.client.HTTPConnection(host, port, timeout=self.timeout)
+        if scheme == "https":
+            if self.verify:
+                context = ssl.create_default_context()
+            else:
+                context = ssl._create_unverified_context()
+            return http.client.HTTPSConnection(
+                host, port, timeout=self.timeout, context=context
+            )
+        raise ValueError("unsupported scheme: %s" % scheme)
+
+    def acquire(self, address):
+        """
+        Get an idle connection to the address, or None.
+        """
+
+        now = time.monotonic()
+        with self.lock:
+            connections = self.idle.get(address)
+            while connections:
+                connection, released = connections.pop()
+                if now - released < self.keepalive_idle:
+                    return connection
+                connection.close()
+        return None
+
+    def release(self, address, connection):
+        """
+        Give a connection back to be reused.
+        """
+
+        with self.lock:
+            connections = self.idle.setdefault(address, [])
+            if len(connections) < self.max_idle:
+                connections.append((connection, time.monotonic()))
+                return
+        connection.close()
+
+    def request(self, url, message, **kwargs):
+        """
+        Issue a request, this has the signature of a splunklib HTTP request handler.
+        """
+
+        parsed_url = urlparse(url)
+        address = (parsed_url.scheme, parsed_url.hostname, parsed_url.port)
+        path = parsed_url.path
+        if parsed_url.query:
+            path += "?" + parsed_url.query
+
+        body = message.get("body", "")
+        head = {
+            "Content-Length": str(len(body)),
+            "Host": parsed_url.hostname,
+            "User-Agent": "splunk-sdk-python",
+            "Accept": "*/*",
+            "Connection": "Keep-Alive",
+        }
+        for key, value in message["headers"]:
+            head[key] = value
+        method = message.get("method", "GET")
+
+        connection = self.acquire(address)
+        reused = connection is not None
+        if connection is None:
+            connection = self.connect(*address)
+
+        try:
+            connection.request(method, path, body, head)
+            response = connection.getresponse()
+            data = response.read()
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+            connection.close()
+            if not reused:
+                raise
+
+            # splunkd closed the idle connection meanwhile, retry on a new one
+            connection = self.connect(*address)
+            connection.request(method, path, body, head)
+            response = connection.getresponse()
+            data = response.read()
+        except Exception:
+            connection.close()
+            raise
+
+        if response.will_close:
+            connection.close()
+        else:
+            self.release(address, connection)
+
+        return {
+            "status": response.status,
+            "reason": response.reason,
+            "headers": response.getheaders(),
+            "body": binding.ResponseReader(io.BytesIO(data)),
+        }
+
+
+class PooledService(object):
+    """
+    A splunklib service of the pool and the KV store collections resolved with it.
+    """
+
+    __slots__ = ("service", "last_used", "collections", "batch_save_size")
+
+    def __init__(self, service, last_used):
+        self.service = service
+        self.last_used = last_used
+        self.collections = {}
+        self.batch_save_size = None
+
+    def max_documents_per_batch_save(self):
+        """
+        Get the maximum number of documents per batch_save call from limits.conf, the
+        default is used if limits.conf can not be read with the session.
+        """
+
+        if self.batch_save_size is None:
+            try:
+                stanza = self.service.confs["limits"]["kvstore"]
+                self.batch_save_size = int(
+                    stanza.content.get(
+                        "max_documents_per_batch_save",
+                        DEFAULT_MAX_DOCUMENTS_PER_BATCH_SAVE,
+                    )
+                )
+            except Exception:
+                self.batch_save_size = DEFAULT_MAX_DOCUMENTS_PER_BATCH_SAVE
+        return self.batch_save_size
+
+    def kvstore_collection(self, collection_name):
+        """
+        Get a KV store collection, the namespace is only resolved the first time.
+        """
+
+        collection = self.collections.get(collection_name)
+        if collection is None:
+            collection = self.service.kvstore[collection_name]
+            self.collections[collection_name] = collection
+        return collection
+
+
+class ServicePool(object):
+    """
+    Pool of splunklib services that are reused across requests of the persistent
+    process.
+
+    Services are keyed by (token, scheme, host, port, owner, app) and share the
+    keep-alive connections to splunkd. Entries expire after idle_ttl seconds without
+    use and are evicted as soon as splunkd rejects their session key.
+    """
+
+    def __init__(self, idle_ttl=300, max_size=64, timeout=300):
+        self.idle_ttl = idle_ttl
+        self.max_size = max_size
+        self.timeout = timeout
+        self.connections = KeepAliveConnections(timeout=timeout)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, token, rest_uri, owner="nobody", app=None):
+        """
+        Get the pooled service for the session key and the splunkd REST uri.
+        """
+
+        parsed_uri = urlparse(rest_uri)
+        key = (
+            token,
+            parsed_uri.scheme,
+            parsed_uri.hostname,
+            parsed_uri.port,
+            owner,
+            app,
+        )
+        now = time.monotonic()
+
+        with self.lock:
+            self.expire(now)
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry.last_used = now
+                self.entries.move_to_end(key)
+                return entry
+
+        def request(url, message, **kwargs):
+            response = self.connections.request(url, message, **kwargs)
+            if response["status"] == 401:
+                self.evict(key)
+            return response
+
+        service = client.connect(
+            scheme=parsed_uri.scheme,
+            host=parsed_uri.hostname,
+            port=parsed_uri.port,
+            owner=owner,
+            app=app,
+            token=token,
+            handler=request,
+        )
+        entry = PooledService(service, now)
+
+        with self.lock:
+            self.entries[key] = entry
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+        return entry
+
+    def expire(self, now):
+        """
+        Remove the entries that were idle for longer than idle_ttl.
+        """
+
+        while self.entries:
+            key, entry = next(iter(self.entries.items()))
+            if now - entry.last_used < self.idle_ttl:
+                break
+            del self.entries[key]
+
+    def evict(self, key):
+        """
+        Remove an entry, e.g. because its session key is no longer valid.
+        """
+
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def invalidate(self, token):
+        """
+        Remove all entries of a session key.
+        """
+
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == token]:
+                del self.entries[key]
+
+
+class AuditRecord(tuple):
+    """
+    The arguments of an audit record, with a key that identifies the record across the
+    retries of its batch.
+
+    >>> record = AuditRecord(("a", "b"), "sink-1")
+    >>> record, record.key
+    (('a', 'b'), 'sink-1')
+    """
+
+    def __new__(cls, record, key):
+        self = tuple.__new__(cls, record)
+        self.key = key
+        return self
+
+
+class AuditSink(object):
+    """
+    Audit records that are queued by the requests and written in batches by a
+    background thread.
+
+    A batch is written when flush_size records are queued or flush_interval seconds
+    passed. When the queue is full, put blocks up to put_timeout seconds before the
+    record is dropped, a batch that could not be written is retried once. Remaining
+    records are written by close(), which runs when the handler is done or the
+    process exits.
+    """
+
+    def __init__(
+        self,
+        writer,
+        max_queue=10000,
+        flush_size=100,
+        flush_interval=1.0,
+        put_timeout=5.0,
+        logger=None,
+    ):
+        self.writer = writer
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.logger = logger
+        self.queue = queue.Queue(max_queue)
+        self.counters = {"queued": 0, "flushed": 0, "dropped": 0, "failed": 0}
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def put(self, record):
+        """
+        Queue a record, returns False if the record was dropped.
+        """
+
+        self.start()
+
+        try:
+            self.queue.put(record, timeout=self.put_timeout)
+        except queue.Full:
+            self.count("dropped", 1)
+            if self.logger is not None:
+                self.logger.error(
+                    "The audit queue is full, an audit record was dropped"
+                )
+            return False
+
+        self.count("queued", 1)
+        return True
+
+    def start(self):
+        """
+        Start the background thread, if not running yet.
+        """
+
+        if self.thread is not None:
+            return
+
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self.run, name="audit-sink", daemon=True
+                )
+                self.thread.start()
+                atexit.register(self.close)
+
+    def run(self):
+        """
+        Write the queued records until the sink is closed and the queue is empty.
+        """
+
+        while True:
+            batch = self.take_batch()
+            if batch:
+                self.write(batch)
+            elif self.stopping.is_set():
+                return
+
+    def take_batch(self):
+        """
+        Take up to flush_size records, waiting at most flush_interval seconds.
+        """
+
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+
+        while len(batch) < self.flush_size:
+            timeout = deadline - time.monotonic()
+            try:
+                if timeout > 0 and not self.stopping.is_set():
+                    batch.append(self.queue.get(timeout=timeout))
+                else:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+
+        return batch
+
+    def write(self, batch):
+        """
+        Write a batch of records, retrying once if the writer fails.
+        """
+
+        for attempt in (1, 2):
+            try:
+                self.writer(batch)
+            except Exception:
+                if attempt == 1:
+                    time.sleep(self.flush_interval)
+                    continue
+                self.count("failed", len(batch))
+                if self.logger is not None:
+                    self.logger.exception(
+                        "Failed to write a batch of %s audit records", len(batch)
+                    )
+            else:
+                self.count("flushed", len(batch))
+            break
+
+        for _ in batch:
+            self.queue.task_done()
+
+    def flush(self):
+        """
+        Wait until all queued records are written.
+        """
+
+        if self.thread is not None:
+            self.queue.join()
+
+    def close(self, timeout=30):
+        """
+        Write the remaining records and stop the background thread.
+        """
+
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def count(self, counter, value):
+        """
+        Increment a counter.
+        """
+
+        with self.lock:
+            self.counters[counter] += value
+
+    def stats(self):
+        """
+        Get the counters of queued, flushed, dropped and failed records.
+        """
+
+        with self.lock:
+            return dict(self.counters, pending=self.queue.qsize())
+
+
+class LogLevelResolver(object):
+    """
+    The log level of a handler, resolved with a function and cached for ttl seconds.
+
+    The first call resolves the level synchronously. Once the ttl expired, the cached
+    level is still returned while a background thread resolves the current level, so
+    at most one resolution runs every ttl seconds.
+    """
+
+    def __init__(self, resolve, ttl=60, logger=None):
+        self.resolve = resolve
+        self.ttl = ttl
+        self.logger = logger
+        self.level = None
+        self.resolved_at = None
+        self.refreshing = False
+        self.lock = threading.Lock()
+
+    def get(self, *args):
+        """
+        Get the log level, the arguments are passed to the resolve function.
+        """
+
+        if self.level is None:
+            self.refresh(*args)
+            return self.level
+
+        if time.monotonic() - self.resolved_at >= self.ttl:
+            with self.lock:
+                start_refresh = not self.refreshing
+                self.refreshing = True
+            if start_refresh:
+                threading.Thread(
+                    target=self.refresh, args=args, name="loglevel", daemon=True
+                ).start()
+
+        return self.level
+
+    def refresh(self, *args):
+        """
+        Resolve the log level, the cached level is kept if this fails.
+        """
+
+        try:
+            self.level = self.resolve(*args)
+        except Exception:
+            if self.logger is not None:
+                self.logger.exception("Failed to resolve the log level")
+        finally:
+            self.resolved_at = time.monotonic()
+            self.refreshing = False
+
+    def invalidate(self):
+        """
+        Resolve the log level again on the next call.
+        """
+
+        self.level = None
+
+
+class RateLimitFilter(logging.Filter):
     """
+    Limit repeated warnings and errors: a route logs at most burst records of the same
+    message per interval seconds, the number of suppressed records is appended to the
+    first record of the next interval.
+
+    Records are limited per route, level, logger and message. The message is the
+    format string of the record, so records of a message whose arguments differ are
+    limited together, see RESTHandler.log_error.
+    """
+
+    def __init__(self, route=None, burst=10, interval=60):
+        super(RateLimitFilter, self).__init__()
+        self.route = route
+        self.burst = burst
+        self.interval = interval
+        self.windows = {}
+        self.suppressed = 0
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING:
+            return True
+
+        route_name = self.route() if self.route is not None else None
+        key = (route_name, record.levelno, record.name, record.msg)
+        now = time.monotonic()
+
+        with self.lock:
+            window = self.windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                suppressed = window[2] if window is not None else 0
+                self.windows[key] = [now, 1, 0]
+                if len(self.windows) > 10000:
+                    self.windows.clear()
+                if suppressed:
+                    record.msg = "%s (%d similar records suppressed)" % (
+                        record.getMessage(),
+                        suppressed,
+                    )
+                    record.args = None
+                return True
+
+            if window[1] < self.burst:
+                window[1] += 1
+                return True
+
+            window[2] += 1
+            self.suppressed += 1
+            return False
+
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler that never blocks the logging thread: records are dropped and counted
+    when the queue is full.
+
+    Records are queued as they are, so their messages are only formatted by the
+    listener thread, and only if they are written.
+    """
+
+    def __init__(self, max_queue=10000):
+        super(BoundedQueueHandler, self).__init__(queue.Queue(max_queue))
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LoggingPipeline(object):
+    """
+    Logging of a persistent process to a rotating file in $SPLUNK_HOME/var/log/splunk.
+
+    The root logger gets a bounded queue handler, the records are written to the file
+    by the thread of a QueueListener, so a slow disk or a burst of records does not
+    stall the requests. Pipelines are installed once per file name.
+    """
+
+    FORMAT = (
+        "%(asctime)s %(levelname)s %(filename)s %(funcName)s %(lineno)d %(message)s"
+    )
+
+    pipelines = {}
+    pipelines_lock = threading.Lock()
 
     def __init__(
         self,
-        user,
-        session_key,
-        system_authtoken,
-        server_rest_uri,
-        server_rest_host,
-        server_rest_port,
-        server_hostname,
-        server_servername,
-        connection_src_ip,
-        connection_listening_port,
-        method,
-        path,
-        query,
-        raw_args,
+        filename,
+        max_bytes=10000000,
+        backup_count=1,
+        max_queue=10000,
+        level=logging.INFO,
     ):
-        self.user = user
-        self.session_key = session_key
-        self.system_authtoken = system_authtoken
-        self.server_rest_uri = server_rest_uri
-        self.server_rest_host = server_rest_host
-        self.server_rest_port = server_rest_port
-        self.server_hostname = server_hostname
-        self.server_servername = server_servername
-        self.connection_src_ip = connection_src_ip
-        self.connection_listening_port = connection_listening_port
-        self.method = method
-        self.path = path
-        self.query = query
+        self.filename = filename
+        self.file_handler = logging.handlers.RotatingFileHandler(
+            filename, mode="a", maxBytes=max_bytes, backupCount=backup_count
+        )
+        formatter = logging.Formatter(self.FORMAT)
+        formatter.converter = time.gmtime
+        self.file_handler.setFormatter(formatter)
+
+        self.queue_handler = BoundedQueueHandler(max_queue)
+        self.rate_limit = RateLimitFilter()
+        self.queue_handler.addFilter(self.rate_limit)
+        self.listener = logging.handlers.QueueListener(
+            self.queue_handler.queue, self.file_handler, respect_handler_level=True
+        )
+        self.level = level
+        self.started = False
+
+    @classmethod
+    def install(cls, log_file, route=None, **kwargs):
+        """
+        Install the pipeline of a log file of $SPLUNK_HOME/var/log/splunk on the root
+        logger, if it is not installed yet. route returns the route of the current
+        request, to rate limit repeated messages per route.
+        """
+
+        filename = os.path.join(
+            os.environ["SPLUNK_HOME"], "var", "log", "splunk", log_file
+        )
+
+        with cls.pipelines_lock:
+            pipeline = cls.pipelines.get(filename)
+            if pipeline is None:
+                pipeline = cls(filename, **kwargs)
+                pipeline.start()
+                cls.pipelines[filename] = pipeline
+            if route is not None:
+                pipeline.rate_limit.route = route
+
+        return pipeline
+
+    def start(self):
+        """
+        Replace the file handlers of the root logger with the queue handler.
+        """
+
+        root = logging.getLogger()
+        for handler in root.handlers[:]:
+            if isinstance(handler, (logging.FileHandler, BoundedQueueHandler)):
+                root.removeHandler(handler)
+        root.addHandler(self.queue_handler)
+        root.setLevel(self.level)
+
+        self.listener.start()
+        self.started = True
+        atexit.register(self.stop)
+
+    def stop(self):
+        """
+        Write the queued records and close the file.
+        """
+
+        if self.started:
+            self.started = False
+            logging.getLogger().removeHandler(self.queue_handler)
+            self.listener.stop()
+            self.file_handler.close()
+
+    def stats(self):
+        """
+        Get the counters of queued, dropped and rate limited records.
+        """
+
+        return {
+            "pending": self.queue_handler.queue.qsize(),
+            "dropped": self.queue_handler.dropped,
+            "suppressed": self.rate_limit.suppressed,
+        }
+
+
+def encode_cursor(state):
+    """
+    Encode the state of a paginated query as an opaque cursor token.
+
+    >>> decode_cursor(encode_cursor({"skip": 100}))
+    {'skip': 100}
+    """
+
+    return base64.urlsafe_b64encode(json.dumps(state).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    """
+    Decode a cursor token, raises ValueError if the token is invalid.
+    """
+
+    try:
+        state = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except Exception:
+        raise ValueError("the cursor is invalid")
+
+    if not isinstance(state, dict):
+        raise ValueError("the cursor is invalid")
+
+    return state
+
+
+class Pagination(object):
+    """
+    The position of a paginated query: skip, limit, sort and fields projection.
+
+    The state is carried by the cursor token, so the following pages only need the
+    cursor that was returned as next_cursor.
+    """
+
+    __slots__ = ("skip", "limit", "sort", "fields")
+
+    def __init__(self, skip=0, limit=1000, sort=None, fields=None):
+        self.skip = skip
+        self.limit = limit
+        self.sort = sort
+        self.fields = fields
+
+    @classmethod
+    def from_params(cls, params, default_sort=None, max_limit=10000):
+        """
+        Get the pagination of the limit, cursor, sort and fields parameters, or None
+        if neither limit nor cursor are set. Raises ValueError for invalid parameters.
+        """
+
+        limit = params.get("limit")
+        cursor = params.get("cursor")
+
+        if limit is None and cursor is None:
+            return None
+
+        if cursor is not None:
+            state = decode_cursor(str(cursor))
+        else:
+            state = {
+                "sort": params.get("sort", default_sort),
+                "fields": params.get("fields"),
+            }
+
+        if limit is None:
+            limit = state.get("limit", max_limit)
+
+        try:
+            limit = int(limit)
+            skip = int(state.get("skip", 0))
+        except (TypeError, ValueError):
+            raise ValueError("limit is incorrect, an integer is expected")
+
+        if not 0 < limit <= max_limit or skip < 0:
+            raise ValueError(f"limit is incorrect, valid values are 1 to {max_limit}")
+
+        fields = state.get("fields")
+        if isinstance(fields, str):
+            fields = [field.strip() for field in fields.split(",") if field.strip()]
+
+        return cls(skip, limit, state.get("sort"), fields or None)
+
+    def next_cursor(self, count):
+        """
+        Get the cursor of the next page if the page was full, or None.
+        """
+
+        if count < self.limit:
+            return None
+
+        return encode_cursor(
+            {
+                "skip": self.skip + count,
+                "limit": self.limit,
+                "sort": self.sort,
+                "fields": self.fields,
+            }
+        )
+
+    def key(self):
+        """
+        Get a hashable key of the pagination, e.g. to coalesce identical requests.
+
+        >>> Pagination(0, 10, ["object", "ack_mtime"], ["object"]).key()
+        (0, 10, ('object', 'ack_mtime'), ('object',))
+        """
+
+        sort = tuple(self.sort) if isinstance(self.sort, list) else self.sort
+        fields = tuple(self.fields) if self.fields else None
+        return (self.skip, self.limit, sort, fields)
+
+
+class JSONCodec(object):
+    """
+    JSON encoding and decoding with orjson or ujson if they are vendored in lib, the
+    json module of the standard library otherwise.
+
+    >>> JSONCodec("json").dumps({"a": [1, 2]})
+    '{"a": [1, 2]}'
+    >>> JSONCodec("json").loads(b'{"a": 1}')
+    {'a': 1}
+    """
+
+    def __init__(self, name=None):
+        if name is None:
+            if orjson is not None:
+                name = "orjson"
+            elif ujson is not None:
+                name = "ujson"
+            else:
+                name = "json"
+
+        self.name = name
+
+        if name == "orjson":
+            self.loads = orjson.loads
+            self.dumps_bytes = self.orjson_dumps_bytes
+            self.dumps = self.orjson_dumps
+        elif name == "ujson":
+            self.loads = ujson.loads
+            self.dumps = self.ujson_dumps
+            self.dumps_bytes = self.ujson_dumps_bytes
+        else:
+            self.loads = json.loads
+            self.dumps = json.dumps
+            self.dumps_bytes = self.json_dumps_bytes
+
+    @staticmethod
+    def orjson_dumps_bytes(data):
+        try:
+            return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            # types orjson does not serialize, e.g. integers of more than 64 bits
+            return json.dumps(data).encode("utf-8")
+
+    def orjson_dumps(self, data):
+        return self.orjson_dumps_bytes(data).decode("utf-8")
+
+    @staticmethod
+    def ujson_dumps(data):
+        return ujson.dumps(data, ensure_ascii=False, escape_forward_slashes=False)
+
+    def ujson_dumps_bytes(self, data):
+        return self.ujson_dumps(data).encode("utf-8")
+
+    @staticmethod
+    def json_dumps_bytes(data):
+        return json.dumps(data).encode("utf-8")
+
+
+class TenantExecutor(object):
+    """
+    Bounded thread pool that runs independent calls of a request concurrently, e.g. the
+    KV store calls of the chunks of a large batch.
+
+    A tenant runs at most tenant_concurrency calls at a time, so a large request of a
+    tenant can not take all the workers. The limit is applied before a call is
+    submitted, workers never wait.
+    """
+
+    def __init__(self, max_workers=8, tenant_concurrency=4):
+        self.max_workers = max_workers
+        self.tenant_concurrency = tenant_concurrency
+        self.pool = None
+        self.semaphores = {}
+        self.lock = threading.Lock()
+
+    def get_pool(self):
+        with self.lock:
+            if self.pool is None:
+                self.pool = ThreadPoolExecutor(
+                    max_workers=self.max_workers, thread_name_prefix="rest_handler"
+                )
+            return self.pool
+
+    def get_semaphore(self, tenant_id):
+        with self.lock:
+            semaphore = self.semaphores.get(tenant_id)
+            if semaphore is None:
+                semaphore = threading.BoundedSemaphore(self.tenant_concurrency)
+                self.semaphores[tenant_id] = semaphore
+            return semaphore
+
+    def map(self, function, items, tenant_id=None):
+        """
+        Call the function for each item, returns the results in the order of the items.
+
+        All calls are completed before the first exception raised by a call is raised,
+        functions that account errors per item should return them instead.
+        """
+
+        items = list(items)
+        if len(items) <= 1:
+            return [function(item) for item in items]
+
+        pool = self.get_pool()
+        semaphore = self.get_semaphore(tenant_id)
+        futures = []
+
+        try:
+            for item in items:
+                semaphore.acquire()
+                try:
+                    future = pool.submit(function, item)
+                except BaseException:
+                    semaphore.release()
+                    raise
+                future.add_done_callback(lambda future: semaphore.release())
+                futures.append(future)
+        finally:
+            # wait for the submitted calls, even if submitting failed
+            exceptions = [future.exception() for future in futures]
+
+        for exception in exceptions:
+            if exception is not None:
+                raise exception
+
+        return [future.result() for future in futures]
+
+    def shutdown(self):
+        with self.lock:
+            pool, self.pool = self.pool, None
+        if pool is not None:
+            pool.shutdown(wait=True)
+
+
+class SingleFlight(object):
+    """
+    Coalesce identical concurrent calls: the first caller of a key runs the call, the
+    callers that arrive while it runs wait for its result instead of repeating it.
+
+    Results are kept for ttl seconds (0 disables the micro-cache). Keys belong to a
+    group, invalidate(group) drops the cached results of the group and detaches its
+    running calls, whose results are then neither cached nor shared with new callers.
+    """
+
+    def __init__(self, ttl=0.25, max_entries=1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.flights = {}
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def do(self, key, function, group=None, cacheable=None):
+        """
+        Get the result of function() for the key, an exception of the call is raised to
+        all of its callers. cacheable(result) tells whether a result may be cached.
+        """
+
+        with self.lock:
+            cached = self.cache.get(key)
+            if cached is not None:
+                if cached[0] > time.monotonic():
+                    return cached[1]
+                del self.cache[key]
+
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = Flight(group)
+                self.flights[key] = flight
+
+        if not leader:
+            flight.done.wait()
+            if flight.exception is not None:
+                raise flight.exception
+            return flight.result
+
+        try:
+            flight.result = function()
+        except BaseException as exception:
+            flight.exception = exception
+            raise
+        finally:
+            with self.lock:
+                if self.flights.get(key) is flight:
+                    del self.flights[key]
+                    if (
+                        flight.exception is None
+                        and self.ttl > 0
+                        and (cacheable is None or cacheable(flight.result))
+                    ):
+                        expires = time.monotonic() + self.ttl
+                        self.cache[key] = (expires, flight.result, group)
+                        while len(self.cache) > self.max_entries:
+                            self.cache.popitem(last=False)
+            flight.done.set()
+
+        return flight.result
+
+    def invalidate(self, group=None):
+        """
+        Drop the cached results and detach the running calls of a group, or of all
+        groups.
+        """
+
+        with self.lock:
+            for key in list(self.flights):
+                if group is None or self.flights[key].group == group:
+                    del self.flights[key]
+            for key in list(self.cache):
+                if group is None or self.cache[key][2] == group:
+                    del self.cache[key]
+
+
+class Flight(object):
+    """
+    A running call of SingleFlight.
+    """
+
+    __slots__ = ("group", "done", "result", "exception")
+
+    def __init__(self, group):
+        self.group = group
+        self.done = threading.Event()
+        self.result = None
+        self.exception = None
+
+
+class KeyLocks(object):
+    """
+    Locks of keys, e.g. the records of a collection that a request reads and writes.
+
+    The locks only serialize the threads of the process, the locks of the keys that
+    are not held are dropped.
+    """
+
+    def __init__(self):
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def hold(self, keys):
+        """
+        Hold the locks of the keys, acquired in sorted order so that callers holding
+        overlapping keys do not deadlock.
+        """
+
+        keys = sorted(set(keys))
+        with self.lock:
+            locks = []
+            for key in keys:
+                entry = self.locks.get(key)
+                if entry is None:
+                    entry = self.locks[key] = [threading.Lock(), 0]
+                entry[1] += 1
+                locks.append(entry[0])
+
+        acquired = []
+        try:
+            for lock in locks:
+                lock.acquire()
+                acquired.append(lock)
+            yield
+        finally:
+            for lock in reversed(acquired):
+                lock.release()
+            with self.lock:
+                for key in keys:
+                    entry = self.locks[key]
+                    entry[1] -= 1
+                    if not entry[1]:
+                        del self.locks[key]
+
+
+# sub-buckets per power of two of the latency histograms, the relative error of a
+# recorded latency is below 1 / 2 ** (HISTOGRAM_SUB_BUCKET_BITS - 1)
+HISTOGRAM_SUB_BUCKET_BITS = 6
+
+
+def histogram_bucket_index(value):
+    """
+    Get the bucket of a value: values below 2 ** HISTOGRAM_SUB_BUCKET_BITS have a
+    bucket each, larger values share buckets whose width doubles per power of two.
+
+    >>> [histogram_bucket_index(v) for v in (0, 63, 64, 65, 66, 128)]
+    [0, 63, 64, 64, 65, 96]
+    """
+
+    if value < 1 << HISTOGRAM_SUB_BUCKET_BITS:
+        return value
+    shift = value.bit_length() - HISTOGRAM_SUB_BUCKET_BITS
+    return (shift << (HISTOGRAM_SUB_BUCKET_BITS - 1)) + (value >> shift)
+
+
+def histogram_bucket_value(index):
+    """
+    Get the value in the middle of a bucket.
+
+    >>> [histogram_bucket_value(i) for i in (63, 64, 96)]
+    [63, 65, 130]
+    """
+
+    if index < 1 << HISTOGRAM_SUB_BUCKET_BITS:
+        return index
+    shift = (index >> (HISTOGRAM_SUB_BUCKET_BITS - 1)) - 1
+    lower = (index - (shift << (HISTOGRAM_SUB_BUCKET_BITS - 1))) << shift
+    return lower + ((1 << shift) >> 1)
+
+
+class LatencyHistogram(object):
+    """
+    Histogram of latencies in microseconds with log-linear buckets, in the manner of
+    HdrHistogram: the memory is bounded by the range of the values, not by their count.
+    """
+
+    __slots__ = ("counts", "count", "total", "max")
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, seconds):
+        """
+        Record a latency.
+        """
+
+        value = int(seconds * 1000000)
+        index = histogram_bucket_index(value)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, percentile):
+        """
+        Get the latency in microseconds at a percentile.
+        """
+
+        if not self.count:
+            return 0
+
+        target = max(1, int(round(self.count * percentile / 100.0)))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= target:
+                return min(histogram_bucket_value(index), self.max)
+        return self.max
+
+    def summary(self):
+        """
+        Summarize the histogram in milliseconds.
+        """
+
+        return {
+            "count": self.count,
+            "mean_ms": round(self.total / 1000.0 / self.count, 3) if self.count else 0,
+            "p50_ms": self.percentile(50) / 1000.0,
+            "p90_ms": self.percentile(90) / 1000.0,
+            "p99_ms": self.percentile(99) / 1000.0,
+            "max_ms": self.max / 1000.0,
+        }
+
+
+class RequestMetrics(object):
+    """
+    Latency histograms and counters of a handler, per route and phase.
+
+    The route of the request that is processed by a thread is kept in a thread local,
+    so phases can be recorded without passing the route around. Workers that run calls
+    of a request set the route of the request with route(). Phases recorded outside of
+    a request, e.g. by background threads, are accounted to "background".
+    """
+
+    def __init__(self, flush_interval=300):
+        self.flush_interval = flush_interval
+        self.routes = {}
+        self.started = time.time()
+        self.last_flush = time.monotonic()
+        self.current = threading.local()
+        self.lock = threading.Lock()
+
+    def begin(self, route_name):
+        """
+        Set the route of the request of the current thread.
+        """
+
+        self.current.route = route_name
+
+    @contextmanager
+    def route(self, route_name):
+        """
+        Account the phases recorded by the current thread to a route, e.g. in a worker
+        that runs a call of a request.
+        """
+
+        previous = getattr(self.current, "route", None)
+        self.current.route = route_name
+        try:
+            yield
+        finally:
+            self.current.route = previous
+
+    def end(self, response, seconds):
+        """
+        Account the response of the request of the current thread.
+        """
+
+        route_name = self.current_route()
+        self.current.route = None
+
+        status = response.get("status", 200) if isinstance(response, dict) else 500
+        if isinstance(status, (list, tuple)):
+            status = status[0]
+
+        with self.lock:
+            metrics = self.route_metrics(route_name)
+            metrics["requests"] += 1
+            if status >= 400:
+                metrics["errors"] += 1
+            metrics["phases"].setdefault("total", LatencyHistogram()).record(seconds)
+
+    def current_route(self):
+        """
+        Get the route of the request of the current thread.
+        """
+
+        return getattr(self.current, "route", None) or "background"
+
+    def route_metrics(self, route_name):
+        metrics = self.routes.get(route_name)
+        if metrics is None:
+            metrics = {"requests": 0, "errors": 0, "phases": {}}
+            self.routes[route_name] = metrics
+        return metrics
+
+    def record(self, phase, seconds, route_name=None):
+        """
+        Record the latency of a phase.
+        """
+
+        if route_name is None:
+            route_name = self.current_route()
+
+        with self.lock:
+            phases = self.route_metrics(route_name)["phases"]
+            histogram = phases.get(phase)
+            if histogram is None:
+                histogram = phases[phase] = LatencyHistogram()
+            histogram.record(seconds)
+
+    def summary(self):
+        """
+        Summarize the metrics of all routes.
+        """
+
+        with self.lock:
+            routes = {}
+            for route_name, metrics in self.routes.items():
+                routes[route_name] = {
+                    "requests": metrics["requests"],
+                    "errors": metrics["errors"],
+                    "phases": {
+                        phase: histogram.summary()
+                        for phase, histogram in metrics["phases"].items()
+                    },
+                }
+
+        elapsed = max(time.time() - self.started, 0.001)
+        for metrics in routes.values():
+            metrics["requests_per_second"] = round(metrics["requests"] / elapsed, 3)
+
+        return {"since": self.started, "routes": routes}
+
+    def flush_due(self):
+        """
+        Tell whether the periodic summary is due, at most one caller gets True.
+        """
+
+        now = time.monotonic()
+        with self.lock:
+            if now - self.last_flush < self.flush_interval:
+                return False
+            self.last_flush = now
+            return True
+
+
+def iter_ndjson(payload, codec=None):
+    """
+    Iterate the records of a newline-delimited JSON payload as (line number, record),
+    the record is a ValueError if the line is not a JSON object. Blank lines are
+    skipped.
+
+    >>> [(n, r) for n, r in iter_ndjson('{"a": 1}\\n\\n{"a": 2}')]
+    [(1, {'a': 1}), (3, {'a': 2})]
+    >>> [type(r).__name__ for n, r in iter_ndjson("[1]\\nx")]
+    ['ValueError', 'ValueError']
+    """
+
+    loads = codec.loads if codec is not None else json.loads
+
+    for line_number, line in enumerate(io.StringIO(payload or ""), 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = loads(line)
+        except Exception as e:
+            yield line_number, ValueError("invalid JSON: %s" % e)
+            continue
+        if not isinstance(record, dict):
+            yield line_number, ValueError("a JSON object is expected")
+            continue
+        yield line_number, record
+
+
+def negotiate_encoding(accept_encoding, encodings=("gzip", "deflate")):
+    """
+    Choose the content encoding of a response from the Accept-Encoding header of the
+    request: the accepted encoding with the highest quality, in the order of encodings
+    for equal qualities. Returns None if none is accepted.
+
+    >>> negotiate_encoding("gzip, deflate, br")
+    'gzip'
+    >>> negotiate_encoding("gzip;q=0.5, deflate")
+    'deflate'
+    >>> negotiate_encoding("gzip;q=0, *"), negotiate_encoding("identity")
+    ('deflate', None)
+    """
+
+    if not accept_encoding:
+        return None
+
+    qualities = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.partition(";")
+        quality = 1.0
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[name.strip().lower()] = quality
+
+    chosen = None
+    for encoding in encodings:
+        quality = qualities.get(encoding, qualities.get("*", 0.0))
+        if quality > 0 and (chosen is None or quality > chosen[1]):
+            chosen = (encoding, quality)
+
+    return chosen[0] if chosen is not None else None
+
+
+def compress_payload(payload, encoding, level=6, chunk_size=1048576):
+    """
+    Compress a payload with gzip or deflate (zlib format), feeding the compressor
+    chunk by chunk.
+
+    >>> payload = b"abc" * 1000
+    >>> zlib.decompress(compress_payload(payload, "gzip", chunk_size=100), 31) == payload
+    True
+    >>> zlib.decompress(compress_payload(payload, "deflate")) == payload
+    True
+    """
+
+    wbits = 31 if encoding == "gzip" else 15
+    compressor = zlib.compressobj(level, zlib.DEFLATED, wbits)
+
+    view = memoryview(payload)
+    parts = [
+        compressor.compress(view[start : start + chunk_size])
+        for start in range(0, len(view), chunk_size)
+    ]
+    parts.append(compressor.flush())
+
+    return b"".join(parts)
+
+
+def iter_chunks(iterable, size):
+    """
+    Iterate the items of an iterable in lists of size items.
+
+    >>> list(iter_chunks(range(5), 2))
+    [[0, 1], [2, 3], [4]]
+    """
+
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def pairs_to_dict(pairs):
+    """
+    Create a dictionary of a list of [key, value] pairs, the values of repeated keys are
+    collected in a list.
+
+    >>> pairs_to_dict([["a", "1"], ["b", "2"], ["a", "3"]])
+    {'a': ['1', '3'], 'b': '2'}
+    """
+
+    parameters = {}
+
+    for key, val in pairs:
+        # If the key is already in the list, but the existing entry isn't a list then make the
+        # existing entry a list and add thi one
+        if key in parameters and not isinstance(parameters[key], list):
+            parameters[key] = [parameters[key], val]
+
+        # If the entry is already included as a list, then just add the entry
+        elif key in parameters:
+            parameters[key].append(val)
+
+        # Otherwise, just add the entry
+        else:
+            parameters[key] = val
+
+    return parameters
+
+
+# marker of the lazy attributes of a request that were not computed yet
+NOT_COMPUTED = object()
+
+
+class RequestInfo(object):
+    """
+    This represents the request.
+
+    The attributes are read from the splunkd envelope when they are accessed, derived
+    values (the parsed rest uri, the query and form parameters and the decoded JSON
+    body) are computed on first access and memoized.
+    """
+
+    __slots__ = (
+        "raw_args",
+        "codec",
+        "method",
+        "path",
+        "_parsed_uri",
+        "_query",
+        "_query_parameters",
+        "_form_parameters",
+        "_json_body",
+        "_headers",
+    )
+
+    def __init__(self, raw_args, codec=None):
         self.raw_args = raw_args
+        self.codec = codec
+        self.method = raw_args["method"]
+        self.path = raw_args.get("path_info")
+        self._parsed_uri = NOT_COMPUTED
+        self._query = NOT_COMPUTED
+        self._query_parameters = NOT_COMPUTED
+        self._form_parameters = NOT_COMPUTED
+        self._json_body = NOT_COMPUTED
+        self._headers = NOT_COMPUTED
+
+    @property
+    def user(self):
+        return self.raw_args["session"]["user"]
+
+    @property
+    def payload(self):
+        # only available if passPayload = true
+        return self.raw_args.get("payload")
+
+    @property
+    def session_key(self):
+        return self.raw_args["session"]["authtoken"]
+
+    @property
+    def system_authtoken(self):
+        # only available if passSystemAuth = True
+        return self.raw_args.get("system_authtoken")
+
+    @property
+    def server_rest_uri(self):
+        return self.raw_args["server"]["rest_uri"]
+
+    @property
+    def parsed_uri(self):
+        if self._parsed_uri is NOT_COMPUTED:
+            self._parsed_uri = urlparse(self.server_rest_uri)
+        return self._parsed_uri
+
+    @property
+    def server_rest_host(self):
+        return self.parsed_uri.hostname
+
+    @property
+    def server_rest_port(self):
+        return self.parsed_uri.port
+
+    @property
+    def server_hostname(self):
+        return self.raw_args["server"]["hostname"]
+
+    @property
+    def server_servername(self):
+        return self.raw_args["server"]["servername"]
+
+    @property
+    def connection_src_ip(self):
+        return self.raw_args["connection"]["src_ip"]
+
+    @property
+    def connection_listening_port(self):
+        return self.raw_args["connection"]["listening_port"]
+
+    def header(self, name, default=None):
+        """
+        Get a header of the HTTP request, names are case insensitive. Headers are only
+        available if passHttpHeaders = true.
+        """
+
+        if self._headers is NOT_COMPUTED:
+            self._headers = {
+                header_name.lower(): value
+                for header_name, value in self.raw_args.get("headers") or []
+            }
+        return self._headers.get(name.lower(), default)
+
+    @property
+    def query_parameters(self):
+        """
+        The arguments passed on the URL.
+        """
+
+        if self._query_parameters is NOT_COMPUTED:
+            self._query_parameters = pairs_to_dict(self.raw_args.get("query") or [])
+        return self._query_parameters
+
+    @property
+    def form_parameters(self):
+        """
+        The arguments passed in the body of a POST/PUT.
+        """
+
+        if self._form_parameters is NOT_COMPUTED:
+            self._form_parameters = pairs_to_dict(self.raw_args.get("form") or [])
+        return self._form_parameters
+
+    @property
+    def query(self):
+        """
+        The arguments of the handler function, for a POST the form arguments are
+        applied to the query arguments.
+        """
+
+        if self._query is NOT_COMPUTED:
+            if self.method == "post":
+                query = dict(self.query_parameters)
+                for name, value in self.raw_args.get("form") or []:
+                    query[name] = value
+            else:
+                query = self.query_parameters
+            self._query = query
+        return self._query
+
+    @property
+    def json_body(self):
+        """
+        The payload decoded as JSON, None if there is no payload or it is not JSON.
+        """
+
+        if self._json_body is NOT_COMPUTED:
+            try:
+                if self.codec is not None:
+                    self._json_body = self.codec.loads(self.raw_args["payload"])
+                else:
+                    self._json_body = json.loads(self.raw_args["payload"])
+            except Exception:
+                self._json_body = None
+        return self._json_body
 
 
 class RESTHandler(PersistentServerConnectionApplication):
@@ -63,16 +1792,65 @@ class RESTHandler(PersistentServerConnectionApplication):
     If a POST request is made to the endpoint is executed with the path
     /lookup_edit/lookup_contents, the this class will attempt to execute post_lookup_contents().
 
+    Additional routes with path parameters can be registered with the @route decorator,
+    the route table of a handler class is built once when the class is created.
+
     The arguments to the function will be the following:
 
       * request_info (an instance of RequestInfo)
       * keyword arguments (**kwargs)
     """
 
+    # JSON codec of the requests and the rendered responses
+    codec = JSONCodec()
+
+    # workers of map_concurrent, and the concurrent calls per tenant
+    max_workers = 8
+    tenant_concurrency = 4
+
+    # seconds the results of coalesced reads are reused, 0 disables the micro-cache
+    single_flight_ttl = 0.25
+
+    # log file of the process in $SPLUNK_HOME/var/log/splunk, None keeps the logging
+    log_file = None
+
+    # payloads of at least compression_threshold bytes are compressed with the first
+    # of compression_encodings accepted by the client, None disables the compression
+    compression_threshold = 16384
+    compression_level = 6
+    compression_encodings = ("gzip", "deflate")
+
     def __init__(self, command_line, command_arg, logger=None):
         self.logger = logger
+        self.service_pool = ServicePool()
+        self.metrics = RequestMetrics()
+        if self.log_file is not None:
+            self.log_pipeline = LoggingPipeline.install(
+                self.log_file, route=self.metrics.current_route
+            )
+        else:
+            self.log_pipeline = None
+        self.executor = TenantExecutor(self.max_workers, self.tenant_concurrency)
+        self.single_flight = SingleFlight(self.single_flight_ttl)
+        self.audit_sink = AuditSink(self.flush_audit_records, logger=logger)
+        self.audit_id = uuid.uuid4().hex
+        self.audit_sequence = itertools.count(1)
+        self.audit_warned = False
+        self.loglevel_resolver = LogLevelResolver(self.resolve_loglevel, logger=logger)
         PersistentServerConnectionApplication.__init__(self)
 
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.route_table = RouteTable.build(cls)
+
+    @classmethod
+    def list_routes(cls):
+        """
+        List every route of the handler.
+        """
+
+        return sorted(cls.route_table.routes, key=lambda r: (r["path"], r["method"]))
+
     @classmethod
     def get_function_signature(cls, method, path):
         """
@@ -84,9 +1862,175 @@ class RESTHandler(PersistentServerConnectionApplication):
         else:
             return method
 
+    def get_service(self, request_info, owner="nobody", app=None):
+        """
+        Get a splunklib service for the session of the request, services are pooled and
+        reused by the following requests of the same session.
+        """
+
+        with self.timed("service"):
+            return self.service_pool.get(
+                request_info.session_key, request_info.server_rest_uri, owner, app
+            ).service
+
+    def get_kvstore_collection(
+        self, request_info, collection_name, owner="nobody", app=None
+    ):
+        """
+        Get a KV store collection for the session of the request.
+        """
+
+        with self.timed("service"):
+            return self.service_pool.get(
+                request_info.session_key, request_info.server_rest_uri, owner, app
+            ).kvstore_collection(collection_name)
+
+    def get_kvstore_batch_size(self, request_info, owner="nobody", app=None):
+        """
+        Get the maximum number of documents the KV store accepts per batch_save call.
+        """
+
+        with self.timed("service"):
+            return self.service_pool.get(
+                request_info.session_key, request_info.server_rest_uri, owner, app
+            ).max_documents_per_batch_save()
+
+    def resolve_loglevel(self, request_info):
+        """
+        Resolve the log level of the handler, None keeps the level of the logger.
+        """
+
+        return None
+
+    def apply_loglevel(self, request_info):
+        """
+        Set the cached log level on the logger of the handler.
+        """
+
+        if self.logger is None:
+            return
+
+        level = self.loglevel_resolver.get(request_info)
+        if isinstance(level, str):
+            level = logging.getLevelName(level.upper())
+        if isinstance(level, int) and self.logger.level != level:
+            self.logger.setLevel(level)
+
+    @route("post", "loglevel_invalidate")
+    def post_loglevel_invalidate(self, request_info, **kwargs):
+        """
+        Invalidate the cached log level, it is resolved again by the next request.
+        """
+
+        self.loglevel_resolver.invalidate()
+
+        return {"payload": {"action": "success"}, "status": 200}
+
+    def log_error(self, msg, *args):
+        """
+        Log an error with the arguments of its message, returns the message. The
+        arguments are not part of the message the repeated errors are limited on.
+
+        >>> RESTHandler.log_error(None, 'tenant_id="%s", failed', "t1")
+        'tenant_id="t1", failed'
+        """
+
+        logging.error(msg, *args)
+        return msg % args if args else msg
+
+    def audit(self, *record):
+        """
+        Queue an audit record, it is written by write_audit_records in the background.
+        """
+
+        key = f"{self.audit_id}-{next(self.audit_sequence)}"
+        return self.audit_sink.put(AuditRecord(record, key))
+
+    def write_audit_records(self, records):
+        """
+        Write a batch of audit records, to be implemented by handlers that audit.
+
+        A batch that failed is written again, handlers skip or overwrite the records
+        whose key was already written. The records are dropped by default.
+        """
+
+        if not self.audit_warned:
+            self.audit_warned = True
+            logging.warning(
+                'handler="%s" does not implement write_audit_records, audit records are dropped',
+                type(self).__name__,
+            )
+
+    def flush_audit_records(self, records):
+        """
+        Write a batch of audit records of the audit sink, measuring its latency.
+        """
+
+        with self.timed("audit"):
+            self.write_audit_records(records)
+
+    @contextmanager
+    def timed(self, phase):
+        """
+        Measure the latency of a phase of the current request, e.g. a KV store query.
+        """
+
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.metrics.record(phase, time.perf_counter() - started)
+
+    @route("get", "metrics")
+    def get_metrics(self, request_info, **kwargs):
+        """
+        Get the latency histograms and counters per route and phase.
+        """
+
+        response = self.metrics.summary()
+        response["audit"] = self.audit_sink.stats()
+        if self.log_pipeline is not None:
+            response["logging"] = self.log_pipeline.stats()
+
+        return self.render_json(response)
+
+    def log_metrics(self):
+        """
+        Log the summary of the metrics as one line, if the periodic summary is due.
+        """
+
+        if self.logger is not None and self.metrics.flush_due():
+            summary = dict(self.metrics.summary(), audit=self.audit_sink.stats())
+            if self.log_pipeline is not None:
+                summary["logging"] = self.log_pipeline.stats()
+            self.logger.info("rest_handler_metrics %s", self.codec.dumps(summary))
+
+    def map_concurrent(self, function, items, tenant_id=None):
+        """
+        Call the function for each item in the thread pool of the handler, the results
+        are returned in the order of the items.
+        """
+
+        # the workers record their phases in the route of the request
+        route_name = self.metrics.current_route()
+
+        def call(item):
+            with self.metrics.route(route_name):
+                return function(item)
+
+        return self.executor.map(call, items, tenant_id)
+
+    def done(self):
+        """
+        Write the buffered audit records when the persistent process is done.
+        """
+
+        self.executor.shutdown()
+        self.audit_sink.close()
+
     def render_json(self, data, response_code=200, headers=None):
         """
-        Render the data as JSON
+        Render the data as JSON, data that is already encoded is used as it is
         """
 
         combined_headers = {"Content-Type": "application/json"}
@@ -94,12 +2038,93 @@ class RESTHandler(PersistentServerConnectionApplication):
         if headers is not None:
             combined_headers.update(headers)
 
+        if isinstance(data, bytes):
+            payload = data.decode("utf-8")
+        elif isinstance(data, str):
+            payload = data
+        else:
+            with self.timed("serialize"):
+                payload = self.codec.dumps(data)
+
+        return {
+            "payload": payload,
+            "status": response_code,
+            "headers": combined_headers,
+        }
+
+    def render_ndjson(self, records, response_code=200, headers=None):
+        """
+        Render records as newline-delimited JSON.
+        """
+
+        combined_headers = {"Content-Type": "application/x-ndjson"}
+
+        if headers is not None:
+            combined_headers.update(headers)
+
+        with self.timed("serialize"):
+            payload = "".join(self.codec.dumps(record) + "\n" for record in records)
+
         return {
-            "payload": json.dumps(data),
+            "payload": payload,
             "status": response_code,
             "headers": combined_headers,
         }
 
+    def compress_response(self, request_info, response):
+        """
+        Compress the payload of a response with the encoding negotiated from the
+        Accept-Encoding header of the request, if it has at least compression_threshold
+        bytes. The compressed payload is returned base64-encoded in payload_base64.
+
+        Payloads returned as objects, that splunkd would serialize, are serialized with
+        the codec of the handler to be compressed.
+        """
+
+        if self.compression_threshold is None or not isinstance(response, dict):
+            return response
+
+        payload = response.get("payload")
+        if not isinstance(payload, (str, bytes, dict, list)):
+            return response
+
+        headers = response.get("headers")
+        if not (headers is None or isinstance(headers, dict)):
+            return response
+        if headers and any(name.lower() == "content-encoding" for name in headers):
+            return response
+
+        encoding = negotiate_encoding(
+            request_info.header("Accept-Encoding"), self.compression_encodings
+        )
+        if encoding is None:
+            return response
+
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        elif isinstance(payload, (dict, list)):
+            payload = self.codec.dumps_bytes(payload)
+            if not headers or not any(
+                name.lower() == "content-type" for name in headers
+            ):
+                headers = dict(headers or {}, **{"Content-Type": "application/json"})
+
+        if len(payload) < self.compression_threshold:
+            return response
+
+        with self.timed("compress"):
+            compressed = compress_payload(payload, encoding, self.compression_level)
+            payload_base64 = base64.b64encode(compressed).decode("ascii")
+
+        response = dict(response)
+        del response["payload"]
+        response["payload_base64"] = payload_base64
+        response["headers"] = dict(
+            headers or {}, **{"Content-Encoding": encoding, "Vary": "Accept-Encoding"}
+        )
+
+        return response
+
     def render_error_json(self, message, response_code=500):
         """
         Render an error to be returned to the client.
@@ -108,7 +2133,7 @@ class RESTHandler(PersistentServerConnectionApplication):
         data = {"success": False, "message": message}
 
         return {
-            "payload": json.dumps(data),
+            "payload": self.codec.dumps(data),
             "status": response_code,
             "headers": {"Content-Type": "application/json"},
         }
@@ -125,50 +2150,16 @@ class RESTHandler(PersistentServerConnectionApplication):
         return post_arg_dict
 
     def handle(self, in_string):
+        started = time.perf_counter()
+        response = None
+
         try:
             # log
             self.logger.debug("trackme_rest_handler, handling incoming request.")
 
             # Parse the arguments
             args = self.parse_in_string(in_string)
-
-            #
-            # user info - add to request_info
-            #
-
-            session_key = args["session"]["authtoken"]
-            user = args["session"]["user"]
-
-            #
-            # system auth
-            #
-
-            # If passSystemAuth = True, add system_authtoken
-            try:
-                system_authtoken = args["system_authtoken"]
-            except Exception as e:
-                system_authtoken = None
-
-            #
-            # server info
-            #
-
-            server_rest_uri = args["server"]["rest_uri"]
-
-            # extract rest host and port
-            parsed_uri = urlparse(server_rest_uri)
-            server_rest_host = parsed_uri.hostname
-            server_rest_port = parsed_uri.port
-
-            server_hostname = args["server"]["hostname"]
-            server_servername = args["server"]["servername"]
-
-            #
-            # connection info
-            #
-
-            connection_src_ip = args["connection"]["src_ip"]
-            connection_listening_port = args["connection"]["listening_port"]
+            parsed = time.perf_counter()
 
             #
             # http method
@@ -181,109 +2172,467 @@ class RESTHandler(PersistentServerConnectionApplication):
             if "path_info" in args:
                 path = args["path_info"]
             else:
-                return {"payload": "No path was provided", "status": 403}
-
-            if method.lower() == "post":
-                # Load the parameters from the query
-                query = args["query_parameters"]
+                self.metrics.begin("no_path")
+                response = {"payload": "No path was provided", "status": 403}
+                return response
 
-                if query is None:
-                    query = {}
+            # Resolve the function from the route table
+            resolved = self.route_table.resolve(method, path)
 
-                # Apply the ones (if any) we got from the form
-                query_form = self.get_forms_args_as_dict(args["form"])
-
-                if query_form is not None:
-                    query.update(query_form)
-            else:
-                query = args["query_parameters"]
-
-            #
-            # finally add to the request_info
-            #
+            # Try to run the function
+            if resolved is not None:
+                function_name, path_params = resolved
+                function_to_call = getattr(self, function_name)
 
-            # Make the request info object
-            request_info = RequestInfo(
-                user,
-                session_key,
-                system_authtoken,
-                server_rest_uri,
-                server_rest_host,
-                server_rest_port,
-                server_hostname,
-                server_servername,
-                connection_src_ip,
-                connection_listening_port,
-                method,
-                path,
-                query,
-                args,
-            )
+                self.metrics.begin(function_name)
+                self.metrics.record("parse", parsed - started)
+                self.metrics.record("route", time.perf_counter() - parsed)
 
-            # Get the function signature
-            function_name = self.get_function_signature(method, path)
+                # Make the request info object, its attributes are computed on access
+                request_info = RequestInfo(args, self.codec)
 
-            try:
-                function_to_call = getattr(self, function_name)
-            except AttributeError:
-                function_to_call = None
+                # set the log level of the handler
+                self.apply_loglevel(request_info)
 
-            # Try to run the function
-            if function_to_call is not None:
                 if self.logger is not None:
                     self.logger.debug("Executing function, name=%s", function_name)
 
+                query = request_info.query
+
+                # path parameters take precedence over query and form arguments
+                if path_params:
+                    query = dict(query, **path_params)
+
                 # Execute the function
-                return function_to_call(request_info, **query)
+                with self.timed("handler"):
+                    response = self.call_route(function_to_call, request_info, query)
+
+                # Compress the payload if the client accepts it
+                response = self.compress_response(request_info, response)
+                return response
             else:
+                self.metrics.begin("not_found")
+
                 if self.logger is not None:
                     self.logger.warn(
                         "A request could not be executed since the associated function "
                         + "is missing, name=%s",
-                        function_name,
+                        self.get_function_signature(method, path),
                     )
 
-                return {"payload": "Path was not found", "status": 404}
+                response = {"payload": "Path was not found", "status": 404}
+                return response
         except Exception as exception:
             if self.logger is not None:
                 self.logger.exception(
                     "Failed to handle request due to an unhandled exception"
                 )
 
-            return {"payload": str(exception), "status": 500}
+            response = {"payload": str(exception), "status": 500}
+            return response
+        finally:
+            self.metrics.end(response, time.perf_counter() - started)
+            self.log_metrics()
+
+    def call_route(self, function, request_info, query):
+        """
+        Call the function of the resolved route.
+        """
+
+        return function(request_info, **query)
 
     def convert_to_dict(self, query):
         """
         Create a dictionary containing the parameters.
         """
-        parameters = {}
 
-        for key, val in query:
-            # If the key is already in the list, but the existing entry isn't a list then make the
-            # existing entry a list and add thi one
-            if key in parameters and not isinstance(parameters[key], list):
-                parameters[key] = [parameters[key], val]
+        return pairs_to_dict(query)
+
+    def parse_in_string(self, in_string):
+        """
+        Parse the in_string
+        """
+
+        params = self.codec.loads(in_string)
+
+        params["method"] = params["method"].lower()
+
+        return params
+
+
+class EventLoopThread(object):
+    """
+    An asyncio event loop that runs in a daemon thread for the lifetime of the
+    persistent process, coroutines are submitted from the request threads.
+    """
+
+    def __init__(self, name="rest_handler_loop"):
+        self.name = name
+        self.loop = None
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        """
+        Start the loop, if it is not running yet.
+        """
+
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                self.thread = threading.Thread(
+                    target=self.loop.run_forever, name=self.name, daemon=True
+                )
+                self.thread.start()
+            return self.loop
+
+    def run(self, coroutine, timeout=None):
+        """
+        Run a coroutine in the loop and wait for its result.
+        """
+
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.start())
+        try:
+            return future.result(timeout)
+        except BaseException:
+            future.cancel()
+            raise
+
+    def call_soon(self, callback, *args):
+        """
+        Schedule a callback in the loop, e.g. to release resources owned by the loop.
+        """
+
+        self.start().call_soon_threadsafe(callback, *args)
+
+    def close(self):
+        with self.lock:
+            loop, thread = self.loop, self.thread
+            self.loop = self.thread = None
+        if loop is not None:
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+
+
+class AsyncHTTPError(Exception):
+    """
+    Raised by AsyncSplunkdClient when splunkd answers with an error status.
+    """
+
+    def __init__(self, status, reason, body):
+        super(AsyncHTTPError, self).__init__(
+            "HTTP %d %s -- %s" % (status, reason, body[:512].decode("utf-8", "replace"))
+        )
+        self.status = status
+        self.reason = reason
+        self.body = body
+
+
+async def gather_limited(coroutines, limit, return_exceptions=False):
+    """
+    Await the coroutines with at most limit of them running at a time, the results
+    are returned in the order of the coroutines.
+    """
+
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(coroutine):
+        async with semaphore:
+            return await coroutine
+
+    return await asyncio.gather(
+        *[run(coroutine) for coroutine in coroutines],
+        return_exceptions=return_exceptions,
+    )
+
+
+class AsyncSplunkdClient(object):
+    """
+    Minimal HTTP/1.1 client of the splunkd REST API on asyncio streams.
+
+    Connections are kept alive and reused by the requests of the client, the client
+    must only be used by coroutines of one event loop.
+    """
 
-            # If the entry is already included as a list, then just add the entry
-            elif key in parameters:
-                parameters[key].append(val)
+    def __init__(self, rest_uri, token, max_idle=8, timeout=300, verify=False):
+        parsed_uri = urlparse(rest_uri)
+        self.scheme = parsed_uri.scheme
+        self.host = parsed_uri.hostname
+        self.port = parsed_uri.port
+        self.token = token if token.startswith("Splunk ") else "Splunk %s" % token
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.verify = verify
+        self.idle = []
+
+    async def connect(self):
+        """
+        Open a new connection.
+        """
 
-            # Otherwise, just add the entry
+        if self.scheme == "https":
+            if self.verify:
+                context = ssl.create_default_context()
             else:
-                parameters[key] = val
+                context = ssl._create_unverified_context()
+        elif self.scheme == "http":
+            context = None
+        else:
+            raise ValueError("unsupported scheme: %s" % self.scheme)
 
-        return parameters
+        return await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, ssl=context), self.timeout
+        )
 
-    def parse_in_string(self, in_string):
+    async def request(self, method, path, params=None, body=None, headers=None):
         """
-        Parse the in_string
+        Issue a request, returns the status, the headers and the body of the response.
+
+        Error statuses are returned as well, use call() to raise them.
         """
 
-        params = json.loads(in_string)
+        if params:
+            path += "?" + urlencode(params)
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        body = body or b""
+
+        head = [
+            "%s %s HTTP/1.1" % (method.upper(), path),
+            "Host: %s:%s" % (self.host, self.port),
+            "Authorization: %s" % self.token,
+            "User-Agent: splunk-sdk-python",
+            "Accept: */*",
+            "Connection: keep-alive",
+            "Content-Length: %d" % len(body),
+        ]
+        for key, value in (headers or {}).items():
+            head.append("%s: %s" % (key, value))
+        message = ("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body
+
+        connection = self.idle.pop() if self.idle else None
+        reused = connection is not None
+        if connection is None:
+            connection = await self.connect()
 
-        params["method"] = params["method"].lower()
+        try:
+            response = await asyncio.wait_for(
+                self.exchange(connection, message), self.timeout
+            )
+        except (ConnectionError, asyncio.IncompleteReadError):
+            connection[1].close()
+            if not reused:
+                raise
+
+            # splunkd closed the idle connection meanwhile, retry on a new one
+            connection = await self.connect()
+            response = await asyncio.wait_for(
+                self.exchange(connection, message), self.timeout
+            )
+        except BaseException:
+            connection[1].close()
+            raise
+
+        status, reason, response_headers, data = response
+        if (
+            response_headers.get("connection", "").lower() == "close"
+            or len(self.idle) >= self.max_idle
+        ):
+            connection[1].close()
+        else:
+            self.idle.append(connection)
 
-        params["form_parameters"] = self.convert_to_dict(params.get("form", []))
-        params["query_parameters"] = self.convert_to_dict(params.get("query", []))
+        return status, reason, response_headers, data
 
-        return params
+    async def exchange(self, connection, message):
+        """
+        Write a request and read its response, the body is read by its Content-Length
+        or its chunks.
+        """
+
+        reader, writer = connection
+        writer.write(message)
+        await writer.drain()
+
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError("connection closed by splunkd")
+        _, status, reason = status_line.decode("latin-1").rstrip("\r\n").split(" ", 2)
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            key, _, value = line.decode("latin-1").partition(":")
+            headers[key.strip().lower()] = value.strip()
+
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b";")[0].strip(), 16)
+                if size == 0:
+                    # trailers end with an empty line
+                    while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            data = b"".join(chunks)
+        else:
+            data = await reader.readexactly(int(headers.get("content-length", 0)))
+
+        return int(status), reason, headers, data
+
+    async def call(self, method, path, params=None, body=None, headers=None):
+        """
+        Issue a request, returns the body decoded as JSON and raises AsyncHTTPError on
+        error statuses.
+        """
+
+        params = dict(params or {}, output_mode="json")
+        status, reason, _, data = await self.request(
+            method, path, params, body, headers
+        )
+        if status >= 400:
+            raise AsyncHTTPError(status, reason, data)
+        return json.loads(data) if data else None
+
+    def kvstore_path(self, collection_name, owner, app, *segments):
+        return "/servicesNS/%s/%s/storage/collections/data/%s" % (
+            quote(owner, safe=""),
+            quote(app, safe=""),
+            "/".join(quote(part, safe="") for part in (collection_name,) + segments),
+        )
+
+    async def kvstore_query(
+        self, collection_name, owner="nobody", app="search", query=None, **params
+    ):
+        """
+        Query the records of a KV store collection, params are skip, limit, sort and
+        fields.
+        """
+
+        if query is not None:
+            params["query"] = json.dumps(query)
+        if isinstance(params.get("fields"), (list, tuple)):
+            params["fields"] = ",".join(params["fields"])
+        return await self.call(
+            "GET", self.kvstore_path(collection_name, owner, app), params
+        )
+
+    async def kvstore_batch_save(
+        self, collection_name, documents, owner="nobody", app="search"
+    ):
+        """
+        Insert or update documents with one batch_save call, returns their _key.
+        """
+
+        return await self.call(
+            "POST",
+            self.kvstore_path(collection_name, owner, app, "batch_save"),
+            body=json.dumps(documents),
+            headers={"Content-Type": "application/json"},
+        )
+
+    async def kvstore_delete(
+        self, collection_name, owner="nobody", app="search", key=None, query=None
+    ):
+        """
+        Delete a record by its _key, or the records that match the query.
+        """
+
+        segments = () if key is None else (key,)
+        params = {} if query is None else {"query": json.dumps(query)}
+        return await self.call(
+            "DELETE", self.kvstore_path(collection_name, owner, app, *segments), params
+        )
+
+    def close(self):
+        while self.idle:
+            self.idle.pop()[1].close()
+
+
+class AsyncRESTHandler(RESTHandler):
+    """
+    A REST handler whose functions may be coroutines, e.g. async def post_ack_manage().
+
+    Coroutines run in an event loop that lives as long as the persistent process, the
+    request thread waits for their result, so handle() still returns the response
+    dict. Synchronous functions are called as with RESTHandler.
+
+    async_client_for() gives the coroutines a keep-alive splunkd client of the
+    session, and gather_limited() runs coroutines with a concurrency limit.
+    """
+
+    # seconds a request waits for its coroutine
+    coroutine_timeout = 300
+
+    # number of cached clients, one per session key and splunkd
+    max_async_clients = 64
+
+    def __init__(self, command_line, command_arg, logger=None):
+        super(AsyncRESTHandler, self).__init__(command_line, command_arg, logger)
+        self.event_loop = EventLoopThread()
+        self.async_clients = OrderedDict()
+        self.async_clients_lock = threading.Lock()
+
+    def call_route(self, function, request_info, query):
+        """
+        Call the function of the resolved route, coroutines are run in the event loop.
+        """
+
+        if asyncio.iscoroutinefunction(function):
+            return self.event_loop.run(
+                function(request_info, **query), self.coroutine_timeout
+            )
+        return function(request_info, **query)
+
+    def async_client_for(self, request_info, system=False):
+        """
+        Get the splunkd client of the session of the request, or of the system session,
+        to be called by the coroutines of the event loop.
+        """
+
+        if system:
+            token = request_info.system_authtoken
+        else:
+            token = request_info.session_key
+        key = (token, request_info.server_rest_uri)
+        evicted = []
+
+        with self.async_clients_lock:
+            async_client = self.async_clients.get(key)
+            if async_client is None:
+                async_client = AsyncSplunkdClient(request_info.server_rest_uri, token)
+                self.async_clients[key] = async_client
+                while len(self.async_clients) > self.max_async_clients:
+                    evicted.append(self.async_clients.popitem(last=False)[1])
+            self.async_clients.move_to_end(key)
+
+        # the connections of the evicted clients are closed by the event loop
+        for evicted_client in evicted:
+            self.event_loop.call_soon(evicted_client.close)
+
+        return async_client
+
+    def done(self):
+        """
+        Stop the event loop when the persistent process is done.
+        """
+
+        super(AsyncRESTHandler, self).done()
+        if self.event_loop.loop is not None:
+            self.event_loop.run(self.close_async_clients())
+        self.event_loop.close()
+
+    async def close_async_clients(self):
+        with self.async_clients_lock:
+            async_clients = list(self.async_clients.values())
+            self.async_clients.clear()
+        for async_client in async_clients:
+            async_client.close()
+
+
+RESTHandler.route_table = RouteTable.build(RESTHandler)
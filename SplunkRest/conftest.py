@@ -1,6 +1,8 @@
 # configure include paths that are needed for execution of doctest unit tests of the project
+import json
 import os
 import sys
+import threading
 
 _app_path = os.path.abspath(os.path.dirname(__file__))
 _bin_path = os.path.join(_app_path, "bin")
@@ -21,3 +23,209 @@ def app_path():
 @pytest.fixture(scope="session")
 def app():
     return os.path.basename(_app_path)
+
+
+def kv_comparable(value, operand):
+    """
+    Make a value and an operand of a KV store query comparable, numbers are compared
+    as numbers and other values as strings.
+    """
+
+    if not isinstance(value, bool) and not isinstance(operand, bool):
+        try:
+            return float(value), float(operand)
+        except (TypeError, ValueError):
+            pass
+    return str(value), str(operand)
+
+
+KV_COMPARISONS = {
+    "$gt": lambda value, operand: value > operand,
+    "$gte": lambda value, operand: value >= operand,
+    "$lt": lambda value, operand: value < operand,
+    "$lte": lambda value, operand: value <= operand,
+}
+
+
+def kv_query_matches(record, query):
+    """
+    Evaluate the subset of the KV store query language used by the handlers.
+    """
+
+    for field, condition in query.items():
+        if field == "$and":
+            if not all(kv_query_matches(record, sub_query) for sub_query in condition):
+                return False
+        elif field == "$or":
+            if not any(kv_query_matches(record, sub_query) for sub_query in condition):
+                return False
+        elif isinstance(condition, dict):
+            value = record.get(field)
+            for operator, operand in condition.items():
+                if operator == "$in":
+                    if value not in operand:
+                        return False
+                elif operator == "$nin":
+                    if value in operand:
+                        return False
+                elif operator == "$ne":
+                    if value == operand:
+                        return False
+                elif operator not in KV_COMPARISONS:
+                    raise ValueError(f"operator {operator} is not supported")
+                elif value is None or not KV_COMPARISONS[operator](
+                    *kv_comparable(value, operand)
+                ):
+                    return False
+        elif record.get(field) != condition:
+            return False
+    return True
+
+
+def compile_kv_query(query):
+    """
+    Compile a query to a predicate, an $or of equalities on one field is evaluated as
+    a set lookup to keep the fake fast for large object lists.
+    """
+
+    sub_queries = query.get("$or") if len(query) == 1 else None
+    if sub_queries and all(len(sub_query) == 1 for sub_query in sub_queries):
+        fields = {field for sub_query in sub_queries for field in sub_query}
+        values = [value for sub_query in sub_queries for value in sub_query.values()]
+        if len(fields) == 1 and not any(isinstance(v, dict) for v in values):
+            field = fields.pop()
+            values = set(values)
+            return lambda record: record.get(field) in values
+
+    if "$and" in query and len(query) == 1:
+        predicates = [compile_kv_query(sub_query) for sub_query in query["$and"]]
+        return lambda record: all(predicate(record) for predicate in predicates)
+
+    return lambda record: kv_query_matches(record, query)
+
+
+def kv_sort_key(value):
+    """
+    Order the values of a sorted field: missing values, numbers, then strings.
+    """
+
+    if value is None:
+        return (0, 0.0, "")
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return (1, float(value), "")
+    return (2, 0.0, str(value))
+
+
+class FakeCollectionData(object):
+    """
+    In-memory stand-in of the data endpoint of a KV store collection, the calls it
+    received are kept in queries, batches and deletes.
+
+    Like the KV store, a batch_save call stops at the first document for which
+    reject(document) is true, the documents before it are saved.
+    """
+
+    def __init__(self, records=()):
+        self.records = {}
+        self.queries = []
+        self.batches = []
+        self.deletes = []
+        self.reject = None
+        self.lock = threading.RLock()
+        for record in records:
+            self.save(record)
+
+    def query(self, query=None, skip=0, limit=0, sort=None, fields=None, **kwargs):
+        parsed_query = json.loads(query) if query else {}
+        skip, limit = int(skip), int(limit)
+
+        with self.lock:
+            self.queries.append(
+                {
+                    "query": parsed_query,
+                    "skip": skip,
+                    "limit": limit,
+                    "sort": sort,
+                    "fields": fields,
+                }
+            )
+            predicate = compile_kv_query(parsed_query)
+            records = [dict(r) for r in self.records.values() if predicate(r)]
+
+        if sort:
+            for sort_key in reversed(sort.split(",")):
+                field, _, direction = sort_key.partition(":")
+                records.sort(
+                    key=lambda record: kv_sort_key(record.get(field)),
+                    reverse=direction == "-1",
+                )
+
+        records = records[skip : skip + limit] if limit else records[skip:]
+
+        # like the KV store, _key is returned with the projected fields and _user with
+        # the whole records
+        if fields:
+            fields = ["_key"] + [f for f in fields.split(",") if f != "_key"]
+            return [{f: r[f] for f in fields if f in r} for r in records]
+        return [dict(r, _user="nobody") for r in records]
+
+    def save(self, document, key=None):
+        """
+        Insert or replace a document, returns its _key.
+        """
+
+        document = {f: v for f, v in document.items() if f != "_user"}
+
+        with self.lock:
+            if key is not None:
+                document["_key"] = key
+            elif not document.get("_key"):
+                number = len(self.records)
+                while "k%d" % number in self.records:
+                    number += 1
+                document["_key"] = "k%d" % number
+            self.records[document["_key"]] = document
+
+        return document["_key"]
+
+    def batch_save(self, *documents):
+        with self.lock:
+            self.batches.append([dict(document) for document in documents])
+        keys = []
+        for document in documents:
+            if self.reject is not None and self.reject(document):
+                raise ValueError("batch rejected")
+            keys.append(self.save(document))
+        return keys
+
+    def delete(self, query=None):
+        parsed_query = json.loads(query) if query else {}
+
+        with self.lock:
+            self.deletes.append(parsed_query)
+            predicate = compile_kv_query(parsed_query)
+            for key in [k for k, r in self.records.items() if predicate(r)]:
+                del self.records[key]
+
+    def delete_by_id(self, key):
+        with self.lock:
+            self.deletes.append({"_key": key})
+            self.records.pop(key, None)
+
+
+class FakeCollection(object):
+    """
+    In-memory stand-in of a KV store collection of splunklib.
+    """
+
+    def __init__(self, records=()):
+        self.data = FakeCollectionData(records)
+
+
+@pytest.fixture(scope="session")
+def fake_collection():
+    """
+    The in-memory KV store collection of the tests, FakeCollection(records).
+    """
+
+    return FakeCollection
@@ -0,0 +1,231 @@
+import json
+import time
+
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+pytest.importorskip("splunk.persistconn.application")
+
+import z_rest_handler  # noqa: E402
+from z_ack_libs import ACK_KEYS_MIGRATED_KEY, ack_record_key  # noqa: E402
+
+TENANT_ID = "bench"
+OBJECT_CATEGORY = "splk-dsm"
+ACK_COLLECTION = f"kv_trackme_common_alerts_ack_tenant_{TENANT_ID}"
+DATA_COLLECTION = f"kv_trackme_dsm_tenant_{TENANT_ID}"
+
+# number of objects per request and the number of measured requests
+SIZES = [1, 100, 1000, 10000]
+ROUNDS = {1: 50, 100: 30, 1000: 10, 10000: 3}
+
+
+@pytest.fixture(scope="module")
+def handler_class(ack_handler_class):
+    class BenchmarkAckHandler(ack_handler_class):
+        # measure the reads, not the micro-cache of repeated identical reads
+        single_flight_ttl = 0
+
+    return BenchmarkAckHandler
+
+
+@pytest.fixture
+def handler(handler_class):
+    handler = handler_class(None, None)
+    yield handler
+    handler.done()
+
+
+def object_names(count):
+    return [f"netscreen:netscreen:firewall{number:05d}" for number in range(count)]
+
+
+def ack_records(count, ack_state="active"):
+    now = time.time()
+    return [
+        {
+            "_key": ack_record_key(OBJECT_CATEGORY, object_value),
+            "object": object_value,
+            "object_category": OBJECT_CATEGORY,
+            "anomaly_reason": "lag_threshold_breached",
+            "ack_source": "user_ack",
+            "ack_expiration": now + 86400,
+            "ack_state": ack_state,
+            "ack_mtime": now,
+            "ack_type": "unsticky",
+            "ack_comment": "Under review",
+        }
+        for object_value in object_names(count)
+    ]
+
+
+def stored_ack_count(fake_splunkd):
+    # the marker of the key migration is not an ack record
+    records = fake_splunkd.kvstore.collection(ACK_COLLECTION).records
+    return len(records) - (ACK_KEYS_MIGRATED_KEY in records)
+
+
+def run_benchmark(benchmark, fake_splunkd, handler, request, route_name, size):
+    """
+    Benchmark a request after one warm-up request, and report the latency percentiles
+    of the handler and the calls to splunkd per request.
+    """
+
+    kvstore = fake_splunkd.kvstore
+    rounds = ROUNDS[size]
+
+    response = handler.handle(request)
+    assert response["status"] == 200, response["payload"][:1000]
+
+    kvstore.reset_calls()
+    handler.metrics = z_rest_handler.RequestMetrics()
+
+    response = benchmark.pedantic(
+        handler.handle, args=(request,), rounds=rounds, iterations=1
+    )
+    assert response["status"] == 200, response["payload"][:1000]
+
+    total = handler.metrics.routes[route_name]["phases"]["total"]
+    benchmark.extra_info.update(
+        {
+            "objects": size,
+            "requests_per_second": round(total.count / (total.total / 1000000.0), 3),
+            "p50_ms": total.percentile(50) / 1000.0,
+            "p99_ms": total.percentile(99) / 1000.0,
+            "splunkd_calls_per_request": {
+                call: count / float(rounds) for call, count in kvstore.calls.items()
+            },
+        }
+    )
+
+    if response["headers"]["Content-Type"] == "application/x-ndjson":
+        return [json.loads(line) for line in response["payload"].splitlines()]
+    return json.loads(response["payload"])
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_ack_manage_show(benchmark, fake_splunkd, make_request, handler, size):
+    fake_splunkd.kvstore.load(ACK_COLLECTION, ack_records(size))
+    request = make_request(
+        "POST",
+        "ack_manage",
+        {
+            "tenant_id": TENANT_ID,
+            "action": "show",
+            "object_category": OBJECT_CATEGORY,
+            "object_list": ",".join(object_names(size)),
+        },
+    )
+
+    result = run_benchmark(
+        benchmark, fake_splunkd, handler, request, "post_ack_manage", size
+    )
+
+    assert result["process_count"] == size
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_ack_manage_enable(benchmark, fake_splunkd, make_request, handler, size):
+    fake_splunkd.kvstore.load(ACK_COLLECTION, [])
+    fake_splunkd.kvstore.load(
+        DATA_COLLECTION,
+        [
+            {"object": object_value, "anomaly_reason": "lag_threshold_breached"}
+            for object_value in object_names(size)
+        ],
+    )
+    request = make_request(
+        "POST",
+        "ack_manage",
+        {
+            "tenant_id": TENANT_ID,
+            "action": "enable",
+            "object_category": OBJECT_CATEGORY,
+            "object_list": ",".join(object_names(size)),
+            "ack_period": 86400,
+            "ack_comment": "Under review",
+        },
+    )
+
+    result = run_benchmark(
+        benchmark, fake_splunkd, handler, request, "post_ack_manage", size
+    )
+
+    assert result["success_count"] == size
+    assert stored_ack_count(fake_splunkd) == size
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_ack_manage_disable(benchmark, fake_splunkd, make_request, handler, size):
+    fake_splunkd.kvstore.load(ACK_COLLECTION, ack_records(size))
+    request = make_request(
+        "POST",
+        "ack_manage",
+        {
+            "tenant_id": TENANT_ID,
+            "action": "disable",
+            "object_category": OBJECT_CATEGORY,
+            "object_list": ",".join(object_names(size)),
+        },
+    )
+
+    result = run_benchmark(
+        benchmark, fake_splunkd, handler, request, "post_ack_manage", size
+    )
+
+    assert result["success_count"] == size
+    assert stored_ack_count(fake_splunkd) == size
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_get_ack_for_object_all(benchmark, fake_splunkd, make_request, handler, size):
+    fake_splunkd.kvstore.load(ACK_COLLECTION, ack_records(size))
+    request = make_request(
+        "POST",
+        "get_ack_for_object",
+        {
+            "tenant_id": TENANT_ID,
+            "object_category": OBJECT_CATEGORY,
+            "object_list": "*",
+        },
+    )
+
+    result = run_benchmark(
+        benchmark, fake_splunkd, handler, request, "post_get_ack_for_object", size
+    )
+
+    assert len(result) == size
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_ack_import(benchmark, fake_splunkd, make_request, handler, size):
+    fake_splunkd.kvstore.load(ACK_COLLECTION, ack_records(size // 2))
+    request = make_request(
+        "POST",
+        "ack_import",
+        "\n".join(json.dumps(record) for record in ack_records(size)),
+        query={"tenant_id": TENANT_ID},
+    )
+
+    results = run_benchmark(
+        benchmark, fake_splunkd, handler, request, "post_ack_import", size
+    )
+
+    # the records are updated by (object_category, object), imports can be repeated
+    assert [result["result"] for result in results] == ["success"] * size
+    assert stored_ack_count(fake_splunkd) == size
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_ack_export(benchmark, fake_splunkd, make_request, handler, size):
+    fake_splunkd.kvstore.load(ACK_COLLECTION, ack_records(size))
+    request = make_request(
+        "GET",
+        "ack_export",
+        query={"tenant_id": TENANT_ID, "object_category": OBJECT_CATEGORY},
+    )
+
+    records = run_benchmark(
+        benchmark, fake_splunkd, handler, request, "get_ack_export", size
+    )
+
+    assert len(records) == size
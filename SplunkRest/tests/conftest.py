@@ -0,0 +1,380 @@
+# in-process stand-in for the splunkd REST API of the KV store, used by the functional tests
+# and the benchmarks
+import importlib
+import json
+import os
+import sys
+import threading
+import time
+import types
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, unquote, urlsplit
+
+import pytest
+
+
+def install_trackme_libs_stubs():
+    """
+    Install stand-ins of the trackme libs the ack handler imports, they are part of
+    the TrackMe app and not of this repository. The log level is fixed and the audit
+    records are dropped, the offline ack handler overrides both anyway.
+    """
+
+    trackme_libs = types.ModuleType("trackme_libs")
+    trackme_libs.trackme_getloglevel = lambda system_authtoken, splunkd_port: "INFO"
+    trackme_libs.trackme_audit_event = lambda *record: None
+
+    def convert_epoch_to_datetime(epoch):
+        try:
+            return time.strftime("%d %b %Y %H:%M:%S", time.gmtime(float(epoch)))
+        except (TypeError, ValueError, OverflowError):
+            return "N/A"
+
+    trackme_libs_ack = types.ModuleType("trackme_libs_ack")
+    trackme_libs_ack.convert_epoch_to_datetime = convert_epoch_to_datetime
+
+    sys.modules.setdefault("trackme_libs", trackme_libs)
+    sys.modules.setdefault("trackme_libs_ack", trackme_libs_ack)
+
+
+install_trackme_libs_stubs()
+
+ATOM_FEED = """<?xml version="1.0" encoding="UTF-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom" xmlns:s="http://dev.splunk.com/ns/rest">
+  <title>{title}</title>
+  <id>{base}{path}</id>
+  <updated>2024-01-01T00:00:00+00:00</updated>
+  <entry>
+    <title>{name}</title>
+    <id>{base}{path}</id>
+    <updated>2024-01-01T00:00:00+00:00</updated>
+    <link href="{path}" rel="alternate"/>
+    <content type="text/xml">
+      <s:dict>
+        {content}
+        <s:key name="eai:acl">
+          <s:dict>
+            <s:key name="app">{app}</s:key>
+            <s:key name="owner">{owner}</s:key>
+            <s:key name="sharing">app</s:key>
+          </s:dict>
+        </s:key>
+      </s:dict>
+    </content>
+  </entry>
+</feed>
+"""
+
+
+class FakeKVStore(object):
+    """
+    The collections of the fake splunkd, FakeCollectionData of the tests, with the
+    call counters and the injected latency.
+    """
+
+    def __init__(
+        self, collection_class, latency=0.0, max_documents_per_batch_save=1000
+    ):
+        self.collection_class = collection_class
+        self.latency = latency
+        self.max_documents_per_batch_save = max_documents_per_batch_save
+        self.collections = {}
+        self.calls = Counter()
+        self.lock = threading.Lock()
+
+        # the session keys allowed to access a collection, all if not set
+        self.acls = {}
+
+    def collection(self, name):
+        with self.lock:
+            collection = self.collections.get(name)
+            if collection is None:
+                collection = self.collections[name] = self.collection_class().data
+            return collection
+
+    def load(self, name, records):
+        """
+        Replace the records of a collection.
+        """
+
+        collection = self.collection_class(records).data
+        with self.lock:
+            self.collections[name] = collection
+
+    def allowed(self, name, token):
+        """
+        Tell whether a session key can access the records of a collection.
+        """
+
+        with self.lock:
+            tokens = self.acls.get(name)
+        return tokens is None or token in tokens
+
+    def reset_calls(self):
+        with self.lock:
+            self.calls.clear()
+
+    def count(self, call):
+        with self.lock:
+            self.calls[call] += 1
+
+    def query(self, name, params):
+        return self.collection(name).query(
+            **{
+                param: params[param]
+                for param in ("query", "skip", "limit", "sort", "fields")
+                if params.get(param)
+            }
+        )
+
+    def delete(self, name, key=None, params=None):
+        collection = self.collection(name)
+        if key is not None:
+            collection.delete_by_id(key)
+        else:
+            collection.delete((params or {}).get("query"))
+
+
+class FakeSplunkdRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    # headers and body are sent separately, without TCP_NODELAY the body waits for
+    # the delayed ACK of the client
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_POST(self):
+        self.dispatch("POST")
+
+    def do_DELETE(self):
+        self.dispatch("DELETE")
+
+    def dispatch(self, method):
+        kvstore = self.server.kvstore
+        if kvstore.latency:
+            time.sleep(kvstore.latency)
+
+        url = urlsplit(self.path)
+        params = dict(parse_qsl(url.query))
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        if body and "json" not in self.headers.get("Content-Type", ""):
+            params.update(parse_qsl(body.decode("utf-8")))
+
+        # /servicesNS/<owner>/<app>/<endpoint>
+        segments = [unquote(segment) for segment in url.path.split("/")]
+        owner, app, endpoint = segments[2], segments[3], segments[4:]
+        while endpoint and endpoint[-1] == "":
+            endpoint.pop()
+
+        if endpoint[:3] == ["storage", "collections", "data"]:
+            name = endpoint[3]
+            rest = endpoint[4:]
+            token = self.headers.get("Authorization", "")
+            if token.startswith("Splunk "):
+                token = token[len("Splunk ") :]
+            if not kvstore.allowed(name, token):
+                kvstore.count("kv_forbidden")
+                return self.send_json(
+                    {"messages": [{"type": "ERROR", "text": "Forbidden"}]}, 403
+                )
+            if method == "GET" and not rest:
+                kvstore.count("kv_query")
+                return self.send_json(kvstore.query(name, params))
+            if method == "POST" and rest == ["batch_save"]:
+                kvstore.count("kv_batch_save")
+                documents = json.loads(body)
+                if len(documents) > kvstore.max_documents_per_batch_save:
+                    return self.send_json({"messages": []}, 400)
+                return self.send_json(kvstore.collection(name).batch_save(*documents))
+            if method == "POST":
+                kvstore.count("kv_save")
+                key = kvstore.collection(name).save(
+                    json.loads(body), rest[0] if rest else None
+                )
+                return self.send_json({"_key": key})
+            if method == "DELETE":
+                kvstore.count("kv_delete")
+                kvstore.delete(name, rest[0] if rest else None, params)
+                return self.send_json({})
+
+        if endpoint[:3] == ["storage", "collections", "config"] and len(endpoint) == 4:
+            kvstore.count("kv_config")
+            return self.send_atom(owner, app, "/".join(endpoint), endpoint[3], "")
+
+        if endpoint[:2] == ["configs", "conf-limits"]:
+            kvstore.count("conf")
+            content = '<s:key name="max_documents_per_batch_save">%d</s:key>' % (
+                kvstore.max_documents_per_batch_save
+            )
+            return self.send_atom(owner, app, "/".join(endpoint), "kvstore", content)
+
+        self.send_json({"messages": [{"type": "ERROR", "text": "Not Found"}]}, 404)
+
+    def send_json(self, data, status=200):
+        self.send_body(json.dumps(data).encode("utf-8"), "application/json", status)
+
+    def send_atom(self, owner, app, endpoint, name, content):
+        path = "/servicesNS/%s/%s/%s" % (owner, app, endpoint)
+        body = ATOM_FEED.format(
+            title=name,
+            base=self.server.base_uri,
+            path=path,
+            name=name,
+            content=content,
+            owner=owner,
+            app=app,
+        )
+        self.send_body(body.encode("utf-8"), "text/xml")
+
+    def send_body(self, body, content_type, status=200):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture(scope="session")
+def fake_splunkd(fake_collection):
+    """
+    Start the fake splunkd, the latency of each call is set in milliseconds by the
+    SPLUNKD_LATENCY_MS environment variable.
+    """
+
+    kvstore = FakeKVStore(
+        fake_collection,
+        latency=float(os.environ.get("SPLUNKD_LATENCY_MS", 0)) / 1000,
+    )
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeSplunkdRequestHandler)
+    server.daemon_threads = True
+    server.kvstore = kvstore
+    server.base_uri = "http://127.0.0.1:%d" % server.server_address[1]
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    yield server
+
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(scope="session")
+def splunk_home(tmp_path_factory):
+    """
+    Set SPLUNK_HOME to a temporary directory if it is not set, the handlers log to
+    $SPLUNK_HOME/var/log/splunk. The session fixtures cannot use the monkeypatch
+    fixture, the variable is restored at the end of the session.
+    """
+
+    monkeypatch = pytest.MonkeyPatch()
+    if "SPLUNK_HOME" not in os.environ:
+        home = tmp_path_factory.mktemp("splunk_home")
+        os.makedirs(os.path.join(str(home), "var", "log", "splunk"))
+        monkeypatch.setenv("SPLUNK_HOME", str(home))
+
+    yield os.environ["SPLUNK_HOME"]
+
+    monkeypatch.undo()
+
+
+@pytest.fixture(scope="session")
+def ack_handler_class(splunk_home):
+    """
+    The ack handler without the calls to the trackme endpoints, which are not part of
+    the fake splunkd: the log level is fixed and audit records are counted.
+    """
+
+    rest_handler_kvstore = importlib.import_module("rest_handler_kvstore")
+
+    class OfflineAckHandler(rest_handler_kvstore.TrackMeHandlerAck_v2):
+        audited = 0
+
+        # the acks of the tests do not expire, no background sweeper
+        ack_expiry_enabled = False
+
+        def resolve_loglevel(self, request_info):
+            return "INFO"
+
+        def write_audit_records(self, records):
+            self.audited += len(records)
+
+    return OfflineAckHandler
+
+
+@pytest.fixture(scope="session")
+def make_request(fake_splunkd):
+    """
+    Make the JSON envelope splunkd passes to a persistent handler, the handler calls
+    back the fake splunkd.
+    """
+
+    def make(
+        method,
+        path,
+        payload=None,
+        rest_path="/trackme/v2/ack",
+        query=None,
+        user="admin",
+        authtoken="NOTAREALTOKEN",
+    ):
+        return make_envelope(
+            fake_splunkd.base_uri,
+            method,
+            path,
+            payload,
+            rest_path,
+            query,
+            user,
+            authtoken,
+        )
+
+    return make
+
+
+def make_envelope(
+    base_uri,
+    method,
+    path,
+    payload=None,
+    rest_path="/trackme/v2/ack",
+    query=None,
+    user="admin",
+    authtoken="NOTAREALTOKEN",
+):
+    request = {
+        "connection": {"listening_port": 8089, "src_ip": "127.0.0.1", "ssl": False},
+        "cookies": [],
+        "headers": [
+            ["Authorization", f"Splunk {authtoken}"],
+            ["Host", "localhost:8089"],
+            ["Accept", "*/*"],
+        ],
+        "method": method,
+        "output_mode": "json",
+        "output_mode_explicit": False,
+        "query": [[key, value] for key, value in (query or {}).items()],
+        "rest_path": "%s/%s" % (rest_path, path),
+        "path_info": path,
+        "server": {
+            "guid": "1B43291B-02C8-45C3-A9BD-72A9C9130EDD",
+            "hostname": "host.domain.com",
+            "rest_uri": base_uri,
+            "servername": "host.domain.com",
+        },
+        "session": {"authtoken": authtoken, "user": user},
+        "system_authtoken": "NOTAREALSYSTEMTOKEN",
+    }
+    if method == "POST":
+        request["form"] = []
+        if payload is not None:
+            if not isinstance(payload, str):
+                payload = json.dumps(payload)
+            request["payload"] = payload
+    return json.dumps(request)
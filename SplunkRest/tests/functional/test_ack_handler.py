@@ -0,0 +1,260 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("splunk.persistconn.application")
+
+TENANT_ID = "functional"
+OBJECT_CATEGORY = "splk-dsm"
+ACK_COLLECTION = f"kv_trackme_common_alerts_ack_tenant_{TENANT_ID}"
+
+
+@pytest.fixture
+def handler(ack_handler_class):
+    handler = ack_handler_class(None, None)
+    yield handler
+    handler.done()
+
+
+def ack_record(key, object_value, ack_state="active", ack_mtime=100.0):
+    return {
+        "_key": key,
+        "object": object_value,
+        "object_category": OBJECT_CATEGORY,
+        "anomaly_reason": "lag_threshold_breached",
+        "ack_source": "user_ack",
+        "ack_expiration": 4102444800.0 if ack_state == "active" else 0,
+        "ack_state": ack_state,
+        "ack_mtime": ack_mtime,
+        "ack_type": "unsticky" if ack_state == "active" else "N/A",
+        "ack_comment": "Under review",
+    }
+
+
+def test_ack_export__projects_the_requested_fields(fake_splunkd, make_request, handler):
+    fake_splunkd.kvstore.load(
+        ACK_COLLECTION, [ack_record("1", "a"), ack_record("2", "b", "inactive")]
+    )
+
+    response = handler.handle(
+        make_request(
+            "GET",
+            "ack_export",
+            query={"tenant_id": TENANT_ID, "fields": "object,ack_state"},
+        )
+    )
+
+    assert response["status"] == 200
+    assert [json.loads(line) for line in response["payload"].splitlines()] == [
+        {"_key": "1", "object": "a", "ack_state": "active"},
+        {"_key": "2", "object": "b", "ack_state": "inactive"},
+    ]
+    queries = fake_splunkd.kvstore.collection(ACK_COLLECTION).queries
+    assert [query["fields"] for query in queries] == ["object,ack_state"]
+
+
+@pytest.mark.parametrize("pagination", [{}, {"limit": 10}])
+def test_get_ack_for_object__coalesced_reads_are_not_shared_between_users(
+    fake_splunkd, make_request, ack_handler_class, monkeypatch, pagination
+):
+    class CoalescingAckHandler(ack_handler_class):
+        single_flight_ttl = 60
+
+    fake_splunkd.kvstore.load(ACK_COLLECTION, [ack_record("1", "a")])
+    monkeypatch.setitem(fake_splunkd.kvstore.acls, ACK_COLLECTION, {"ADMINTOKEN"})
+    body = dict(
+        pagination,
+        tenant_id=TENANT_ID,
+        object_category=OBJECT_CATEGORY,
+        object_list="*",
+    )
+
+    handler = CoalescingAckHandler(None, None)
+    try:
+        response = handler.handle(
+            make_request(
+                "POST", "get_ack_for_object", body, user="admin", authtoken="ADMINTOKEN"
+            )
+        )
+        assert response["status"] == 200
+
+        # the collection is not readable by the second user, within the TTL
+        response = handler.handle(
+            make_request(
+                "POST", "get_ack_for_object", body, user="guest", authtoken="GUESTTOKEN"
+            )
+        )
+        assert response["status"] == 500
+        assert "Forbidden" in response["payload"]["result"]
+    finally:
+        handler.done()
+
+
+def test_write_audit_records__a_retried_batch_does_not_duplicate_records(
+    ack_handler_class, monkeypatch
+):
+    import rest_handler_kvstore
+
+    class AuditingAckHandler(ack_handler_class):
+        write_audit_records = (
+            rest_handler_kvstore.TrackMeHandlerAck_v2.write_audit_records
+        )
+
+    events = []
+
+    # the second record of the batch fails once, after the first one was written
+    def trackme_audit_event(*record):
+        if record[0] == "b" and "failed" not in events:
+            events.append("failed")
+            raise Exception("splunkd is not reachable")
+        events.append(record[0])
+
+    monkeypatch.setattr(
+        rest_handler_kvstore, "trackme_audit_event", trackme_audit_event
+    )
+
+    handler = AuditingAckHandler(None, None)
+    handler.audit_sink.flush_interval = 0.01
+    for name in ("a", "b", "c"):
+        handler.audit(name)
+    handler.done()
+
+    assert events == ["a", "failed", "b", "c"]
+    assert handler.audit_sink.stats()["flushed"] == 3
+
+
+def test_ack_expiry__needs_the_system_token_of_a_request(ack_handler_class):
+    class ExpiringAckHandler(ack_handler_class):
+        ack_expiry_enabled = True
+
+    handler = ExpiringAckHandler(None, None)
+    handler.ack_expiry.stopping = True  # no background thread
+
+    handler.track_ack_expiry(
+        SimpleNamespace(
+            system_authtoken=None, server_rest_uri="https://127.0.0.1:8089"
+        ),
+        TENANT_ID,
+    )
+    assert handler.ack_expiry.stats()["tenants"] == 0
+
+    # a tenant without a system token is paused instead of retried
+    handler.ack_expiry.track(TENANT_ID)
+    handler.ack_expiry.sweep()
+    handler.done()
+
+    assert handler.ack_expiry.stats()["paused"] == 1
+    assert handler.ack_expiry.rescans == {}
+
+
+def test_ack_manage__writes_into_a_collection_with_legacy_keys(
+    fake_splunkd, make_request, handler, ack_handler_class
+):
+    from z_ack_libs import ACK_KEYS_MIGRATED_KEY, ack_record_key
+
+    # records written by the previous versions, with auto-generated keys
+    fake_splunkd.kvstore.load(
+        ACK_COLLECTION,
+        [
+            ack_record("5f0c1e4b01", "a", ack_mtime=100.0),
+            ack_record("5f0c1e4b02", "a", "inactive", ack_mtime=50.0),
+            ack_record("5f0c1e4b03", "b"),
+        ],
+    )
+
+    response = handler.handle(
+        make_request(
+            "POST",
+            "ack_manage",
+            {
+                "tenant_id": TENANT_ID,
+                "action": "disable",
+                "object_category": OBJECT_CATEGORY,
+                "object_list": "a",
+            },
+        )
+    )
+    assert response["status"] == 200
+
+    response = handler.handle(
+        make_request(
+            "POST",
+            "ack_import",
+            "\n".join(
+                json.dumps({"object_category": OBJECT_CATEGORY, "object": name})
+                for name in ("b", "c")
+            ),
+            query={"tenant_id": TENANT_ID},
+        )
+    )
+    assert response["status"] == 200
+
+    records = fake_splunkd.kvstore.collection(ACK_COLLECTION).records
+    assert sorted(records) == sorted(
+        [ACK_KEYS_MIGRATED_KEY]
+        + [ack_record_key(OBJECT_CATEGORY, name) for name in ("a", "b", "c")]
+    )
+    assert records[ack_record_key(OBJECT_CATEGORY, "a")]["ack_state"] == "inactive"
+
+    response = handler.handle(
+        make_request(
+            "POST",
+            "ack_manage",
+            {
+                "tenant_id": TENANT_ID,
+                "action": "show",
+                "object_category": OBJECT_CATEGORY,
+                "object_list": "*",
+            },
+        )
+    )
+    assert json.loads(response["payload"])["process_count"] == 3
+
+    # another process finds the marker of the migration, the records are not scanned
+    other_handler = ack_handler_class(None, None)
+    queries = fake_splunkd.kvstore.collection(ACK_COLLECTION).queries
+    del queries[:]
+    response = other_handler.handle(
+        make_request(
+            "POST",
+            "ack_manage",
+            {
+                "tenant_id": TENANT_ID,
+                "action": "enable",
+                "object_category": OBJECT_CATEGORY,
+                "object_list": "d",
+            },
+        )
+    )
+    other_handler.done()
+
+    assert response["status"] == 200
+    assert [query["query"] for query in queries] == [{"_key": ACK_KEYS_MIGRATED_KEY}]
+
+
+@pytest.mark.parametrize("status", [401, 503])
+def test_expire_acks__tells_auth_failures_from_transient_ones(
+    fake_splunkd, handler, monkeypatch, status
+):
+    import rest_handler_kvstore
+    from z_ack_libs import AckExpiryAuthError, AckExpiryError
+
+    class HTTPError(Exception):
+        pass
+
+    failure = HTTPError("splunkd failed")
+    failure.status = status
+    monkeypatch.setattr(
+        rest_handler_kvstore,
+        "batch_save_records",
+        lambda collection, documents, *args: [failure] * len(documents),
+    )
+    # an ack that expired since it was scheduled
+    fake_splunkd.kvstore.load(
+        ACK_COLLECTION, [dict(ack_record("1", "a"), ack_expiration=100.0)]
+    )
+    handler.ack_expiry_contexts[TENANT_ID] = ("NOTAREALTOKEN", fake_splunkd.base_uri)
+
+    with pytest.raises(AckExpiryAuthError if status == 401 else AckExpiryError):
+        handler.expire_acks(TENANT_ID, [(OBJECT_CATEGORY, "a", 100.0)])
@@ -0,0 +1,361 @@
+import json
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("splunk.persistconn.application")
+
+import rest_handler_kv_table  # noqa: E402
+from z_kvstore_repository import CollectionSchema  # noqa: E402
+
+
+class TableHandler(rest_handler_kv_table.KVTableHandler):
+    log_file = None
+
+    def __init__(self, collection):
+        super(TableHandler, self).__init__(None, None)
+        self.collection = collection
+
+    def get_kvstore_collection(self, request_info, collection_name, **kwargs):
+        return self.collection
+
+    def get_kvstore_batch_size(self, request_info, **kwargs):
+        return 1000
+
+
+def make_request(
+    payload=None, method="POST", path="save_delta", query=None, user="admin"
+):
+    request = {
+        "method": method,
+        "server": {"rest_uri": "https://127.0.0.1:8089"},
+        "connection": {"src_ip": "127.0.0.1", "listening_port": 8089},
+        "session": {"authtoken": "NOTAREALTOKEN", "user": user},
+        "query": [[key, value] for key, value in (query or {}).items()],
+        "path_info": path,
+    }
+    if method == "POST":
+        request["form"] = []
+        request["payload"] = json.dumps(payload)
+    return json.dumps(request)
+
+
+@pytest.fixture
+def collection(fake_collection):
+    return fake_collection(
+        [
+            {"_key": "1", "mystring": "a", "mynumber": 1, "updated": 100.0},
+            {"_key": "2", "mystring": "b", "mynumber": 2, "updated": 100.0},
+            {"_key": "3", "mystring": "c", "mynumber": 3, "updated": 200.0},
+        ]
+    )
+
+
+def test_save_delta__saves_changed_rows_in_one_batch(collection):
+    handler = TableHandler(collection)
+
+    response = handler.handle(
+        make_request(
+            {
+                "collection": "my_collection",
+                "rows": [
+                    {"_key": "1", "updated": 100, "mynumber": "10"},
+                    {"_key": "2", "updated": 100, "mystring": None},
+                    {"mystring": "new"},
+                ],
+            }
+        )
+    )
+    handler.done()
+
+    assert response["status"] == 200
+    assert len(collection.data.batches) == 1
+    records = collection.data.records
+    assert records["1"]["mynumber"] == 10 and records["1"]["mystring"] == "a"
+    assert "mystring" not in records["2"]
+    assert records["1"]["updated"] > 100 and records["3"]["updated"] == 200.0
+    assert [r["result"] for r in json.loads(response["payload"])["records"]] == [
+        "success"
+    ] * 3
+
+
+def test_save_delta__returns_conflicts_and_invalid_rows(collection):
+    handler = TableHandler(collection)
+
+    response = handler.handle(
+        make_request(
+            {
+                "collection": "my_collection",
+                "rows": [
+                    {"_key": "1", "updated": 100, "mynumber": 10},
+                    {"_key": "3", "updated": 100, "mynumber": 30},
+                    {"_key": "4", "updated": 100, "mynumber": 40},
+                    {"_key": "2", "mynumber": 20},
+                    {"_key": "2", "updated": 100, "mybool": "maybe"},
+                ],
+            }
+        )
+    )
+    handler.done()
+
+    summary = json.loads(response["payload"])
+    results = summary["records"]
+
+    # a row that is not valid fails the request, the valid rows are saved
+    assert response["status"] == 500
+    assert [r["result"] for r in results] == [
+        "success",
+        "conflict",
+        "conflict",
+        "conflict",
+        "failure",
+    ]
+    assert results[1]["current"]["mynumber"] == 3
+    assert results[2]["reason"] == "the row was deleted"
+    assert results[3]["reason"] == "the row was modified"
+    assert collection.data.batches == [[dict(collection.data.records["1"])]]
+    assert collection.data.records["3"]["mynumber"] == 3
+
+
+def test_save_delta__conflicts_only_and_unknown_collections(collection):
+    handler = TableHandler(collection)
+
+    response = handler.handle(
+        make_request(
+            {
+                "collection": "my_collection",
+                "rows": [{"_key": "3", "updated": 100, "mynumber": 30}],
+            }
+        )
+    )
+    assert response["status"] == 409
+    assert collection.data.batches == []
+
+    response = handler.handle(
+        make_request({"collection": "unknown_collection", "rows": []})
+    )
+    handler.done()
+
+    assert response["status"] == 500
+    assert "is not declared in collections.conf" in response["payload"]["result"]
+
+
+def test_rows__serves_one_sorted_and_filtered_page(collection):
+    handler = TableHandler(collection)
+
+    response = handler.handle(
+        make_request(
+            method="GET",
+            path="rows",
+            query={
+                "collection": "my_collection",
+                "page": "2",
+                "size": "1",
+                "sort[0][field]": "mynumber",
+                "sort[0][dir]": "desc",
+                "filter[0][field]": "mynumber",
+                "filter[0][type]": ">=",
+                "filter[0][value]": "2",
+                "fields": "mystring",
+            },
+        )
+    )
+
+    assert response["status"] == 200
+    assert json.loads(response["payload"]) == {
+        "last_page": 2,
+        "last_row": 2,
+        "data": [{"_key": "2", "mystring": "b"}],
+    }
+    assert collection.data.queries[0]["query"] == {"mynumber": {"$gte": 2}}
+
+    response = handler.handle(
+        make_request(
+            method="GET",
+            path="rows",
+            query={
+                "collection": "my_collection",
+                "filters": json.dumps(
+                    [{"field": "mystring", "type": "like", "value": "a"}]
+                ),
+            },
+        )
+    )
+    handler.done()
+
+    assert response["status"] == 500
+    assert 'the filter type="like" is not supported' in response["payload"]["result"]
+
+
+def test_rows__count_is_cached_until_a_save(collection):
+    handler = TableHandler(collection)
+    rows = make_request(
+        method="GET", path="rows", query={"collection": "my_collection", "size": "2"}
+    )
+
+    assert json.loads(handler.handle(rows)["payload"])["last_page"] == 2
+    collection.data.records["4"] = {"_key": "4", "mynumber": 4, "updated": 100.0}
+    collection.data.records["5"] = {"_key": "5", "mynumber": 5, "updated": 100.0}
+    assert json.loads(handler.handle(rows)["payload"])["last_page"] == 2
+
+    handler.handle(
+        make_request({"collection": "my_collection", "rows": [{"mynumber": 6}]})
+    )
+
+    assert json.loads(handler.handle(rows)["payload"])["last_row"] == 6
+    handler.done()
+
+
+def test_rows__counts_are_not_shared_between_users(collection, fake_collection):
+    # the records the user can read, like the ACLs of the KV store
+    collections = {"admin": collection, "guest": fake_collection([])}
+
+    class UserTableHandler(TableHandler):
+        def get_kvstore_collection(self, request_info, collection_name, **kwargs):
+            return collections[request_info.user]
+
+    handler = UserTableHandler(collection)
+    query = {"collection": "my_collection"}
+
+    response = handler.handle(make_request(method="GET", path="rows", query=query))
+    assert json.loads(response["payload"])["last_row"] == 3
+
+    response = handler.handle(
+        make_request(method="GET", path="rows", query=query, user="guest")
+    )
+    handler.done()
+
+    assert json.loads(response["payload"]) == {
+        "last_page": 1,
+        "last_row": 0,
+        "data": [],
+    }
+
+
+def test_save_delta__concurrent_saves_of_a_row_conflict(collection, monkeypatch):
+    handler = TableHandler(collection)
+    query = collection.data.query
+
+    # widen the window between the read and the write of the rows
+    def slow_query(*args, **kwargs):
+        records = query(*args, **kwargs)
+        time.sleep(0.05)
+        return records
+
+    monkeypatch.setattr(collection.data, "query", slow_query)
+
+    responses = []
+
+    def save(mynumber):
+        responses.append(
+            handler.handle(
+                make_request(
+                    {
+                        "collection": "my_collection",
+                        "rows": [{"_key": "1", "updated": 100, "mynumber": mynumber}],
+                    }
+                )
+            )
+        )
+
+    threads = [threading.Thread(target=save, args=(n,)) for n in (10, 20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    handler.done()
+
+    assert sorted(response["status"] for response in responses) == [200, 409]
+    assert len(collection.data.batches) == 1
+
+
+def test_save_delta__compares_versions_as_they_are_stored(fake_collection):
+    collection = fake_collection(
+        [{"_key": "1", "mynumber": 1, "updated": 1704067200.123}]
+    )
+    handler = TableHandler(collection)
+
+    response = handler.handle(
+        make_request(
+            {
+                "collection": "my_collection",
+                "rows": [{"_key": "1", "updated": 1704067200.1230001, "mynumber": 2}],
+            }
+        )
+    )
+    handler.done()
+
+    assert response["status"] == 200
+    updated = collection.data.records["1"]["updated"]
+    assert updated == round(updated, 3)
+    assert json.loads(response["payload"])["records"][0]["updated"] == updated
+
+
+def test_rows__repeated_page_parameter_is_rejected(collection):
+    handler = TableHandler(collection)
+    request = json.loads(
+        make_request(method="GET", path="rows", query={"collection": "my_collection"})
+    )
+    request["query"] += [["page", "1"], ["page", "2"]]
+
+    response = handler.handle(json.dumps(request))
+    handler.done()
+
+    assert response["status"] == 500
+    assert response["payload"]["action"] == "failure"
+
+
+def test_rows__lists_collections_without_version_with_undeclared_fields(
+    fake_collection, monkeypatch
+):
+    schema = CollectionSchema("my_notes", {"mynumber": "number"})
+    monkeypatch.setattr(rest_handler_kv_table, "collection_schema", lambda name: schema)
+    collection = fake_collection([{"_key": "1", "mynumber": 1, "owner_note": "a"}])
+    handler = TableHandler(collection)
+
+    response = handler.handle(
+        make_request(method="GET", path="rows", query={"collection": "my_notes"})
+    )
+    assert json.loads(response["payload"])["data"] == [
+        {"_key": "1", "mynumber": 1, "owner_note": "a"}
+    ]
+
+    # the rows of a collection without the version field are not saved
+    response = handler.handle(
+        make_request({"collection": "my_notes", "rows": [{"_key": "1", "mynumber": 2}]})
+    )
+    handler.done()
+
+    assert response["status"] == 500
+    assert 'has no time field="updated"' in response["payload"]["result"]
+
+
+def test_save_delta__keeps_undeclared_fields_and_versions_legacy_rows(fake_collection):
+    collection = fake_collection(
+        [
+            {"_key": "1", "mynumber": 1, "updated": 100.0, "owner_note": "keep me"},
+            {"_key": "2", "mynumber": 2, "owner_note": "legacy"},
+        ]
+    )
+    handler = TableHandler(collection)
+
+    response = handler.handle(
+        make_request(
+            {
+                "collection": "my_collection",
+                "rows": [
+                    {"_key": "1", "updated": 100, "mynumber": 10},
+                    {"_key": "2", "mynumber": 20},
+                ],
+            }
+        )
+    )
+    handler.done()
+
+    assert response["status"] == 200
+    records = collection.data.records
+    assert records["1"]["owner_note"] == "keep me" and records["1"]["mynumber"] == 10
+    assert records["2"]["owner_note"] == "legacy" and records["2"]["mynumber"] == 20
+    assert records["2"]["updated"] > 0
+    assert "_user" not in records["1"]
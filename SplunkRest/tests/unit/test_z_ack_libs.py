@@ -0,0 +1,337 @@
+import z_ack_libs
+
+
+def ack(key, object_value, mtime, category="splk-dsm"):
+    return {
+        "_key": key,
+        "object": object_value,
+        "object_category": category,
+        "ack_mtime": mtime,
+    }
+
+
+def test_cache__loads_category_then_refreshes_incrementally(fake_collection):
+    collection = fake_collection(
+        [ack("1", "a", 100), ack("2", "b", 100), ack("3", "c", 100, "splk-dhm")]
+    )
+    cache = z_ack_libs.AckRecordCache(mtime_overlap=0, page_size=1)
+
+    index = cache.get("t1", "splk-dsm", collection)
+    assert len(index) == 2 and "a" in index and "c" not in index
+
+    collection.data.save(ack("4", "d", 200))
+    collection.data.queries.clear()
+    index = cache.get("t1", "splk-dsm", collection)
+
+    assert index.get_by_object("d")["_key"] == "4"
+    assert collection.data.queries[0]["query"]["$and"][1] == {"ack_mtime": {"$gt": 100}}
+
+
+def test_cache__write_through_and_lru_eviction(fake_collection):
+    collection = fake_collection([ack("1", "a", 100), ack("2", "b", 100, "splk-dhm")])
+    cache = z_ack_libs.AckRecordCache(max_records=1)
+
+    cache.get("t1", "splk-dsm", collection)
+    cache.upsert("t1", "splk-dsm", ack("9", "z", 300))
+    assert cache.get("t1", "splk-dsm", collection).get_by_key("9")["object"] == "z"
+
+    cache.get("t1", "splk-dhm", collection)
+    assert list(cache.indexes) == [("t1", "splk-dhm")]
+
+
+def test_index__object_points_to_most_recent_record():
+    index = z_ack_libs.AckCollectionIndex()
+    index.upsert(ack("1", "a", 200))
+    index.upsert(ack("2", "a", 100))
+    assert index.get_by_object("a")["_key"] == "1"
+
+
+def test_query_records_by_object__one_query_per_chunk(fake_collection):
+    collection = fake_collection(
+        [
+            {"_key": str(i), "object": "o%d" % i, "anomaly_reason": "lag"}
+            for i in range(5)
+        ]
+    )
+
+    records = z_ack_libs.query_records_by_object(
+        collection, ["o0", "o1", "o1", "o4", "missing"], chunk_size=2
+    )
+
+    assert sorted(records) == ["o0", "o1", "o4"]
+    assert len(collection.data.queries) == 2
+
+
+def test_query_ack_records__filters_by_category_and_objects(fake_collection):
+    collection = fake_collection(
+        [ack(str(i), "o%d" % i, 100 + i) for i in range(250)]
+        + [ack("old", "o1", 50), ack("other", "o2", 500, category="splk-dhm")]
+    )
+
+    index = z_ack_libs.query_ack_records(
+        collection, "splk-dsm", ["o1", "o2", "o200"], chunk_size=2
+    )
+
+    assert len(collection.data.queries) == 2
+    assert len(index) == 4
+    assert index.get_by_object("o1")["_key"] == "1"
+    assert index.get_by_object("o2")["object_category"] == "splk-dsm"
+    assert "o3" not in index
+
+
+def test_decorate_ack_records__converts_each_epoch_once():
+    converted = []
+
+    def convert_epoch(epoch):
+        converted.append(epoch)
+        return "date %s" % epoch
+
+    records = [
+        {"ack_mtime": 100, "ack_expiration": 200, "ack_state": "active"},
+        {
+            "ack_mtime": 100,
+            "ack_expiration": 0,
+            "ack_state": "inactive",
+            "anomaly_reason": "lag,delay",
+            "ack_source": "auto_ack",
+        },
+    ]
+
+    decorated = z_ack_libs.decorate_ack_records(records, convert_epoch)
+
+    assert sorted(converted) == [100, 200]
+    assert decorated[0]["ack_expiration_datetime"] == "date 200"
+    assert decorated[1]["ack_expiration_datetime"] == "N/A"
+    assert [r["ack_is_enabled"] for r in decorated] == [1, 0]
+    assert decorated[0]["anomaly_reason"] == "N/A"
+    assert decorated[1]["anomaly_reason"] == ["lag", "delay"]
+    assert [r["ack_source"] for r in decorated] == ["user_ack", "auto_ack"]
+    assert "ack_is_enabled" not in records[0]
+
+
+def test_decorate_ack_records__adds_only_requested_derived_fields():
+    decorated = z_ack_libs.decorate_ack_records(
+        [{"ack_mtime": 100, "ack_state": "active"}],
+        str,
+        z_ack_libs.parse_derived_fields("ack_is_enabled"),
+    )
+
+    assert decorated == [
+        {
+            "ack_mtime": 100,
+            "ack_state": "active",
+            "ack_is_enabled": 1,
+            "anomaly_reason": "N/A",
+            "ack_source": "user_ack",
+        }
+    ]
+
+
+def test_expiry_index__pops_due_entries_and_skips_stale_ones():
+    index = z_ack_libs.AckExpiryIndex()
+    index.schedule(
+        "t1",
+        {
+            "object": "a",
+            "object_category": "c",
+            "ack_state": "active",
+            "ack_expiration": 10,
+        },
+    )
+    index.schedule(
+        "t1",
+        {
+            "object": "b",
+            "object_category": "c",
+            "ack_state": "active",
+            "ack_expiration": 20,
+        },
+    )
+    index.schedule(
+        "t2",
+        {
+            "object": "a",
+            "object_category": "c",
+            "ack_state": "active",
+            "ack_expiration": 5,
+        },
+    )
+
+    # extended, then disabled: the previous heap entries are stale
+    index.schedule(
+        "t1",
+        {
+            "object": "a",
+            "object_category": "c",
+            "ack_state": "active",
+            "ack_expiration": 30,
+        },
+    )
+    index.schedule(
+        "t1",
+        {
+            "object": "b",
+            "object_category": "c",
+            "ack_state": "inactive",
+            "ack_expiration": 0,
+        },
+    )
+
+    assert index.next_due() == 5
+    assert index.pop_due("t1", 25) == []
+    assert index.pop_due("t1", 30) == [("c", "a", 30)]
+    assert index.pop_due("t2", 30) == [("c", "a", 5)]
+    assert index.next_due() is None
+    assert len(index) == 0
+
+
+def test_expiry_sweeper__loads_tenant_expires_due_acks_and_retries_failures():
+    expired = []
+    failing = [True]
+
+    def load(tenant_id):
+        return [
+            {
+                "object": "a",
+                "object_category": "c",
+                "ack_state": "active",
+                "ack_expiration": 10,
+            },
+            {
+                "object": "b",
+                "object_category": "c",
+                "ack_state": "active",
+                "ack_expiration": 100,
+            },
+        ]
+
+    def expire(tenant_id, entries):
+        if failing[0]:
+            raise ValueError("KV store unavailable")
+        expired.extend(entries)
+
+    sweeper = z_ack_libs.AckExpirySweeper(load, expire, retry_interval=60)
+    sweeper.rescans["t1"] = 0
+
+    # the load runs with the first pass, the failed entry is retried a minute later
+    assert sweeper.sweep(now=20) == 1
+    assert sweeper.stats()["failed"] == 1
+    assert sweeper.next_wakeup() == 80
+
+    failing[0] = False
+    sweeper.schedule(
+        "t1",
+        {
+            "object": "c",
+            "object_category": "c",
+            "ack_state": "active",
+            "ack_expiration": 50,
+        },
+    )
+    assert sweeper.sweep(now=80) == 2
+    assert sorted(expired) == [("c", "a", 80), ("c", "c", 50)]
+    assert sweeper.next_wakeup() == 100
+
+
+def test_ack_expiry_sweeper__backs_off_failed_loads_and_pauses_on_auth_failures():
+    class HTTPError(Exception):
+        status = 401
+
+    loads = []
+    errors = [ValueError("KV store unavailable")] * 4 + [HTTPError("Unauthorized")]
+
+    def load(tenant_id):
+        loads.append(tenant_id)
+        if errors:
+            raise errors.pop(0)
+        return []
+
+    sweeper = z_ack_libs.AckExpirySweeper(
+        load, lambda tenant_id, entries: None, rescan_interval=300, retry_interval=60
+    )
+    sweeper.stopping = True  # no background thread
+    sweeper.track("t1")
+    sweeper.schedule(
+        "t1",
+        {
+            "object": "a",
+            "object_category": "c",
+            "ack_state": "active",
+            "ack_expiration": 10000,
+        },
+    )
+
+    # the retries wait 60, 120 and 240 seconds, then the rescan interval
+    wakeups = []
+    now = 0
+    for _ in range(4):
+        sweeper.sweep(now=now)
+        now = sweeper.rescans["t1"]
+        wakeups.append(now)
+    assert wakeups == [60, 180, 420, 720]
+
+    # an authentication failure pauses the tenant until it is tracked again
+    sweeper.sweep(now=now)
+    assert sweeper.stats() == {
+        "loaded": 0,
+        "expired": 0,
+        "failed": 0,
+        "paused": 1,
+        "scheduled": 0,
+        "tenants": 0,
+    }
+    assert sweeper.next_wakeup() is None
+    sweeper.sweep(now=now + 1000)
+    assert len(loads) == 5
+
+    sweeper.track("t1")
+    sweeper.sweep(now=now + 1000)
+    assert len(loads) == 6 and sweeper.rescans["t1"] == now + 1300
+
+
+def test_rekey_ack_records__keeps_most_recent_record_under_derived_key(fake_collection):
+    key_a = z_ack_libs.ack_record_key("splk-dsm", "a")
+    key_b = z_ack_libs.ack_record_key("splk-dsm", "b")
+    key_c = z_ack_libs.ack_record_key("splk-dhm", "c")
+    collection = fake_collection(
+        [
+            ack("1", "a", 100),
+            ack("2", "a", 300),
+            ack(key_a, "a", 200),
+            ack("3", "b", 100),
+            ack(key_c, "c", 100, "splk-dhm"),
+        ]
+    )
+
+    summary = z_ack_libs.rekey_ack_records(collection, batch_size=1, chunk_size=2)
+
+    records = {r["_key"]: r for r in collection.data.records.values()}
+    assert sorted(records) == sorted([key_a, key_b, key_c])
+    assert records[key_a]["ack_mtime"] == 300
+    assert records[key_b]["object"] == "b"
+    assert summary == {
+        "records": 5,
+        "objects": 3,
+        "rekeyed": 2,
+        "deleted": 3,
+        "failures": [],
+    }
+
+    # the migrated collection is left as it is
+    collection.data.batches.clear()
+    summary = z_ack_libs.rekey_ack_records(collection, batch_size=1)
+    assert summary["rekeyed"] == 0 and collection.data.batches == []
+
+
+def test_mark_ack_keys_migrated__marker_is_left_out_of_the_migration(fake_collection):
+    collection = fake_collection([ack("1", "a", 100)])
+    assert not z_ack_libs.ack_keys_migrated(collection)
+
+    z_ack_libs.mark_ack_keys_migrated(collection)
+    summary = z_ack_libs.rekey_ack_records(collection, batch_size=10)
+
+    assert z_ack_libs.ack_keys_migrated(collection)
+    assert summary["records"] == 1 and summary["rekeyed"] == 1
+    assert sorted(collection.data.records) == sorted(
+        [z_ack_libs.ACK_KEYS_MIGRATED_KEY, z_ack_libs.ack_record_key("splk-dsm", "a")]
+    )
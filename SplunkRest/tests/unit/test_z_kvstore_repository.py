@@ -0,0 +1,196 @@
+import os
+
+import pytest
+
+import z_kvstore_repository
+
+
+@pytest.fixture
+def schema(app_path):
+    return z_kvstore_repository.parse_collections_conf(
+        [os.path.join(app_path, "default", "collections.conf")]
+    )["my_collection"]
+
+
+def test_parse_collections_conf__generates_slotted_record_class(schema):
+    assert schema.enforce_types is True
+    assert dict(schema.field_types) == {
+        "mystring": "string",
+        "mynumber": "number",
+        "mybool": "bool",
+        "updated": "time",
+    }
+
+    record = schema.record_class(mystring="a", mynumber=1)
+    assert type(record).__name__ == "MyCollectionRecord"
+    assert not hasattr(record, "__dict__")
+    with pytest.raises(AttributeError):
+        record.other = 1
+
+
+def test_parse_collections_conf__local_overrides_default(tmp_path):
+    (tmp_path / "default.conf").write_text("[c]\nfield.a = string\nfield.b = number\n")
+    (tmp_path / "local.conf").write_text("[c]\nfield.b = string\n")
+
+    schemas = z_kvstore_repository.parse_collections_conf(
+        [str(tmp_path / "default.conf"), str(tmp_path / "local.conf")]
+    )
+
+    assert dict(schemas["c"].field_types) == {"a": "string", "b": "string"}
+    assert schemas["c"].enforce_types is False
+
+
+def test_record__coerces_values_and_rejects_bad_rows(schema):
+    record = schema.coerce(
+        {
+            "_key": "1",
+            "mystring": 42,
+            "mynumber": "1.5",
+            "mybool": "true",
+            "updated": "2024-01-01T00:00:00Z",
+        }
+    )
+
+    assert record.to_dict() == {
+        "_key": "1",
+        "mystring": "42",
+        "mynumber": 1.5,
+        "mybool": True,
+        "updated": 1704067200.0,
+    }
+
+    with pytest.raises(ValueError, match='field="mynumber"'):
+        schema.coerce({"mynumber": "many"})
+    with pytest.raises(ValueError, match='field="mybool"'):
+        schema.coerce({"mybool": "maybe"})
+    with pytest.raises(ValueError, match='unknown field="other"'):
+        schema.coerce({"other": 1})
+
+
+def test_repository__upserts_valid_rows_in_chunks(fake_collection, schema):
+    collection = fake_collection()
+    repository = z_kvstore_repository.KVRepository(collection, schema, batch_size=2)
+
+    results = repository.upsert_many(
+        [
+            {"mystring": "a"},
+            {"mynumber": "NaN"},
+            {"_key": "x", "mynumber": 2},
+            schema.record_class(mybool=False),
+        ]
+    )
+
+    # the invalid row is not sent, the valid rows are saved in chunks of 2
+    assert [len(batch) for batch in collection.data.batches] == [2, 1]
+    assert isinstance(results[1], ValueError)
+    assert results[0] == "k0" and results[2] == "x" and results[3] == "k2"
+    assert collection.data.records["x"] == {"_key": "x", "mynumber": 2}
+
+
+def test_repository__gets_and_deletes_by_key_in_chunks(fake_collection, schema):
+    collection = fake_collection()
+    repository = z_kvstore_repository.KVRepository(
+        collection, schema, batch_size=10, chunk_size=2
+    )
+    repository.upsert_many([{"_key": str(n), "mynumber": n} for n in range(3)])
+
+    records = repository.get_many(["2", "missing", "0", "2"])
+
+    assert [
+        [condition["_key"] for condition in query["query"]["$or"]]
+        for query in collection.data.queries
+    ] == [["2", "missing"], ["0"]]
+    assert [record and record.mynumber for record in records] == [2, None, 0, 2]
+    assert records[0].to_dict() == {"_key": "2", "mynumber": 2}
+
+    # the stored documents keep the fields that are not declared
+    repository.upsert_documents([{"_key": "2", "mynumber": 2, "owner_note": "a"}])
+    assert repository.get_documents(["2", "missing"]) == [
+        {"_key": "2", "mynumber": 2, "owner_note": "a"},
+        None,
+    ]
+
+    # only the records that existed are counted
+    assert repository.delete_many(["0", "1", "0", "missing"]) == 2
+    assert sorted(collection.data.records) == ["2"]
+    assert repository.delete_many(["0"]) == 0
+
+
+def test_batch_save_records__maps_chunk_results_to_documents(fake_collection):
+    collection = fake_collection([{"_key": "1", "object": "a"}])
+    documents = [
+        {"_key": "1", "object": "a"},
+        {"object": "b"},
+        {"object": "fail"},
+        {"object": "c"},
+    ]
+
+    collection.data.reject = lambda document: document["object"] == "fail"
+
+    results = z_kvstore_repository.batch_save_records(collection, documents, 2)
+
+    assert [len(batch) for batch in collection.data.batches] == [2, 2]
+    assert results[:2] == ["1", "k1"]
+    assert all(isinstance(r, ValueError) for r in results[2:])
+
+
+def test_batch_save_records__reports_the_documents_saved_before_a_failure(
+    fake_collection,
+):
+    collection = fake_collection([{"_key": "3", "object": "c"}])
+    documents = [
+        {"_key": "1", "object": "a"},
+        {"object": "b"},
+        {"_key": "2", "object": "fail"},
+        {"_key": "3", "object": "c2"},
+    ]
+
+    collection.data.reject = lambda document: document["object"] == "fail"
+
+    results = z_kvstore_repository.batch_save_records(collection, documents, 4)
+
+    # the document without _key can not be read again, it is reported as failed
+    assert results[0] == "1"
+    assert all(isinstance(r, ValueError) for r in results[1:])
+    assert collection.data.records["3"]["object"] == "c"
+
+
+def test_batch_save_records__keeps_order_of_map_function_results(fake_collection):
+    collection = fake_collection([])
+    documents = [{"object": "o%d" % i} for i in range(10)]
+
+    # saves the last chunk first, like a concurrent map whose calls complete unordered
+    def map_reversed(function, items):
+        return list(reversed([function(item) for item in reversed(items)]))
+
+    results = z_kvstore_repository.batch_save_records(
+        collection, documents, 3, map_function=map_reversed
+    )
+
+    assert [len(batch) for batch in collection.data.batches] == [1, 3, 3, 3]
+    objects_by_key = {r["_key"]: r["object"] for r in collection.data.records.values()}
+    assert [objects_by_key[key] for key in results] == [d["object"] for d in documents]
+
+
+class Pagination(object):
+    def __init__(self, skip, limit):
+        self.skip, self.limit, self.sort, self.fields = skip, limit, None, None
+
+    def next_cursor(self, count):
+        return self.skip + count
+
+
+def test_query_page__returns_next_cursor_only_if_there_are_more_records(
+    fake_collection,
+):
+    collection = fake_collection([{"_key": str(i), "mynumber": i} for i in range(4)])
+
+    records, next_cursor = z_kvstore_repository.query_page(
+        collection, None, Pagination(0, 3)
+    )
+    assert len(records) == 3 and next_cursor == 3
+
+    records, next_cursor = z_kvstore_repository.query_page(
+        collection, None, Pagination(3, 3)
+    )
+    assert len(records) == 1 and next_cursor is None
@@ -0,0 +1,674 @@
+import asyncio
+import base64
+import json
+import logging
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip("splunk.persistconn.application")
+
+import z_rest_handler  # noqa: E402
+
+
+class EchoHandler(z_rest_handler.RESTHandler):
+    def __init__(self):
+        super(EchoHandler, self).__init__(None, None, logging.getLogger(__name__))
+
+    def get_echo(self, request_info, **kwargs):
+        return {"payload": kwargs, "status": 200}
+
+    def post_ack_manage(self, request_info, **kwargs):
+        return {"payload": "post_ack_manage", "status": 200}
+
+    @z_rest_handler.route("post", "ack/{tenant_id}/objects")
+    def post_tenant_objects(self, request_info, tenant_id, **kwargs):
+        return {"payload": tenant_id, "status": 200}
+
+
+def make_request(method, path, query=None, form=None, headers=None):
+    request = {
+        "method": method,
+        "server": {
+            "rest_uri": "https://127.0.0.1:8089",
+            "hostname": "host.domain.com",
+            "servername": "host.domain.com",
+        },
+        "connection": {"src_ip": "127.0.0.1", "listening_port": 8089},
+        "session": {"authtoken": "NOTAREALTOKEN", "user": "admin"},
+        "query": query or [],
+        "path_info": path,
+    }
+    if method == "POST":
+        request["form"] = form or []
+    if headers is not None:
+        request["headers"] = headers
+    return json.dumps(request)
+
+
+def test_route_table__lists_only_handler_functions():
+    routes = {(r["method"], r["path"]) for r in EchoHandler.list_routes()}
+    assert routes == {
+        ("get", "/echo"),
+        ("post", "/ack_manage"),
+        ("post", "/ack/{tenant_id}/objects"),
+        ("post", "/tenant_objects"),
+        ("post", "/loglevel_invalidate"),
+        ("get", "/metrics"),
+    }
+
+
+def test_handle__resolves_function_by_path():
+    handler = EchoHandler()
+    response = handler.handle(make_request("GET", "echo", query=[["a", "1"]]))
+    assert response == {"payload": {"a": "1"}, "status": 200}
+
+    response = handler.handle(make_request("POST", "ack/manage"))
+    assert response["payload"] == "post_ack_manage"
+
+
+def test_handle__passes_path_parameters():
+    handler = EchoHandler()
+    response = handler.handle(make_request("POST", "ack/mytenant/objects"))
+    assert response == {"payload": "mytenant", "status": 200}
+
+
+def test_handle__unknown_path_is_not_found():
+    handler = EchoHandler()
+    assert handler.handle(make_request("GET", "function_signature"))["status"] == 404
+    assert handler.handle(make_request("GET", "missing"))["status"] == 404
+
+
+def test_audit_sink__writes_queued_records_in_batches():
+    batches = []
+    sink = z_rest_handler.AuditSink(batches.append, flush_size=2, flush_interval=0.01)
+
+    for i in range(5):
+        assert sink.put(i)
+    sink.close()
+
+    assert [r for batch in batches for r in batch] == [0, 1, 2, 3, 4]
+    assert max(len(batch) for batch in batches) <= 2
+    assert sink.stats() == {
+        "queued": 5,
+        "flushed": 5,
+        "dropped": 0,
+        "failed": 0,
+        "pending": 0,
+    }
+
+
+def test_audit_sink__drops_records_when_the_queue_is_full():
+    sink = z_rest_handler.AuditSink(lambda batch: None, max_queue=1, put_timeout=0)
+    sink.thread = object()  # keep the queue from being consumed
+
+    assert sink.put(1)
+    assert not sink.put(2)
+    assert sink.stats()["dropped"] == 1
+
+
+def test_audit__records_are_keyed_and_dropped_with_a_warning_by_default(caplog):
+    handler = EchoHandler()
+    written = []
+    write_audit_records = handler.write_audit_records
+
+    def write(records):
+        written.extend(records)
+        write_audit_records(records)
+
+    handler.write_audit_records = write
+
+    with caplog.at_level(logging.WARNING):
+        assert handler.audit("a", 1)
+        assert handler.audit("b", 2)
+        handler.audit_sink.flush()
+        handler.audit("c", 3)
+        handler.done()
+
+    assert written == [("a", 1), ("b", 2), ("c", 3)]
+    assert len({record.key for record in written}) == 3
+    assert handler.audit_sink.stats()["failed"] == 0
+    assert [r.getMessage() for r in caplog.records].count(
+        'handler="EchoHandler" does not implement write_audit_records, audit records are dropped'
+    ) == 1
+
+
+def test_loglevel_resolver__caches_level_until_invalidated():
+    calls = []
+
+    def resolve(request_info):
+        calls.append(request_info)
+        return "DEBUG"
+
+    resolver = z_rest_handler.LogLevelResolver(resolve, ttl=60)
+
+    assert resolver.get("r1") == "DEBUG"
+    assert resolver.get("r2") == "DEBUG"
+    assert calls == ["r1"]
+
+    resolver.invalidate()
+    assert resolver.get("r3") == "DEBUG"
+    assert calls == ["r1", "r3"]
+
+
+def test_handle__sets_log_level_of_handler_logger_only():
+    class LevelHandler(EchoHandler):
+        def resolve_loglevel(self, request_info):
+            return "DEBUG"
+
+    handler = LevelHandler()
+    handler.logger = logging.getLogger("test_loglevel")
+    root_level = logging.getLogger().level
+
+    handler.handle(make_request("GET", "echo"))
+
+    assert handler.logger.level == logging.DEBUG
+    assert logging.getLogger().level == root_level
+    assert ("post", "/loglevel_invalidate") in {
+        (r["method"], r["path"]) for r in LevelHandler.list_routes()
+    }
+
+
+def test_pagination__cursor_carries_the_query_state():
+    assert z_rest_handler.Pagination.from_params({}) is None
+
+    pagination = z_rest_handler.Pagination.from_params(
+        {"limit": "2", "fields": "object, ack_state"}, default_sort="_key"
+    )
+    assert (pagination.skip, pagination.limit, pagination.sort) == (0, 2, "_key")
+    assert pagination.next_cursor(1) is None
+
+    following = z_rest_handler.Pagination.from_params(
+        {"cursor": pagination.next_cursor(2)}
+    )
+    assert (following.skip, following.limit) == (2, 2)
+    assert following.fields == ["object", "ack_state"]
+
+
+def test_pagination__key_of_a_sort_list_is_hashable():
+    pagination = z_rest_handler.Pagination.from_params(
+        {"limit": 10, "sort": ["object", "ack_mtime"]}
+    )
+    following = z_rest_handler.Pagination.from_params(
+        {"cursor": pagination.next_cursor(10)}
+    )
+
+    single_flight = z_rest_handler.SingleFlight(ttl=0)
+    for page in (pagination, following):
+        assert single_flight.do(page.key(), lambda: "page") == "page"
+
+
+@pytest.mark.parametrize("params", [{"limit": "x"}, {"limit": 0}, {"cursor": "%%"}])
+def test_pagination__invalid_parameters(params):
+    with pytest.raises(ValueError):
+        z_rest_handler.Pagination.from_params(params)
+
+
+@pytest.mark.parametrize("name", ["json", "orjson", "ujson"])
+def test_json_codec__round_trip(name):
+    if name != "json":
+        pytest.importorskip(name)
+    codec = z_rest_handler.JSONCodec(name)
+    data = {"records": [{"object": "a/b", "ack_mtime": 1.5, "ü": None}]}
+
+    assert codec.loads(codec.dumps(data)) == data
+    assert codec.loads(codec.dumps_bytes(data)) == data
+
+
+def test_render_json__keeps_encoded_payloads():
+    handler = EchoHandler()
+    assert handler.render_json('{"a": 1}')["payload"] == '{"a": 1}'
+    assert handler.render_json(b'{"a": 1}')["payload"] == '{"a": 1}'
+    assert json.loads(handler.render_json({"a": 1})["payload"]) == {"a": 1}
+
+
+def test_handle__compresses_large_payloads_accepted_by_the_client():
+    class LargeHandler(EchoHandler):
+        compression_threshold = 1024
+
+        def get_large(self, request_info, size="2000", **kwargs):
+            return self.render_json({"data": "x" * int(size)})
+
+    handler = LargeHandler()
+    response = handler.handle(
+        make_request(
+            "GET", "large", headers=[["accept-encoding", "deflate, gzip;q=0.8"]]
+        )
+    )
+
+    assert "payload" not in response
+    assert response["headers"] == {
+        "Content-Type": "application/json",
+        "Content-Encoding": "deflate",
+        "Vary": "Accept-Encoding",
+    }
+    payload = zlib.decompress(base64.b64decode(response["payload_base64"]))
+    assert json.loads(payload) == {"data": "x" * 2000}
+
+    response = handler.handle(
+        make_request("GET", "large", headers=[["Accept-Encoding", "gzip"]])
+    )
+    payload = zlib.decompress(base64.b64decode(response["payload_base64"]), 31)
+    assert json.loads(payload) == {"data": "x" * 2000}
+
+    # small payloads and clients without an accepted encoding are not compressed
+    for request in (
+        make_request(
+            "GET",
+            "large",
+            query=[["size", "10"]],
+            headers=[["Accept-Encoding", "gzip"]],
+        ),
+        make_request("GET", "large", headers=[["Accept-Encoding", "br, gzip;q=0"]]),
+        make_request("GET", "large"),
+    ):
+        response = handler.handle(request)
+        assert "payload_base64" not in response
+        assert "Content-Encoding" not in response["headers"]
+
+
+def test_handle__compresses_large_object_payloads():
+    class LargeHandler(EchoHandler):
+        compression_threshold = 1024
+
+        def get_large(self, request_info, size="2000", **kwargs):
+            data = [{"id": i, "value": "x" * 10} for i in range(int(size))]
+            return {"payload": {"data": data}, "status": 200}
+
+    handler = LargeHandler()
+    response = handler.handle(
+        make_request("GET", "large", headers=[["Accept-Encoding", "gzip"]])
+    )
+
+    assert "payload" not in response
+    assert response["headers"] == {
+        "Content-Type": "application/json",
+        "Content-Encoding": "gzip",
+        "Vary": "Accept-Encoding",
+    }
+    payload = json.loads(
+        zlib.decompress(base64.b64decode(response["payload_base64"]), 31)
+    )
+    assert len(payload["data"]) == 2000 and payload["data"][-1]["id"] == 1999
+
+    # small objects are returned as they are, splunkd serializes them
+    response = handler.handle(
+        make_request(
+            "GET", "large", query=[["size", "1"]], headers=[["Accept-Encoding", "gzip"]]
+        )
+    )
+    assert response["payload"] == {"data": [{"id": 0, "value": "x" * 10}]}
+
+
+def test_request_info__computes_attributes_on_access():
+    args = json.loads(make_request("POST", "echo", query=[["a", "1"], ["a", "2"]]))
+    args["method"] = "post"
+    args["form"] = [["b", "3"]]
+    args["payload"] = '{"tenant_id": "t1"}'
+    del args["connection"]
+
+    request_info = z_rest_handler.RequestInfo(args, z_rest_handler.JSONCodec("json"))
+
+    assert request_info.query == {"a": ["1", "2"], "b": "3"}
+    assert request_info.server_rest_port == 8089
+    assert request_info.json_body == {"tenant_id": "t1"}
+    assert request_info.system_authtoken is None
+    with pytest.raises(KeyError):
+        request_info.connection_src_ip
+    with pytest.raises(AttributeError):
+        request_info.anything = 1
+
+
+def test_latency_histogram__percentiles_within_bucket_error():
+    histogram = z_rest_handler.LatencyHistogram()
+    for milliseconds in range(1, 1001):
+        histogram.record(milliseconds / 1000.0)
+
+    assert histogram.count == 1000
+    assert len(histogram.counts) < 400
+    assert histogram.percentile(50) == pytest.approx(500000, rel=0.04)
+    assert histogram.percentile(99) == pytest.approx(990000, rel=0.04)
+    assert histogram.percentile(100) == 1000000
+
+
+def test_handle__records_metrics_per_route():
+    handler = EchoHandler()
+
+    handler.handle(make_request("GET", "echo"))
+    handler.handle(make_request("GET", "missing"))
+    response = handler.handle(make_request("GET", "metrics"))
+
+    routes = json.loads(response["payload"])["routes"]
+    assert routes["get_echo"]["requests"] == 1
+    assert routes["get_echo"]["errors"] == 0
+    assert set(routes["get_echo"]["phases"]) >= {"parse", "route", "handler", "total"}
+    assert routes["not_found"]["errors"] == 1
+
+
+def test_map_concurrent__records_worker_phases_in_the_route_of_the_request():
+    class FanOutHandler(EchoHandler):
+        def get_fan_out(self, request_info, **kwargs):
+            def query_chunk(chunk):
+                with self.timed("kv_query"):
+                    return threading.current_thread().name
+
+            threads = self.map_concurrent(query_chunk, range(4), tenant_id="t1")
+            return {"payload": threads, "status": 200}
+
+    handler = FanOutHandler()
+    response = handler.handle(make_request("GET", "fan_out"))
+    handler.done()
+
+    assert all(name.startswith("rest_handler") for name in response["payload"])
+    assert handler.metrics.routes["get_fan_out"]["phases"]["kv_query"].count == 4
+    assert "background" not in handler.metrics.routes
+
+
+def test_tenant_executor__keeps_order_and_limits_tenant_concurrency():
+    executor = z_rest_handler.TenantExecutor(max_workers=8, tenant_concurrency=2)
+    lock = threading.Lock()
+    running = []
+    peak = []
+
+    def call(item):
+        with lock:
+            running.append(item)
+            peak.append(len(running))
+        time.sleep(0.01)
+        with lock:
+            running.remove(item)
+        return item * 2
+
+    try:
+        assert executor.map(call, range(10), "tenant") == [i * 2 for i in range(10)]
+    finally:
+        executor.shutdown()
+
+    assert max(peak) == 2
+
+
+def test_tenant_executor__raises_after_all_calls_completed():
+    executor = z_rest_handler.TenantExecutor(max_workers=4, tenant_concurrency=4)
+    completed = []
+
+    def call(item):
+        if item == 0:
+            raise ValueError("failed")
+        time.sleep(0.01)
+        completed.append(item)
+
+    try:
+        with pytest.raises(ValueError):
+            executor.map(call, range(4))
+    finally:
+        executor.shutdown()
+
+    assert sorted(completed) == [1, 2, 3]
+
+
+class AsyncEchoHandler(z_rest_handler.AsyncRESTHandler):
+    def __init__(self):
+        super(AsyncEchoHandler, self).__init__(None, None, logging.getLogger(__name__))
+
+    def get_echo(self, request_info, **kwargs):
+        return {"payload": kwargs, "status": 200}
+
+    async def post_ack_manage(self, request_info, **kwargs):
+        async def double(value):
+            await asyncio.sleep(0.001)
+            return value * 2
+
+        results = await z_rest_handler.gather_limited(
+            [double(value) for value in range(5)], 2
+        )
+        return self.render_json(results)
+
+
+def test_async_handler__runs_coroutine_and_sync_routes():
+    handler = AsyncEchoHandler()
+    try:
+        response = handler.handle(make_request("POST", "ack_manage"))
+        assert json.loads(response["payload"]) == [0, 2, 4, 6, 8]
+
+        response = handler.handle(make_request("GET", "echo", query=[["a", "1"]]))
+        assert response["payload"] == {"a": "1"}
+    finally:
+        handler.done()
+
+
+def test_async_handler__closes_evicted_clients_in_the_event_loop():
+    routes = {r["path"] for r in AsyncEchoHandler.list_routes()}
+    assert not any("async_client" in path for path in routes)
+
+    handler = AsyncEchoHandler()
+    handler.max_async_clients = 1
+    closed = []
+    try:
+        requests = []
+        for token in ("token1", "token2"):
+            request = json.loads(make_request("GET", "echo"))
+            request["session"]["authtoken"] = token
+            requests.append(z_rest_handler.RequestInfo(request))
+
+        first = handler.async_client_for(requests[0])
+        assert handler.async_client_for(requests[0]) is first
+        first.close = lambda: closed.append(threading.current_thread().name)
+
+        second = handler.async_client_for(requests[1])
+        handler.event_loop.run(asyncio.sleep(0))
+
+        assert second is not first
+        assert closed == ["rest_handler_loop"]
+        assert list(handler.async_clients.values()) == [second]
+    finally:
+        handler.done()
+
+
+class SplunkdStub(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    connections = set()
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.connections.add(self.client_address)
+        body = json.dumps([{"_key": "1", "path": self.path}]).encode("utf-8")
+        self.send_response(200)
+        if "chunked" in self.path:
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for start in range(0, len(body), 7):
+                chunk = body[start : start + 7]
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            self.wfile.write(b"0\r\n\r\n")
+        else:
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+
+def test_async_client__reuses_connection_and_reads_chunked_bodies():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SplunkdStub)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    rest_uri = "http://127.0.0.1:%d" % server.server_address[1]
+
+    async def scenario():
+        async_client = z_rest_handler.AsyncSplunkdClient(rest_uri, "token")
+        try:
+            first = await async_client.kvstore_query("c1", app="trackme", limit=10)
+            second = await async_client.kvstore_query("chunked", query={"a": 1})
+        finally:
+            async_client.close()
+        return first, second
+
+    try:
+        first, second = asyncio.run(scenario())
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert first[0]["path"].startswith(
+        "/servicesNS/nobody/trackme/storage/collections/data/c1?limit=10"
+    )
+    assert second[0]["_key"] == "1"
+    assert len(SplunkdStub.connections) == 1
+
+
+def test_single_flight__coalesces_concurrent_calls_and_caches_results():
+    single_flight = z_rest_handler.SingleFlight(ttl=60)
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def read():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return len(calls)
+
+    results = []
+    leader = threading.Thread(
+        target=lambda: results.append(single_flight.do("key", read, group="g"))
+    )
+    leader.start()
+    started.wait(5)
+    followers = [
+        threading.Thread(
+            target=lambda: results.append(single_flight.do("key", read, group="g"))
+        )
+        for _ in range(4)
+    ]
+    for follower in followers:
+        follower.start()
+    time.sleep(0.05)
+    release.set()
+    for thread in [leader] + followers:
+        thread.join(5)
+
+    assert results == [1] * 5
+    assert single_flight.do("key", read, group="g") == 1
+
+    single_flight.invalidate("g")
+    assert single_flight.do("key", read, group="g") == 2
+
+
+def test_single_flight__does_not_cache_invalidated_or_failed_calls():
+    single_flight = z_rest_handler.SingleFlight(ttl=60)
+    calls = []
+
+    def read_and_write():
+        calls.append(1)
+        single_flight.invalidate("g")
+        return len(calls)
+
+    assert single_flight.do("key", read_and_write, group="g") == 1
+    assert single_flight.do("key", read_and_write, group="g") == 2
+
+    with pytest.raises(ValueError):
+        single_flight.do("failing", lambda: int("x"))
+    assert "failing" not in single_flight.cache
+
+
+def test_key_locks__serialize_overlapping_keys_and_drop_released_locks():
+    key_locks = z_rest_handler.KeyLocks()
+    held = threading.Event()
+    order = []
+
+    def hold(keys, name):
+        with key_locks.hold(keys):
+            held.set()
+            order.append(name)
+            time.sleep(0.05)
+            order.append(name)
+
+    first = threading.Thread(target=hold, args=([("c", "2"), ("c", "1")], "first"))
+    first.start()
+    held.wait(5)
+    with key_locks.hold([("c", "1"), ("c", "3")]):
+        order.append("second")
+    first.join(5)
+
+    assert order == ["first", "first", "second"]
+    assert key_locks.locks == {}
+
+
+def test_rate_limit_filter__limits_repeated_errors_per_route():
+    route_name = ["route_a"]
+    rate_limit = z_rest_handler.RateLimitFilter(route=lambda: route_name[0], burst=2)
+
+    def error(msg, *args):
+        return logging.LogRecord("test", logging.ERROR, __file__, 1, msg, args, None)
+
+    allowed = [rate_limit.filter(error("failed %s", i)) for i in range(5)]
+    route_name[0] = "route_b"
+    allowed.append(rate_limit.filter(error("failed %s", 5)))
+
+    assert allowed == [True, True, False, False, False, True]
+    assert rate_limit.suppressed == 3
+    assert rate_limit.filter(
+        logging.LogRecord("test", logging.INFO, __file__, 1, "failed %s", (6,), None)
+    )
+    assert rate_limit.filter(
+        logging.LogRecord("test", logging.WARNING, __file__, 1, "failed %s", (6,), None)
+    )
+
+    rate_limit.windows[("route_a", logging.ERROR, "test", "failed %s")][0] -= 60
+    record = error("failed %s", 7)
+    route_name[0] = "route_a"
+    assert rate_limit.filter(record)
+    assert record.getMessage() == "failed 7 (3 similar records suppressed)"
+
+
+def test_log_error__logs_the_message_with_its_arguments(caplog):
+    handler = EchoHandler()
+
+    with caplog.at_level(logging.ERROR):
+        messages = [
+            handler.log_error('tenant_id="%s", failed, exception="%s"', tenant, 100)
+            for tenant in ("t1", "t2")
+        ]
+    handler.done()
+
+    assert messages == [
+        'tenant_id="t1", failed, exception="100"',
+        'tenant_id="t2", failed, exception="100"',
+    ]
+    # the records share their message, the limit of repeated errors applies to both
+    assert {record.msg for record in caplog.records} == {
+        'tenant_id="%s", failed, exception="%s"'
+    }
+    assert handler.log_error("100%") == "100%"
+
+
+def test_bounded_queue_handler__drops_records_when_full():
+    handler = z_rest_handler.BoundedQueueHandler(max_queue=2)
+    for i in range(5):
+        handler.handle(
+            logging.LogRecord("test", logging.INFO, __file__, 1, "%s", (i,), None)
+        )
+
+    assert handler.queue.qsize() == 2
+    assert handler.dropped == 3
+
+
+def test_logging_pipeline__writes_records_in_the_background(tmp_path, monkeypatch):
+    (tmp_path / "var" / "log" / "splunk").mkdir(parents=True)
+    monkeypatch.setenv("SPLUNK_HOME", str(tmp_path))
+    root = logging.getLogger()
+    root_handlers, root_level = root.handlers[:], root.level
+
+    pipeline = z_rest_handler.LoggingPipeline.install("test_rest_api.log")
+    try:
+        logging.getLogger("test_pipeline").info("request %s", "done")
+    finally:
+        pipeline.stop()
+        del z_rest_handler.LoggingPipeline.pipelines[pipeline.filename]
+        root.handlers[:] = root_handlers
+        root.setLevel(root_level)
+
+    log = (tmp_path / "var" / "log" / "splunk" / "test_rest_api.log").read_text()
+    assert "INFO" in log and "request done" in log